@@ -0,0 +1,228 @@
+"""
+Storage formats for the per-clip arrays written by wav_to_numpy.py. Saving
+    librosa's float32 output takes 640KB per 10s clip at 16kHz, while the
+    downloaded .wav files only ever held 16 bit PCM. The formats are:
+    - 'float32' :    <n>.wav.npy float32 array, the original layout
+    - 'int16' :      <n>.wav.npy int16 PCM array, half the size and lossless for
+        clips that did not need resampling
+    - 'compressed' : <n>.wav.npz zlib compressed int16 PCM array, smaller again
+        at the cost of some decode time
+
+'load_clip' reads any of them back as float32, dequantising int16 PCM the same
+    way soundfile does(divided by 32768). As per-sample normalisation cannot be
+    stored in int16, clips in the PCM formats can be normalised as they are
+    loaded instead. wav_to_numpy.py records whether a dataset needs this in its
+    'storage.json', which every reader checks with 'normalise_on_load'.
+
+Every load is counted by 'io_meter', which can report how much reading was saved
+    compared to the same clips stored as float32.
+"""
+
+###############################################################################
+# IMPORTS
+###############################################################################
+import numpy as np
+import json
+import os
+
+# Extension of the saved file for each format
+storage_formats = {'float32': '.npy', 'int16': '.npy', 'compressed': '.npz'}
+
+# Name of the file in a dataset folder recording how its clips were stored
+storage_file = 'storage.json'
+
+###############################################################################
+# FUNCTIONS
+###############################################################################
+def clip_extensions():
+    """
+    :return extensions: tuple
+        Every file extension a stored clip can have
+    """
+    return tuple(sorted(set(storage_formats.values())))
+
+
+def quantise_pcm(data):
+    """
+    Converts float audio in [-1, 1] to 16 bit PCM
+
+    :param data: array
+        The float audio signal
+
+    :return pcm: array
+        The int16 signal
+    """
+    return np.clip(np.round(data * 32768), -32768, 32767).astype(np.int16)
+
+
+def clip_path(path, storage='float32'):
+    """
+    :param path: str
+        Path of the clip without the format extension, i.e '.../1.wav'
+    :param storage: str
+        One of 'float32', 'int16' or 'compressed'
+
+    :return path: str
+        Path the clip is saved at in that format
+    """
+    if storage not in storage_formats:
+        raise ValueError(f"Storage format must be one of {list(storage_formats)}, got: {storage}")
+    return path + storage_formats[storage]
+
+
+def save_clip(path, data, storage='float32'):
+    """
+    Saves a clip in one of the storage formats, through a temporary file which
+        is then renamed into place
+
+    :param path: str
+        Path of the clip, with the extension given by 'clip_path'
+    :param data: array
+        The float audio signal
+    :param storage: str
+        One of 'float32', 'int16' or 'compressed'
+
+    :save data: array
+        The clip as .npy or .npz
+    """
+    if storage not in storage_formats:
+        raise ValueError(f"Storage format must be one of {list(storage_formats)}, got: {storage}")
+
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        if storage == 'float32':
+            np.save(f, data.astype(np.float32))
+        elif storage == 'int16':
+            np.save(f, quantise_pcm(data))
+        else:
+            np.savez_compressed(f, data=quantise_pcm(data))
+    os.replace(temp_path, path)
+
+
+def load_clip(path, normalise=False):
+    """
+    Loads a clip saved in any of the storage formats as float32
+
+    :param path: str
+        Path of the .npy or .npz clip
+    :param normalise: Boolean
+        Whether to normalise the clip to mean 0 and std 1 as it is loaded, only
+            needed for clips stored as PCM
+
+    :return data: array
+        The float32 audio signal
+    """
+    if path.endswith('.npz'):
+        with np.load(path) as f:
+            data = f['data']
+    else:
+        data = np.load(path)
+
+    io_meter.add(os.path.getsize(path), data.size)
+
+    if data.dtype == np.int16:
+        data = data.astype(np.float32) / 32768
+    else:
+        data = data.astype(np.float32, copy=False)
+
+    if normalise:
+        std = data.std()
+        if std > 0:
+            data = (data - data.mean()) / std
+
+    return data
+
+
+def save_storage_info(data_dir, storage, normalise_on_load=False):
+    """
+    Records how the clips of a dataset were stored
+
+    :param data_dir: str
+        Base directory of the per-clip dataset
+    :param storage: str
+        One of 'float32', 'int16' or 'compressed'
+    :param normalise_on_load: Boolean
+        Whether the clips still have to be normalised as they are loaded
+
+    :save info: json
+        'storage.json' in the dataset folder, through a temporary file
+    """
+    path = os.path.join(data_dir, storage_file)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'storage': storage, 'normalise_on_load': normalise_on_load}, f, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def normalise_on_load(data_dir):
+    """
+    :param data_dir: str
+        Base directory of the per-clip dataset
+
+    :return normalise: Boolean
+        Whether its clips are to be normalised as they are loaded, False if it
+            has no 'storage.json', i.e it was not written by wav_to_numpy.py
+    """
+    path = os.path.join(data_dir, storage_file)
+    if not os.path.isfile(path):
+        return False
+    with open(path) as f:
+        return bool(json.load(f).get('normalise_on_load', False))
+
+
+def clip_shape(path):
+    """
+    Gets the shape of a clip, only reading what is needed to find it
+
+    :param path: str
+        Path of the .npy or .npz clip
+
+    :return shape: tuple
+        Shape of the stored array
+    """
+    if path.endswith('.npz'):
+        with np.load(path) as f:
+            return f['data'].shape
+    return np.load(path, mmap_mode='r').shape
+
+
+class IOMeter(object):
+    """
+    Running count of bytes read by 'load_clip' against what the same clips would
+        have taken to read as float32
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.num_clips = 0
+        self.bytes_read = 0
+        self.bytes_float32 = 0
+
+    def add(self, num_bytes, num_samples):
+        """
+        :param num_bytes: int
+            Size of the file that was read
+        :param num_samples: int
+            Number of samples in the clip
+        """
+        self.num_clips += 1
+        self.bytes_read += num_bytes
+        # 128 bytes is the usual .npy header
+        self.bytes_float32 += num_samples * 4 + 128
+
+    def report(self):
+        """
+        Prints how much less was read than with float32 clips
+
+        :return ratio: float
+            float32 bytes / bytes actually read
+        """
+        ratio = self.bytes_float32 / max(self.bytes_read, 1)
+        print(f'Loaded {self.num_clips} clips, read {self.bytes_read / 1e6:.1f}MB instead of '
+                f'{self.bytes_float32 / 1e6:.1f}MB as float32 ({ratio:.2f}x less I/O, '
+                f'{(self.bytes_float32 - self.bytes_read) / 1e6:.1f}MB saved)')
+        return ratio
+
+
+# Shared by every load in the process
+io_meter = IOMeter()
@@ -0,0 +1,194 @@
+"""
+N-way K-shot episode sampler over the processed dataset, for meta-learning.
+    Works on either the normalised split/class/<n>.wav.npy layout written by
+    raw_data_normalisation.py(or wav_to_numpy.py) or on shards packed by
+    pack_shards.py, which is picked automatically if an 'index.csv' is found.
+
+Everything the sampler needs, the list of usable classes and the clips of each,
+    is worked out once up front. Each episode is then only a few index draws
+    followed by one gather per class(with shards) into batched arrays:
+    - support : [n_way, k_shot, length]
+    - query :   [n_way, n_query, length]
+    - classes : the names of the n_way classes, row i of support and query is
+        class i
+
+Episodes are drawn from the seed in 'control.yaml'. Episode i always comes from
+    the seed and i alone, so a run is reproducible no matter how many prefetch
+    workers build the episodes or in what order they finish.
+
+USAGE:
+    sampler = EpisodeSampler(data_dir, 'train', n_way=5, k_shot=1, n_query=5)
+    for support, query, classes in sampler.iterate(num_episodes=1000):
+        ...
+"""
+
+###############################################################################
+# IMPORTS
+###############################################################################
+import numpy as np
+import yaml
+import os
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from pack_shards import ShardStore, clip_order
+from array_storage import load_clip, clip_extensions, normalise_on_load
+
+###############################################################################
+# FUNCTIONS
+###############################################################################
+def load_seed(control_path):
+    """
+    Gets the sampling seed used for the rest of the dataset
+
+    :param control_path: str
+        Path of 'control.yaml'
+
+    :return seed: int
+        The seed set in the control file
+    """
+    with open(control_path) as stream:
+        params = yaml.safe_load(stream)
+    return params['seed']
+
+###############################################################################
+# SAMPLER
+###############################################################################
+class EpisodeSampler(object):
+    """
+    Draws reproducible N-way K-shot episodes as batched arrays
+
+    :param data_dir: str
+        Base directory of the per-clip dataset or of the packed shards
+    :param split: str
+        Name of the split to draw episodes from
+    :param n_way: int
+        Number of classes per episode
+    :param k_shot: int
+        Number of support examples per class
+    :param n_query: int
+        Number of query examples per class
+    :param seed: int
+        Base seed, None reads it from the 'control.yaml' of the main codeset
+    :param length: int
+        Number of samples of every clip
+    :param normalise: Boolean
+        Whether per-clip files are normalised as they are loaded, for datasets
+            stored as PCM by wav_to_numpy.py. None follows the dataset's
+            'storage.json', shards are already normalised when packed
+    """
+    def __init__(self, data_dir, split, n_way, k_shot, n_query, seed=None, length=160000, normalise=None):
+        self.n_way = n_way
+        self.k_shot = k_shot
+        self.n_query = n_query
+        self.length = length
+        self.split = split
+        if normalise is None:
+            normalise = normalise_on_load(data_dir)
+        self.normalise = normalise
+
+        if seed is None:
+            seed = load_seed(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'control.yaml'))
+        self.seed = seed
+
+        # Shards are used whenever they are available, otherwise every clip is its own file
+        self.store = None
+        if os.path.isfile(os.path.join(data_dir, 'index.csv')):
+            self.store = ShardStore(data_dir)
+            sizes = {cls: self.store.size(split, cls) for cls in self.store.classes(split)}
+            self.files = None
+        else:
+            split_dir = os.path.join(data_dir, split)
+            self.files = {}
+            for seen_class in sorted(os.listdir(split_dir)):
+                working_dir = os.path.join(split_dir, seen_class)
+                if os.path.isdir(working_dir):
+                    files = sorted([f for f in os.listdir(working_dir) if f.endswith(clip_extensions())],
+                                    key=clip_order)
+                    self.files[seen_class] = [os.path.join(working_dir, f) for f in files]
+            sizes = {cls: len(files) for cls, files in self.files.items()}
+
+        # Only classes with enough examples for a full episode can be drawn
+        per_class = k_shot + n_query
+        self.classes = [cls for cls in sorted(sizes) if sizes[cls] >= per_class]
+        self.sizes = np.array([sizes[cls] for cls in self.classes], dtype=np.int64)
+
+        if len(self.classes) < n_way:
+            raise ValueError(f'Only {len(self.classes)} classes in split {split} have at least '
+                                f'{per_class} examples, {n_way} are needed per episode')
+
+    def draw(self, episode):
+        """
+        Draws the classes and example ids of an episode without loading anything
+
+        :param episode: int
+            Number of the episode
+
+        :return class_ids: array
+            [n_way] positions in 'self.classes'
+        :return example_ids: array
+            [n_way, k_shot + n_query] example ids within each class
+        """
+        rng = np.random.RandomState([self.seed, episode])
+        class_ids = rng.choice(len(self.classes), self.n_way, replace=False)
+        per_class = self.k_shot + self.n_query
+        example_ids = np.stack([rng.choice(self.sizes[c], per_class, replace=False) for c in class_ids])
+        return class_ids, example_ids
+
+    def episode(self, episode):
+        """
+        Builds a full episode
+
+        :param episode: int
+            Number of the episode
+
+        :return support: array
+            [n_way, k_shot, length] float32 support clips
+        :return query: array
+            [n_way, n_query, length] float32 query clips
+        :return classes: list
+            Names of the episode classes in row order
+        """
+        class_ids, example_ids = self.draw(episode)
+        data = np.empty((self.n_way, self.k_shot + self.n_query, self.length), dtype=np.float32)
+
+        for row, (c, ids) in enumerate(zip(class_ids, example_ids)):
+            cls = self.classes[c]
+            if self.store is not None:
+                data[row] = self.store.batch(self.split, cls, ids)
+            else:
+                for col, i in enumerate(ids):
+                    data[row, col] = load_clip(self.files[cls][i], self.normalise)
+
+        classes = [self.classes[c] for c in class_ids]
+        return data[:, :self.k_shot], data[:, self.k_shot:], classes
+
+    def iterate(self, num_episodes, start=0, workers=2, prefetch=4):
+        """
+        Yields episodes in order while background threads build the ones after.
+            Loading is mostly waiting on disk and numpy releases the GIL, so
+            threads are enough to keep a training loop fed.
+
+        :param num_episodes: int
+            Number of episodes to yield
+        :param start: int
+            Number of the first episode, i.e to carry on from a checkpoint
+        :param workers: int
+            Number of background threads building episodes
+        :param prefetch: int
+            Number of episodes built ahead of the one being used
+
+        :yield episode: tuple
+            (support, query, classes) as returned by 'episode'
+        """
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            next_episode = start
+            end = start + num_episodes
+
+            while pending or next_episode < end:
+                while next_episode < end and len(pending) < prefetch + 1:
+                    pending.append(executor.submit(self.episode, next_episode))
+                    next_episode += 1
+                yield pending.popleft().result()
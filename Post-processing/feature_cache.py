@@ -0,0 +1,378 @@
+"""
+Script precomputes log-mel spectrograms of the processed dataset so training
+    jobs no longer have to recompute features from the raw waveforms.
+
+Features are computed many clips at a time: a block of clips is framed into a
+    single [B, frames, n_fft] array, windowed and transformed with one rfft
+    call, then mapped onto the mel bands with one matrix product. The STFT
+    matches librosa's defaults(centred frames, reflect padding, hann window)
+    and the filterbank is the slaney style one librosa uses.
+
+Outputs go in a versioned cache folder named by a hash of the feature
+    parameters, so each configuration gets its own cache and a repeat run with
+    the same parameters finds its features already there:
+    - <cache_root>/<key>/params.json :     the parameters the cache was built with
+        and the dataset it was built from, building it from another dataset
+        recomputes every class
+    - <cache_root>/<key>/split/class.npy : [N, n_mels, frames] float32 features,
+        row i is the i-th clip of the class as ordered by pack_shards.py
+    - <cache_root>/<key>/index.csv :       split, class, row and file of each clip
+
+The input can either be a per-clip split/class/<n>.wav.npy dataset or packed
+    shards, which are used if an 'index.csv' is found. Per-clip PCM datasets
+    are normalised as they are loaded if their 'storage.json' asks for it.
+    Clips of a per-clip dataset which are not '--length' samples long are left
+    out and reported, as in pack_shards.py, shards keep their own length.
+
+USAGE:
+    python feature_cache.py data_dir cache_root [--sr 16000] [--n_fft 1024]
+                                [--hop 160] [--n_mels 128] [--batch 16] [--force]
+"""
+
+###############################################################################
+# IMPORTS
+###############################################################################
+import numpy as np
+import argparse
+import hashlib
+import json
+import time
+import csv
+import os
+
+from tqdm import tqdm
+from numpy.lib.stride_tricks import as_strided
+
+from pack_shards import ShardStore, clip_order, index_columns
+from array_storage import load_clip, clip_shape, clip_extensions, normalise_on_load
+
+# Bumped whenever the way features are computed changes, so old caches are not reused
+feature_version = 1
+
+###############################################################################
+# FEATURE FUNCTIONS
+###############################################################################
+def hz_to_mel(freqs):
+    """
+    Slaney mel scale, linear below 1kHz and logarithmic above
+
+    :param freqs: array
+        Frequencies in Hz
+
+    :return mels: array
+        The frequencies in mels
+    """
+    freqs = np.asarray(freqs, dtype=np.float64)
+    f_sp = 200.0 / 3
+    min_log_hz = 1000.0
+    logstep = np.log(6.4) / 27.0
+    mels = freqs / f_sp
+    log_region = freqs >= min_log_hz
+    mels[log_region] = min_log_hz / f_sp + np.log(freqs[log_region] / min_log_hz) / logstep
+    return mels
+
+
+def mel_to_hz(mels):
+    """
+    Inverse of 'hz_to_mel'
+
+    :param mels: array
+        Frequencies in mels
+
+    :return freqs: array
+        The frequencies in Hz
+    """
+    mels = np.asarray(mels, dtype=np.float64)
+    f_sp = 200.0 / 3
+    min_log_hz = 1000.0
+    min_log_mel = min_log_hz / f_sp
+    logstep = np.log(6.4) / 27.0
+    freqs = mels * f_sp
+    log_region = mels >= min_log_mel
+    freqs[log_region] = min_log_hz * np.exp(logstep * (mels[log_region] - min_log_mel))
+    return freqs
+
+
+def mel_filterbank(sr, n_fft, n_mels, fmin=0.0, fmax=None):
+    """
+    Triangular mel filters with slaney area normalisation
+
+    :param sr: int
+        Samplerate of the clips
+    :param n_fft: int
+        FFT size
+    :param n_mels: int
+        Number of mel bands
+    :param fmin: float
+        Lowest frequency in Hz
+    :param fmax: float
+        Highest frequency in Hz, None for sr / 2
+
+    :return filters: array
+        [n_mels, n_fft // 2 + 1] float32 filterbank
+    """
+    if fmax is None:
+        fmax = sr / 2
+    fft_freqs = np.linspace(0, sr / 2, n_fft // 2 + 1)
+    mel_freqs = mel_to_hz(np.linspace(hz_to_mel([fmin])[0], hz_to_mel([fmax])[0], n_mels + 2))
+
+    fdiff = np.diff(mel_freqs)
+    ramps = mel_freqs[:, None] - fft_freqs[None, :]
+    lower = -ramps[:-2] / fdiff[:-1, None]
+    upper = ramps[2:] / fdiff[1:, None]
+    filters = np.maximum(0, np.minimum(lower, upper))
+
+    filters *= (2.0 / (mel_freqs[2:n_mels + 2] - mel_freqs[:n_mels]))[:, None]
+    return filters.astype(np.float32)
+
+
+def batch_log_mel(block, filters, n_fft, hop, eps=1e-6):
+    """
+    Computes the log-mel spectrograms of a whole block of clips at once
+
+    :param block: array
+        [B, length] clips
+    :param filters: array
+        Mel filterbank from 'mel_filterbank'
+    :param n_fft: int
+        FFT size, also used as the window length
+    :param hop: int
+        Samples between frames
+    :param eps: float
+        Added before the log so silent bins stay finite
+
+    :return features: array
+        [B, n_mels, frames] float32 log-mel spectrograms
+    """
+    block = np.ascontiguousarray(block, dtype=np.float32)
+    # Centred frames, as librosa, so frame t is centred on sample t * hop
+    padded = np.pad(block, ((0, 0), (n_fft // 2, n_fft // 2)), mode='reflect')
+    num_frames = 1 + (padded.shape[1] - n_fft) // hop
+
+    # Overlapping frames are a strided view, nothing is copied until the window is applied
+    stride_b, stride_s = padded.strides
+    frames = as_strided(padded, shape=(padded.shape[0], num_frames, n_fft),
+                        strides=(stride_b, hop * stride_s, stride_s), writeable=False)
+
+    window = (0.5 - 0.5 * np.cos(2 * np.pi * np.arange(n_fft) / n_fft)).astype(np.float32)
+    spectrum = np.fft.rfft(frames * window, axis=-1)
+    power = (spectrum.real ** 2 + spectrum.imag ** 2).astype(np.float32)
+
+    mel = np.matmul(power, filters.T)
+    return np.log(mel + eps).transpose(0, 2, 1).astype(np.float32)
+
+###############################################################################
+# CACHE
+###############################################################################
+class FeatureCache(object):
+    """
+    On disk cache of log-mel features for one set of feature parameters
+
+    :param cache_root: str
+        Folder holding the caches of every configuration
+    :param sr: int
+        Samplerate of the clips
+    :param n_fft: int
+        FFT size and window length
+    :param hop: int
+        Samples between frames
+    :param n_mels: int
+        Number of mel bands
+    :param fmin: float
+        Lowest frequency in Hz
+    :param fmax: float
+        Highest frequency in Hz, None for sr / 2
+    """
+    def __init__(self, cache_root, sr=16000, n_fft=1024, hop=160, n_mels=128, fmin=0.0, fmax=None):
+        self.params = {'version': feature_version, 'sr': sr, 'n_fft': n_fft, 'hop': hop,
+                        'n_mels': n_mels, 'fmin': fmin, 'fmax': sr / 2 if fmax is None else fmax}
+        self.key = hashlib.sha1(json.dumps(self.params, sort_keys=True).encode()).hexdigest()[:12]
+        self.path = os.path.join(cache_root, self.key)
+        self.filters = mel_filterbank(sr, n_fft, n_mels, fmin, fmax)
+
+    def feature_path(self, split, cls):
+        """
+        :return path: str
+            Path of the feature array of a class
+        """
+        return os.path.join(self.path, split, cls + '.npy')
+
+    def load(self, split, cls):
+        """
+        Gets the features of a class
+
+        :param split: str
+            Name of the split
+        :param cls: str
+            Name of the class
+
+        :return features: memmap
+            [N, n_mels, frames] features of the class
+        """
+        return np.load(self.feature_path(split, cls), mmap_mode='r')
+
+    def build_class(self, feature_path, num_clips, get_clips, length, batch=16):
+        """
+        Computes and writes the features of a single class
+
+        :param feature_path: str
+            Path the features are written to
+        :param num_clips: int
+            Number of clips in the class
+        :param get_clips: function
+            Takes an array of row ids and returns their [B, length] clips
+        :param length: int
+            Number of samples of every clip
+        :param batch: int
+            Number of clips per feature call
+
+        :save features: array
+            The [N, n_mels, frames] features, through a temporary file
+        """
+        num_frames = 1 + length // self.params['hop']
+        temp_path = feature_path + '.tmp.npy'
+        features = np.lib.format.open_memmap(temp_path, mode='w+', dtype=np.float32,
+                                                shape=(num_clips, self.params['n_mels'], num_frames))
+
+        try:
+            for i in range(0, num_clips, batch):
+                ids = np.arange(i, min(i + batch, num_clips))
+                features[ids[0]:ids[-1] + 1] = batch_log_mel(get_clips(ids), self.filters,
+                                                                self.params['n_fft'], self.params['hop'])
+            features.flush()
+        except BaseException:
+            # Nothing half computed is left behind
+            del features
+            os.remove(temp_path)
+            raise
+
+        del features
+        os.replace(temp_path, feature_path)
+
+    def build(self, data_dir, length=160000, batch=16, force=False):
+        """
+        Fills the cache with the features of every class in the dataset. Classes
+            already in the cache are skipped unless their source is newer, or
+            the cache was built from another dataset.
+
+        :param data_dir: str
+            Base directory of the per-clip dataset or of the packed shards
+        :param length: int
+            Number of samples every per-clip file should have, shards use
+                their own length
+        :param batch: int
+            Number of clips per feature call
+        :param force: Boolean
+            Whether to recompute classes already in the cache
+        """
+        start_time = time.time()
+        os.makedirs(self.path, exist_ok=True)
+
+        # Features of another dataset are never served as this one's, however new they are
+        params_path = os.path.join(self.path, 'params.json')
+        source = os.path.abspath(data_dir)
+        if os.path.isfile(params_path):
+            with open(params_path) as f:
+                old_source = json.load(f).get('source')
+            if old_source != source:
+                print(f'Cache {self.key} was built from {old_source}, recomputing every class')
+                force = True
+        with open(params_path, 'w') as f:
+            json.dump(dict(self.params, source=source), f, sort_keys=True)
+
+        built, skipped, num_clips = 0, 0, 0
+        index = []
+        for split, cls, files, source_path, get_clips, clip_length in tqdm(dataset_classes(data_dir, length)):
+            index += [{'split': split, 'class': cls, 'row': row, 'file': file, 'scale': ''}
+                        for row, file in enumerate(files)]
+
+            feature_path = self.feature_path(split, cls)
+            if (not force and os.path.isfile(feature_path) and
+                    os.path.getmtime(feature_path) >= os.path.getmtime(source_path)):
+                skipped += 1
+                continue
+
+            os.makedirs(os.path.dirname(feature_path), exist_ok=True)
+            self.build_class(feature_path, len(files), get_clips, clip_length, batch)
+            built += 1
+            num_clips += len(files)
+
+        with open(os.path.join(self.path, 'index.csv'), 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=index_columns)
+            writer.writeheader()
+            writer.writerows(index)
+
+        run_time = max(time.time() - start_time, 1e-9)
+        print(f'Cache {self.key}: computed features of {num_clips} clips in {built} classes, '
+                f'{skipped} classes already cached, {run_time:.1f}s ({num_clips / run_time:.1f} clips/s)')
+
+
+def dataset_classes(data_dir, length=160000):
+    """
+    Lists every class of a per-clip dataset or of packed shards along with a
+        way of loading blocks of its clips
+
+    :param data_dir: str
+        Base directory of the per-clip dataset or of the packed shards
+    :param length: int
+        Number of samples every per-clip file should have, the rest are left
+            out. Shards are all one length already
+
+    :yield class: tuple
+        (split, class, clip file names, path whose modification time marks the
+            class as changed, function from row ids to [B, length] clips,
+            length of the clips)
+    """
+    if os.path.isfile(os.path.join(data_dir, 'index.csv')):
+        store = ShardStore(data_dir)
+        for split in store.splits():
+            for cls in store.classes(split):
+                files = [row['file'] for row in store.index[(split, cls)]]
+                get_clips = lambda ids, split=split, cls=cls: store.batch(split, cls, ids)
+                yield (split, cls, files, os.path.join(data_dir, split, cls + '.npy'), get_clips,
+                        store.shard(split, cls).shape[1])
+        return
+
+    # PCM clips converted with '--normalise' are normalised here, shards already are
+    normalise = normalise_on_load(data_dir)
+    for split in sorted(os.listdir(data_dir)):
+        temp = os.path.join(data_dir, split)
+        if not os.path.isdir(temp):
+            continue
+        for cls in sorted(os.listdir(temp)):
+            working_dir = os.path.join(temp, cls)
+            if not os.path.isdir(working_dir):
+                continue
+            files = sorted([f for f in os.listdir(working_dir) if f.endswith(clip_extensions())], key=clip_order)
+
+            # Only the headers are read to find which clips are the right shape
+            keep = []
+            for file in files:
+                shape = clip_shape(os.path.join(working_dir, file))
+                if shape == (length,):
+                    keep.append(file)
+                else:
+                    print(f'File: {os.path.join(working_dir, file)} was not cached due to shape {shape}')
+
+            paths = [os.path.join(working_dir, f) for f in keep]
+            get_clips = lambda ids, paths=paths: np.stack([load_clip(paths[i], normalise) for i in ids])
+            yield split, cls, keep, working_dir, get_clips, length
+
+###############################################################################
+# MAIN FUNCTION
+###############################################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precomputes log-mel features of the processed dataset')
+    parser.add_argument('data_dir', help='Base directory of the per-clip dataset or of the packed shards')
+    parser.add_argument('cache_root', help='Folder holding the feature caches')
+    parser.add_argument('--sr', type=int, default=16000, help='Samplerate of the clips')
+    parser.add_argument('--n_fft', type=int, default=1024, help='FFT size and window length')
+    parser.add_argument('--hop', type=int, default=160, help='Samples between frames')
+    parser.add_argument('--n_mels', type=int, default=128, help='Number of mel bands')
+    parser.add_argument('--length', type=int, default=160000, help='Samples every per-clip file should have')
+    parser.add_argument('--batch', type=int, default=16, help='Clips per feature call')
+    parser.add_argument('--force', action='store_true', help='Recompute classes already in the cache')
+    args = parser.parse_args()
+
+    cache = FeatureCache(args.cache_root, args.sr, args.n_fft, args.hop, args.n_mels)
+    cache.build(args.data_dir, args.length, args.batch, args.force)
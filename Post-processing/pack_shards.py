@@ -0,0 +1,371 @@
+"""
+Script packs the per-clip .npy files, as written by wav_to_numpy.py or
+    raw_data_normalisation.py, into one contiguous array per class. Loading a
+    class for training then costs a single memory-mapped open rather than one
+    open and read per clip, and the filesystem holds a handful of large files
+    instead of millions of tiny ones.
+
+The 'data_dir' is expected to have the usual split/class/<n>.wav.npy layout, in
+    any of the storage formats of array_storage.py,
+    which is mirrored in 'shard_dir' as:
+    - split/class.npy : [N, length] array of every clip of the class, row i is
+        the i-th clip in the index
+    - index.csv :       split, class, row and original file name of every clip,
+        plus the scale needed to dequantise it if stored as int16
+
+Shards are stored as float32 by default. With '--dtype int16' each clip is
+    scaled by its own peak into the int16 range, halving the size of the
+    shards, and the scale is kept in the index so 'ShardStore' can undo it.
+
+Clips of a dataset whose 'storage.json' asks for it, i.e PCM clips converted
+    with '--normalise', are normalised as they are packed, so the shards hold
+    the same values as a float32 dataset built with the same options.
+
+Clips that are not exactly 'length' samples long are left out and reported. A
+    shard that is newer than every clip in its class folder is taken as up to
+    date and not packed again.
+
+USAGE:
+    python pack_shards.py data_dir shard_dir [--dtype float32] [--length 160000]
+                                                [--block 256] [--force]
+"""
+
+###############################################################################
+# IMPORTS
+###############################################################################
+import numpy as np
+import argparse
+import time
+import csv
+import os
+
+from tqdm import tqdm
+
+from array_storage import load_clip, clip_shape, clip_extensions, normalise_on_load, io_meter
+
+# Columns of the shard index
+index_columns = ['split', 'class', 'row', 'file', 'scale']
+
+###############################################################################
+# PACKING FUNCTIONS
+###############################################################################
+def clip_order(file):
+    """
+    Sort key which puts '2.wav.npy' before '10.wav.npy', i.e download order
+
+    :param file: str
+        Name of the clip file
+
+    :return key: tuple
+        Numeric prefix of the name if it has one, then the name itself
+    """
+    prefix = file.split('.')[0]
+    return (int(prefix), file) if prefix.isdigit() else (float('inf'), file)
+
+
+def quantise(block):
+    """
+    Scales each clip of a block by its own peak into the int16 range
+
+    :param block: array
+        [B, length] float clips
+
+    :return quantised: array
+        [B, length] int16 clips
+    :return scale: array
+        Per clip scale, quantised * scale gives back the clip
+    """
+    peak = np.abs(block).max(axis=1)
+    scale = np.where(peak > 0, peak / 32767, 1.0).astype(np.float32)
+    quantised = np.round(block / scale[:, None]).astype(np.int16)
+    return quantised, scale
+
+
+def pack_class(working_dir, shard_path, dtype='float32', length=160000, block=256, normalise=False):
+    """
+    Packs every clip in a class folder into a single [N, length] array
+
+    :param working_dir: str
+        Class folder of per-clip .npy files
+    :param shard_path: str
+        Path the shard is written to
+    :param dtype: str
+        Either 'float32' or 'int16'
+    :param length: int
+        Number of samples every clip should have
+    :param block: int
+        Number of clips loaded and written at a time
+    :param normalise: Boolean
+        Whether clips are normalised as they are loaded, for PCM datasets
+
+    :return files: list
+        Names of the clips packed, in row order
+    :return scale: array
+        Per clip dequantisation scale, None for float32 shards
+    :return num_bytes: int
+        Number of bytes of clips read
+
+    :save shard: array
+        The .npy shard, through a temporary file renamed into place
+    """
+    files = sorted([f for f in os.listdir(working_dir) if f.endswith(clip_extensions())], key=clip_order)
+
+    # Only the headers are read to find which clips are the right shape
+    keep = []
+    for file in files:
+        shape = clip_shape(os.path.join(working_dir, file))
+        if shape == (length,):
+            keep.append(file)
+        else:
+            print(f'File: {os.path.join(working_dir, file)} was not packed due to shape {shape}')
+
+    temp_path = shard_path + '.tmp.npy'
+    shard = np.lib.format.open_memmap(temp_path, mode='w+', dtype=dtype, shape=(len(keep), length))
+    scale = np.ones(len(keep), dtype=np.float32) if dtype == 'int16' else None
+
+    num_bytes = 0
+    for i in range(0, len(keep), block):
+        paths = [os.path.join(working_dir, f) for f in keep[i:i + block]]
+        data = np.stack([load_clip(p, normalise) for p in paths])
+        num_bytes += sum(os.path.getsize(p) for p in paths)
+
+        if dtype == 'int16':
+            shard[i:i + len(paths)], scale[i:i + len(paths)] = quantise(data)
+        else:
+            shard[i:i + len(paths)] = data
+
+    shard.flush()
+    del shard
+    os.replace(temp_path, shard_path)
+
+    return keep, scale, num_bytes
+
+
+def is_up_to_date(working_dir, shard_path):
+    """
+    Checks whether a shard was written after every clip in its class folder
+
+    :param working_dir: str
+        Class folder of per-clip .npy files
+    :param shard_path: str
+        Path of the shard
+
+    :return up_to_date: Boolean
+        True if the class does not need packing again
+    """
+    try:
+        shard_time = os.path.getmtime(shard_path)
+    except OSError:
+        return False
+    newest = max([os.path.getmtime(working_dir)] +
+                    [os.path.getmtime(os.path.join(working_dir, f)) for f in os.listdir(working_dir)])
+    return shard_time >= newest
+
+
+def load_index(index_path):
+    """
+    Reads a shard index
+
+    :param index_path: str
+        Path of the index csv
+
+    :return index: dict
+        (split, class) -> list of index rows, in row order
+    """
+    index = {}
+    if not os.path.isfile(index_path):
+        return index
+    with open(index_path, newline='') as f:
+        for row in csv.DictReader(f):
+            index.setdefault((row['split'], row['class']), []).append(row)
+    return index
+
+###############################################################################
+# LOADER
+###############################################################################
+class ShardStore(object):
+    """
+    Read only access to packed shards. Every shard is memory-mapped, so clips
+        are only read from disk when they are actually used.
+
+    :param shard_dir: str
+        Directory written by 'main'
+    """
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        self.index = load_index(os.path.join(shard_dir, 'index.csv'))
+        self.shards = {}
+        self.scales = {}
+
+    def splits(self):
+        """
+        :return splits: list
+            Every split in the store
+        """
+        return sorted(set(split for split, _ in self.index))
+
+    def classes(self, split):
+        """
+        :param split: str
+            Name of the split
+
+        :return classes: list
+            Every class in the split
+        """
+        return sorted(cls for s, cls in self.index if s == split)
+
+    def shard(self, split, cls):
+        """
+        Gets the whole of a class, opened on first use
+
+        :param split: str
+            Name of the split
+        :param cls: str
+            Name of the class
+
+        :return shard: memmap
+            [N, length] array of the class as stored
+        """
+        key = (split, cls)
+        if key not in self.shards:
+            self.shards[key] = np.load(os.path.join(self.shard_dir, split, cls + '.npy'), mmap_mode='r')
+            if self.shards[key].dtype == np.int16:
+                self.scales[key] = np.array([float(r['scale']) for r in self.index[key]], dtype=np.float32)
+        return self.shards[key]
+
+    def __len__(self):
+        return sum(len(rows) for rows in self.index.values())
+
+    def size(self, split, cls):
+        """
+        :return num_clips: int
+            Number of clips in the class
+        """
+        return len(self.index[(split, cls)])
+
+    def views(self, split, cls, ids):
+        """
+        Gets clips without copying them, each is a view onto the shard
+
+        :param split: str
+            Name of the split
+        :param cls: str
+            Name of the class
+        :param ids: list or slice
+            Row ids of the clips, a slice gives a single view of the range
+
+        :return views: list or memmap
+            One view per id as stored, i.e still quantised for int16 shards
+        """
+        shard = self.shard(split, cls)
+        if isinstance(ids, slice):
+            return shard[ids]
+        return [shard[i] for i in ids]
+
+    def batch(self, split, cls, ids):
+        """
+        Gets clips as a single float32 array, dequantised if needed
+
+        :param split: str
+            Name of the split
+        :param cls: str
+            Name of the class
+        :param ids: array
+            Row ids of the clips
+
+        :return batch: array
+            [len(ids), length] float32 clips in the order asked for
+        """
+        shard = self.shard(split, cls)
+        ids = np.asarray(ids, dtype=np.int64)
+        batch = shard[ids]
+        if shard.dtype == np.int16:
+            batch = batch.astype(np.float32) * self.scales[(split, cls)][ids][:, None]
+        return batch
+
+###############################################################################
+# MAIN FUNCTION
+###############################################################################
+def main(data_dir, shard_dir, dtype='float32', length=160000, block=256, force=False):
+    """
+    Packs every class of every split in the data directory into shards
+
+    :param data_dir: str
+        Base directory of the per-clip .npy dataset
+    :param shard_dir: str
+        Directory the shards and index are written to, created if needed
+    :param dtype: str
+        Either 'float32' or 'int16'
+    :param length: int
+        Number of samples every clip should have
+    :param block: int
+        Number of clips loaded and written at a time
+    :param force: Boolean
+        Whether to pack classes even if their shard is up to date
+    """
+    if dtype not in ['float32', 'int16']:
+        raise ValueError(f"Shard dtype must be 'float32' or 'int16', got: {dtype}")
+
+    start_time = time.time()
+    normalise = normalise_on_load(data_dir)
+    index_path = os.path.join(shard_dir, 'index.csv')
+    old_index = load_index(index_path)
+    index = {}
+
+    jobs = []
+    for split in sorted(os.listdir(data_dir)):
+        temp = os.path.join(data_dir, split)
+        if not os.path.isdir(temp):
+            continue
+        for seen_class in sorted(os.listdir(temp)):
+            working_dir = os.path.join(temp, seen_class)
+            if os.path.isdir(working_dir):
+                jobs.append((split, seen_class, working_dir))
+
+    packed, skipped, num_clips, num_bytes = 0, 0, 0, 0
+    for split, seen_class, working_dir in tqdm(jobs):
+        os.makedirs(os.path.join(shard_dir, split), exist_ok=True)
+        shard_path = os.path.join(shard_dir, split, seen_class + '.npy')
+
+        # Shards of the same type which havent gone out of date are kept as they are
+        key = (split, seen_class)
+        if (not force and key in old_index and is_up_to_date(working_dir, shard_path) and
+                np.load(shard_path, mmap_mode='r').dtype == dtype):
+            index[key] = old_index[key]
+            skipped += 1
+            continue
+
+        files, scale, class_bytes = pack_class(working_dir, shard_path, dtype, length, block, normalise)
+        index[key] = [{'split': split, 'class': seen_class, 'row': row, 'file': file,
+                        'scale': '' if scale is None else repr(float(scale[row]))}
+                        for row, file in enumerate(files)]
+        packed += 1
+        num_clips += len(files)
+        num_bytes += class_bytes
+
+    temp_path = index_path + '.tmp'
+    with open(temp_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=index_columns)
+        writer.writeheader()
+        for key in sorted(index):
+            writer.writerows(index[key])
+    os.replace(temp_path, index_path)
+
+    run_time = max(time.time() - start_time, 1e-9)
+    print(f'Packed {num_clips} clips into {packed} shards, {skipped} shards already up to date, '
+            f'{run_time:.1f}s ({num_bytes / run_time / 1e6:.1f} MB/s of clips read)')
+    io_meter.report()
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Packs per-clip .npy files into one array per class')
+    parser.add_argument('data_dir', help='Base directory of the per-clip .npy dataset')
+    parser.add_argument('shard_dir', help='Directory the shards and index are written to')
+    parser.add_argument('--dtype', default='float32', choices=['float32', 'int16'], help='Storage type of the shards')
+    parser.add_argument('--length', type=int, default=160000, help='Samples every clip should have')
+    parser.add_argument('--block', type=int, default=256, help='Clips loaded and written at a time')
+    parser.add_argument('--force', action='store_true', help='Pack classes even if already up to date')
+    args = parser.parse_args()
+
+    main(args.data_dir, args.shard_dir, args.dtype, args.length, args.block, args.force)
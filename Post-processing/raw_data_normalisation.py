@@ -3,18 +3,50 @@ Script deals with per-sample normalisation of the raw audio signals after they
     have been converted from wav to npy.
 The main function iterates over the so called 'old_dir'and creates  a mirror
     directory in 'new_dir'.
-The script assumes that the 'new_dir' directory has already been created.
+
+Clips saved in any of the formats of array_storage.py are read, the normalised
+    output is always float32.
+
+Rather than one clip at a time, clips are stacked into [block, length] arrays
+    and the stats and scaling of every row are done in one vectorised call by
+    'normalise_block'. 'old_dir' can be either:
+    - The per-clip split/class/<n>.wav.npy layout, each class is loaded a block
+        at a time into one reused buffer and the rows saved as float32 .npy
+    - Shards packed by pack_shards.py, picked when an 'index.csv' is found.
+        Each block is normalised straight into a memory-mapped output shard, so
+        a class never has to fit in memory. Rows are kept in place so the index
+        stays valid, clips with a std of 0 are left as silence and reported.
+
+With '--inplace' each block is normalised in its own buffer, without the output
+    buffer and full size temporaries of the default, halving peak memory. The
+    std is then found from the sum of squares, which agrees with the default to
+    within float32 precision. For float32 shards with 'new_dir' the same as
+    'old_dir' the shards themselves are normalised in place.
+
+'normalise_sample' is also used by wav_to_numpy.py, which can do the conversion
+    and normalisation in a single pass with '--normalise'.
+
+USAGE:
+    python raw_data_normalisation.py [old_dir] [new_dir] [--length 160000]
+                                        [--block 256] [--inplace]
 """
 ###############################################################################
 # IMPORTS
 ###############################################################################
 import numpy as np
+import argparse
 import librosa
 import yaml
 import time
+import csv
 import sys
 import os
 
+from tqdm import tqdm
+
+from array_storage import load_clip, clip_extensions, save_clip, io_meter
+from pack_shards import clip_order, load_index, index_columns
+
 ###############################################################################
 # DIRECTORIES
 ###############################################################################
@@ -24,12 +56,45 @@ new_dir = 'C:/Users/user/Documents/Datasets/AudioSet_meta_split_raw_array_norm'
 ###############################################################################
 # CONVERSION FUNCTION
 ###############################################################################
+def normalise_sample(data, length=160000):
+    """
+    Checks a data sample is usable and performs sample-wise normalisation, that
+        is; The sample ends up with a mean of ~0 and a std ~ 1. The stats are
+        only computed once and are returned so they can be recorded.
+
+    :param data: array
+        The raw audio signal
+    :param length: int
+        Number of samples every example should have, 10s at 16kHz by default
+
+    :return new_data: array
+        The normalised sample, None if the sample is not usable
+    :return mean: float
+        Mean of the raw sample
+    :return std: float
+        Standard deviation of the raw sample
+    :return reason: str
+        Why the sample is not usable, None if it is
+    """
+    mean = float(np.mean(data))
+    std = float(np.std(data))
+
+    # If any samples have unreasonable stats, we dont bother normalising
+    if std == 0.0:
+        return None, mean, std, 'std=0'
+    if data.shape[0] != length:
+        return None, mean, std, f'length {data.shape[0]} != {length:,}'
+
+    # Performs per-sample normaisation to mean 0 and std 1
+    new_data = (data - mean) / std
+    return new_data, mean, std, None
+
+
 def file_conversion(new_dir, current_path):
     """
     Function loads a path of a specific data example and performs sample-wise
         normalisation, that is; The sample ends up with a mean of ~0 and a std
-        ~ 1. This function assumes the current data samples are saved as .npy
-        files.
+        ~ 1. The current data samples can be in any format of array_storage.py.
 
     :param new_dir: str
         The path in which the new data sample should be saved
@@ -40,74 +105,297 @@ def file_conversion(new_dir, current_path):
         The newly per-sample normalised data is saved to the new directory
     """
     # Loads the current data sample being looked at
-    data = np.load(current_path)
+    data = load_clip(current_path)
 
     # If any samples have unreasonable stats, we dont bother saving and discard
     #   by simply returning without saving
-    if np.std(data) == 0.0:
-        print(f'File: {current_path} was not saved due to std=0')
-        return
-    if data.shape[0] != 160000:
-        print(f'File: {current_path} was not saved due to length {data.shape[0]} != 160,000')
+    new_data, _, _, reason = normalise_sample(data)
+    if new_data is None:
+        print(f'File: {current_path} was not saved due to {reason}')
         return
 
-    # Performs per-sample normaisation to mean 0 and std 1
-    new_data = ((data - np.mean(data)) / np.std(data))
-
-    file_name = current_path.split('\\')[-1]
+    file_name = os.path.splitext(current_path.split('\\')[-1])[0] + '.npy'
     new_path = os.path.join(new_dir, file_name)
     #print(new_path, np.mean(new_data), np.std(new_data))
 
     # Saves the newly normalised sample to new directory
-    np.save(new_path, data)
+    np.save(new_path, new_data)
+
+###############################################################################
+# BATCHED FUNCTIONS
+###############################################################################
+def normalise_block(block, out=None, inplace=False):
+    """
+    Per-sample normalisation of a whole block of clips at once, every row ends
+        up with a mean of ~0 and a std of ~1
+
+    :param block: array
+        [B, length] float32 raw clips
+    :param out: array
+        [B, length] float32 array the normalised clips are written to, i.e a
+            slice of a memory-mapped shard. A new array if None
+    :param inplace: Boolean
+        Whether to normalise 'block' itself, out is then ignored
+
+    :return out: array
+        The normalised clips, rows with a std of 0 are only mean-centred
+    :return mean: array
+        [B] mean of each raw clip
+    :return std: array
+        [B] standard deviation of each raw clip
+    """
+    mean = block.mean(axis=1)
+
+    if inplace:
+        out = block
+        np.subtract(block, mean[:, None], out=block)
+        # Sum of squares straight from the centred rows, np.std would need a full size temporary
+        std = np.sqrt(np.einsum('ij,ij->i', block, block) / block.shape[1]).astype(np.float32)
+    else:
+        std = block.std(axis=1)
+        out = np.subtract(block, mean[:, None], out=out)
+
+    np.divide(out, np.where(std > 0, std, 1)[:, None], out=out)
+    return out, mean, std
+
+
+def normalise_class(working_dir, new_working_dir, length=160000, block=256, inplace=False, buffers=None):
+    """
+    Normalises every clip of a per-clip class folder, a block at a time
+
+    :param working_dir: str
+        Class folder of raw clips, in any format of array_storage.py
+    :param new_working_dir: str
+        Class folder the normalised .npy clips are saved to
+    :param length: int
+        Number of samples every example should have
+    :param block: int
+        Number of clips normalised at a time
+    :param inplace: Boolean
+        Whether blocks are normalised in their own buffer
+    :param buffers: dict
+        Reused between classes so the block buffers are only allocated once
+
+    :return saved: int
+        Number of clips saved
+    :return rejected: int
+        Number of clips not saved
+    :return num_bytes: int
+        Number of bytes of clips read
+    """
+    if buffers is None:
+        buffers = {}
+    if 'in' not in buffers:
+        buffers['in'] = np.empty((block, length), dtype=np.float32)
+        buffers['out'] = None if inplace else np.empty((block, length), dtype=np.float32)
+
+    files = sorted([f for f in os.listdir(working_dir) if f.endswith(clip_extensions())], key=clip_order)
+    saved, rejected, num_bytes = 0, 0, 0
+
+    for i in range(0, len(files), block):
+        names = []
+        for file in files[i:i + block]:
+            current_path = os.path.join(working_dir, file)
+            data = load_clip(current_path)
+            num_bytes += os.path.getsize(current_path)
+
+            # Clips of the wrong length can't be stacked, so are turned away here
+            if data.shape[0] != length:
+                print(f'File: {current_path} was not saved due to length {data.shape[0]} != {length:,}')
+                rejected += 1
+                continue
+            buffers['in'][len(names)] = data
+            names.append(file)
+
+        n = len(names)
+        out = None if inplace else buffers['out'][:n]
+        new_data, _, std = normalise_block(buffers['in'][:n], out=out, inplace=inplace)
+
+        for row, file in enumerate(names):
+            # If any samples have unreasonable stats, we dont bother saving and discard
+            if std[row] == 0.0:
+                print(f'File: {os.path.join(working_dir, file)} was not saved due to std=0')
+                rejected += 1
+                continue
+            save_clip(os.path.join(new_working_dir, os.path.splitext(file)[0] + '.npy'), new_data[row])
+            saved += 1
+
+    return saved, rejected, num_bytes
+
+
+def normalise_shard(shard_path, new_path, scale=None, block=256, inplace=False):
+    """
+    Normalises a shard written by pack_shards.py a block of rows at a time,
+        writing each block straight into a memory-mapped output shard
+
+    :param shard_path: str
+        Path of the raw shard
+    :param new_path: str
+        Path the normalised float32 shard is saved to, the same as 'shard_path'
+            to normalise a float32 shard in place
+    :param scale: array
+        Per row dequantisation scale of an int16 shard, None for float32
+    :param block: int
+        Number of rows normalised at a time
+    :param inplace: Boolean
+        Whether blocks are normalised in their own buffer
+
+    :return silent: list
+        Rows with a std of 0, which are left as silence
+    :return num_bytes: int
+        Number of bytes of the shard read
+    """
+    same = os.path.abspath(shard_path) == os.path.abspath(new_path)
+    source = np.load(shard_path, mmap_mode='r+' if same else 'r')
+    num_rows, length = source.shape
+
+    if same:
+        if source.dtype != np.float32:
+            raise ValueError(f'Only float32 shards can be normalised in place, {shard_path} is {source.dtype}')
+        dest = source
+    else:
+        temp_path = new_path + '.tmp.npy'
+        dest = np.lib.format.open_memmap(temp_path, mode='w+', dtype=np.float32, shape=(num_rows, length))
+        buffer = np.empty((min(block, num_rows), length), dtype=np.float32)
+
+    silent = []
+    for i in range(0, num_rows, block):
+        rows = slice(i, min(i + block, num_rows))
+
+        if same:
+            # The memory-mapped rows are the buffer
+            _, _, std = normalise_block(dest[rows], inplace=True)
+        else:
+            data = buffer[:rows.stop - rows.start]
+            if scale is not None:
+                np.multiply(source[rows], scale[rows, None], out=data)
+            else:
+                data[:] = source[rows]
+            if inplace:
+                _, _, std = normalise_block(data, inplace=True)
+                dest[rows] = data
+            else:
+                _, _, std = normalise_block(data, out=dest[rows])
+
+        silent.extend(i + np.flatnonzero(std == 0))
+
+    dest.flush()
+    del dest, source
+    if not same:
+        os.replace(temp_path, new_path)
+
+    return silent, os.path.getsize(shard_path)
+
+
+def main_shards(old_dir, new_dir, block=256, inplace=False):
+    """
+    Normalises every shard listed in the index of the old directory
+
+    :param old_dir: str
+        Directory of shards written by pack_shards.py
+    :param new_dir: str
+        Directory the normalised shards and their index are written to
+
+    :return saved: int
+        Number of clips normalised
+    :return rejected: int
+        Number of clips left as silence
+    :return num_bytes: int
+        Number of bytes of shards read
+    """
+    index = load_index(os.path.join(old_dir, 'index.csv'))
+    saved, rejected, num_bytes = 0, 0, 0
+
+    for split, seen_class in tqdm(sorted(index)):
+        os.makedirs(os.path.join(new_dir, split), exist_ok=True)
+        rows = index[(split, seen_class)]
+        scale = None
+        if rows and rows[0]['scale'] != '':
+            scale = np.array([float(r['scale']) for r in rows], dtype=np.float32)
+
+        silent, shard_bytes = normalise_shard(os.path.join(old_dir, split, seen_class + '.npy'),
+                                                os.path.join(new_dir, split, seen_class + '.npy'),
+                                                scale, block, inplace)
+        for row in silent:
+            print(f"Clip: {rows[row]['file']} of {split}/{seen_class} left as silence due to std=0")
+        saved += len(rows) - len(silent)
+        rejected += len(silent)
+        num_bytes += shard_bytes
+
+    # Normalised shards are always float32, so nothing needs dequantising any more
+    temp_path = os.path.join(new_dir, 'index.csv.tmp')
+    with open(temp_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=index_columns)
+        writer.writeheader()
+        for key in sorted(index):
+            writer.writerows(dict(r, scale='') for r in index[key])
+    os.replace(temp_path, os.path.join(new_dir, 'index.csv'))
+
+    return saved, rejected, num_bytes
 
 ###############################################################################
 # MAIN FUNCTION
 ###############################################################################
-def main(old_dir, new_dir):
+def main(old_dir, new_dir, length=160000, block=256, inplace=False):
     """
     Iterates thorugh the folder structure of old directory and mirrors it in the
         new dir folder with per-sample normalised data.
 
     :param old_dir: str
         The base directory path which we wish to mirror. Contains our current
-            raw and un-normalised data
+            raw and un-normalised data, either per-clip or packed into shards
     :param new_dir: str
         Path to the new directory in which we want out normalised data
+    :param length: int
+        Number of samples every example should have
+    :param block: int
+        Number of clips normalised at a time
+    :param inplace: Boolean
+        Whether blocks are normalised in their own buffer, halving peak memory
     """
-    #sets working dir as array parent folder
-    os.chdir(new_dir)
-
-    splits = os.listdir(old_dir)
-    for split in splits:
-        print('\n')
-        print(split)
-
-        temp = os.path.join(old_dir, split)
-        temp_new = os.path.join(new_dir, split)
-
-        try:
-            os.mkdir(temp_new)
-        except Exception:
-            print(f'Already Created: {temp_new}')
+    start_time = time.time()
+    os.makedirs(new_dir, exist_ok=True)
 
-        contained_classes = os.listdir(temp)
+    if os.path.isfile(os.path.join(old_dir, 'index.csv')):
+        saved, rejected, num_bytes = main_shards(old_dir, new_dir, block, inplace)
+    else:
+        jobs = []
+        for split in sorted(os.listdir(old_dir)):
+            temp = os.path.join(old_dir, split)
+            if not os.path.isdir(temp):
+                continue
+            for seen_class in sorted(os.listdir(temp)):
+                working_dir = os.path.join(temp, seen_class)
+                if os.path.isdir(working_dir):
+                    jobs.append((working_dir, os.path.join(new_dir, split, seen_class)))
 
-        for seen_class in contained_classes:
-            working_dir = os.path.join(temp, seen_class)
-            new_working_dir = os.path.join(temp_new, seen_class)
+        saved, rejected, num_bytes = 0, 0, 0
+        # Block buffers are shared by every class
+        buffers = {}
+        for working_dir, new_working_dir in tqdm(jobs):
+            os.makedirs(new_working_dir, exist_ok=True)
+            class_saved, class_rejected, class_bytes = normalise_class(working_dir, new_working_dir, length,
+                                                                        block, inplace, buffers)
+            saved += class_saved
+            rejected += class_rejected
+            num_bytes += class_bytes
 
-            try:
-                os.mkdir(new_working_dir)
-            except Exception:
-                print(f'Already Created: {new_working_dir}')
+        # How much reading the storage format of the clips saved
+        io_meter.report()
 
-            for file in os.listdir(working_dir):
-                if file.endswith('.npy'):
-                    file_path = os.path.join(working_dir, file)
+    run_time = max(time.time() - start_time, 1e-9)
+    print(f'Normalised {saved} clips, {rejected} rejected in {run_time:.1f}s '
+            f'({saved / run_time:.1f} clips/s, {num_bytes / run_time / 1e6:.1f} MB/s read)')
 
-                    file_conversion(new_working_dir, file_path)
 
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-sample normalises a .npy dataset or its packed shards')
+    parser.add_argument('old_dir', nargs='?', default=old_dir, help='Base directory of the raw dataset or shards')
+    parser.add_argument('new_dir', nargs='?', default=new_dir, help='Directory the normalised dataset is written to')
+    parser.add_argument('--length', type=int, default=160000, help='Samples every clip should have')
+    parser.add_argument('--block', type=int, default=256, help='Clips normalised at a time')
+    parser.add_argument('--inplace', action='store_true', help='Normalise blocks in place to halve peak memory')
+    args = parser.parse_args()
 
-main(old_dir, new_dir)
+    main(args.old_dir, args.new_dir, args.length, args.block, args.inplace)
@@ -5,75 +5,376 @@ Script deals with dataset wide conversion from .wav files to .npy files. The
     like the one to spectrograms, to be done much more quickly.
 The main function iterates over the so called 'old_dir'and creates  a mirror
     directory in 'new_dir'.
-The script assumes that the 'new_dir' directory has already been created.
+
+Files are converted in parallel by a pool of processes, with the file list
+    handed out in chunks so that the per task overhead stays small. Outputs are
+    written to a temporary file and renamed into place, so a killed run never
+    leaves a half written array behind. Any output that is newer than its
+    source .wav, and was converted with the same options, is taken as already
+    converted and skipped, meaning a re-run only does the work that is missing.
+
+Clips downloaded at the wanted samplerate are read directly with soundfile,
+    only those that need resampling or downmixing go through librosa.
+
+With '--normalise' each file is also validated and per-sample normalised before
+    it is saved, the same as raw_data_normalisation.py does, so the dataset
+    only has to be decoded and written once. Samples with a std of 0 or the
+    wrong length are not saved.
+
+'--storage' picks how the arrays are saved, see array_storage.py. The 'int16'
+    and 'compressed' formats keep the 16 bit PCM of the .wav files rather than
+    float32, so are 2-4x smaller. Converting to another format replaces the
+    outputs of the old one, so no clip is left in the dataset twice.
+    Normalised values cannot be stored as PCM, so with these formats
+    '--normalise' only validates the samples and the normalisation is instead
+    done on load by 'load_clip(path, normalise=True)'. This is recorded in
+    'storage.json' in 'new_dir', which pack_shards.py, feature_cache.py and
+    episode_sampler.py all follow.
+
+Either way the mean, std and length of every raw sample are written to
+    'stats.csv' in 'new_dir', so later jobs can renormalise or filter examples
+    without loading the audio again. Rows of files skipped as up to date are
+    kept from the previous run. Each row also records the options the file was
+    converted with, files with no row or other options are converted again.
+    Files rejected with the same options are not decoded again, and anything
+    an earlier run saved for them is removed when they are rejected.
+
+USAGE:
+    python wav_to_numpy.py old_dir new_dir [--sr 16000] [--workers 4]
+                                            [--chunksize 16] [--force]
+                                            [--normalise] [--length 160000]
+                                            [--storage float32]
 """
 
 ###############################################################################
 # IMPORTS
 ###############################################################################
 import numpy as np
+import soundfile as sf
+import argparse
 import librosa
 import time
+import csv
 import os
 
-###############################################################################
-# DIRECTORIES
-###############################################################################
-old_dir = 'X:/Datasets/AudioSet/AudioSet_meta_split_raw_wav'
-new_dir = 'X:/Datasets/AudioSet/AudioSet_meta_split_raw_array'
+from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
+
+from raw_data_normalisation import normalise_sample
+from array_storage import storage_formats, clip_extensions, clip_path, save_clip, save_storage_info
+
+# Columns of the per-sample stats table
+stats_columns = ['file', 'mean', 'std', 'length', 'saved', 'params']
 
 ###############################################################################
 # CONVERSION FUNCTION
 ###############################################################################
-def file_conversion(new_dir, current_path, sr):
-    data, sr = librosa.load(current_path, sr=sr, mono=True)
+def is_up_to_date(current_path, new_path):
+    """
+    Checks whether a file has already been converted since the .wav was last
+        changed. Outputs are only ever renamed into place once complete so the
+        modification time alone is enough to trust them.
+
+    :param current_path: str
+        Path of the source .wav file
+    :param new_path: str
+        Path of the .npy file it is converted to
+
+    :return up_to_date: Boolean
+        True if the conversion can be skipped
+    """
+    try:
+        return os.path.getmtime(new_path) >= os.path.getmtime(current_path)
+    except OSError:
+        return False
+
+
+def conversion_params(sr, normalise, length, storage):
+    """
+    :param sr: int
+        Samplerate converted at
+    :param normalise: Boolean
+        Whether samples are validated and normalised
+    :param length: int
+        Number of samples every example should have when normalising
+    :param storage: str
+        Format the arrays are saved in, 'float32' and 'int16' both being .npy
+
+    :return params: str
+        The options that change what is saved, as kept in the stats table
+    """
+    params = f'sr={sr} normalise={int(normalise)} storage={storage}'
+    if normalise:
+        params += f' length={length}'
+    return params
+
+
+def remove_outputs(new_path, keep=None):
+    """
+    Removes the outputs of a file in every storage format but the one kept
+
+    :param new_path: str
+        Path of the output in any of the storage formats
+    :param keep: str
+        Path of the output to leave in place, None to remove every one
+    """
+    base = os.path.splitext(new_path)[0]
+    for extension in clip_extensions():
+        path = base + extension
+        if path != keep and os.path.exists(path):
+            os.remove(path)
+
+
+def load_audio(current_path, sr):
+    """
+    Loads a .wav file as mono float32 at the given samplerate
+
+    :param current_path: str
+        Path of the .wav file
+    :param sr: int
+        Samplerate wanted
+
+    :return data: array
+        The audio signal
+    """
+    info = sf.info(current_path)
+    # Already in the right form, so a plain read gives the same as librosa would
+    if info.samplerate == sr and info.channels == 1:
+        data, _ = sf.read(current_path, dtype='float32')
+        return data
+
+    data, _ = librosa.load(current_path, sr=sr, mono=True)
+    return data
+
 
-    file_name = current_path.split('\\')[-1]
-    new_path = os.path.join(new_dir, file_name)
-    print(new_path)
+def file_conversion(job):
+    """
+    Converts a single .wav file to .npy, called by the worker processes
 
-    np.save(new_path, data)
+    :param job: tuple
+        (current_path, new_path, sr, normalise, length, storage) of the source
+            .wav, the output array, the samplerate to convert at, whether to
+            normalise, the length every sample should have if so and the
+            storage format
+
+    :return converted: int
+        Number of bytes of .wav read, 0 if the file failed to convert
+    :return stats: list
+        Mean, std, length and whether the file was saved, None if it could not
+            be read
+
+    :save data: array
+        The audio signal as a .npy or .npz file at new_path
+    """
+    current_path, new_path, sr, normalise, length, storage = job
+
+    try:
+        data = load_audio(current_path, sr)
+    except Exception as e:
+        print(f'File: {current_path} could not be converted: {e}')
+        return 0, None
+
+    # Stats come from the raw signal so later jobs can still undo or redo normalisation
+    new_data, mean, std, reason = normalise_sample(data, length)
+    stats = [mean, std, data.shape[0], 1]
+
+    if normalise:
+        if new_data is None:
+            stats[3] = 0
+            # Whatever an earlier run saved for it is no longer part of the dataset
+            remove_outputs(new_path)
+            return os.path.getsize(current_path), stats
+        # PCM cant hold the normalised values, these are normalised on load instead
+        if storage == 'float32':
+            data = new_data.astype(np.float32)
+
+    # Saved to a temporary file first and then renamed over the real one
+    save_clip(new_path, data, storage)
+    # A copy saved before in another format would otherwise be read as a second clip
+    remove_outputs(new_path, keep=new_path)
+
+    return os.path.getsize(current_path), stats
+
+
+def load_stats(stats_path):
+    """
+    Reads the stats table written by a previous run
+
+    :param stats_path: str
+        Path of the stats csv
+
+    :return stats: dict
+        File path relative to 'new_dir' -> row of the table
+    """
+    if not os.path.isfile(stats_path):
+        return {}
+    with open(stats_path, newline='') as f:
+        return {row[0]: row for row in csv.reader(f) if row and row[0] != 'file'}
+
+
+def save_stats(stats_path, stats):
+    """
+    Writes the stats table, through a temporary file like the arrays
+
+    :param stats_path: str
+        Path of the stats csv
+    :param stats: dict
+        File path relative to 'new_dir' -> row of the table
+    """
+    temp_path = stats_path + '.tmp'
+    with open(temp_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(stats_columns)
+        writer.writerows(stats[key] for key in sorted(stats))
+    os.replace(temp_path, stats_path)
 
 ###############################################################################
 # MAIN FUNCTION
 ###############################################################################
-def main(old_dir, new_dir):
-    #sets working dir as array parent folder
-    os.chdir(new_dir)
-
-    splits = os.listdir(old_dir)
-    for split in splits:
-        print(split)
-        print('\n')
-        if split == 'Other':
+def collect_jobs(old_dir, new_dir, sr, force=False, normalise=False, length=160000, storage='float32', stats=None):
+    """
+    Walks the split/class folder structure of the old directory, creating the
+        mirrored folders in the new directory and listing the files to convert
+
+    :param old_dir: str
+        The base directory path of the .wav dataset
+    :param new_dir: str
+        Path of the directory the .npy dataset is written to
+    :param sr: int
+        Samplerate to convert at
+    :param force: Boolean
+        Whether to convert files even if their output is up to date
+    :param normalise: Boolean
+        Whether samples are validated and normalised before saving
+    :param length: int
+        Number of samples every example should have when normalising
+    :param storage: str
+        Format the arrays are saved in, one of 'float32', 'int16' or 'compressed'
+    :param stats: dict
+        Stats table of the previous run as given by 'load_stats', files only
+            count as up to date if they were converted with the same options
+
+    :return jobs: list
+        Job tuple, as taken by 'file_conversion', for every file that needs
+            converting
+    :return skipped: int
+        Number of files already up to date
+    """
+    jobs, skipped = [], 0
+    stats = stats or {}
+    params = conversion_params(sr, normalise, length, storage)
+    stats_path = os.path.join(new_dir, 'stats.csv')
+
+    for split in sorted(os.listdir(old_dir)):
+        temp = os.path.join(old_dir, split)
+        if split == 'Other' or not os.path.isdir(temp):
             continue
 
-        else:
-            temp = os.path.join(old_dir, split)
-            temp_new = os.path.join(new_dir, split)
+        for seen_class in sorted(os.listdir(temp)):
+            working_dir = os.path.join(temp, seen_class)
+            if not os.path.isdir(working_dir):
+                continue
+            new_working_dir = os.path.join(new_dir, split, seen_class)
+            os.makedirs(new_working_dir, exist_ok=True)
+
+            for file in sorted(os.listdir(working_dir)):
+                if not file.endswith('.wav'):
+                    continue
+                file_path = os.path.join(working_dir, file)
+                # Keeps the original naming of '<n>.wav.npy', or '.npz' if compressed
+                new_path = clip_path(os.path.join(new_working_dir, file), storage)
+
+                # Outputs of a run with other options are out of date however new they are
+                key = os.path.relpath(new_path, new_dir).replace(os.sep, '/')
+                row = stats.get(key, [])
+                # Rejected files have no output, the stats table is as new as the rejection
+                output_path = stats_path if row[4:5] == ['0'] else new_path
+                if not force and row[5:] == [params] and is_up_to_date(file_path, output_path):
+                    skipped += 1
+                else:
+                    jobs.append((file_path, new_path, sr, normalise, length, storage))
+
+    return jobs, skipped
+
+
+def main(old_dir, new_dir, sr=16000, workers=None, chunksize=16, force=False, normalise=False,
+            length=160000, storage='float32'):
+    """
+    Converts every .wav file under the old directory to .npy in a mirrored
+        folder structure under the new directory
+
+    :param old_dir: str
+        The base directory path of the .wav dataset
+    :param new_dir: str
+        Path of the directory the .npy dataset is written to, created if needed
+    :param sr: int
+        Samplerate to convert at
+    :param workers: int
+        Number of worker processes, None uses one per CPU
+    :param chunksize: int
+        Number of files handed to a worker at a time
+    :param force: Boolean
+        Whether to convert files even if their output is up to date
+    :param normalise: Boolean
+        Whether samples are validated and normalised in the same pass
+    :param length: int
+        Number of samples every example should have when normalising
+    :param storage: str
+        Format the arrays are saved in, one of 'float32', 'int16' or 'compressed'
+
+    :save stats: csv
+        'stats.csv' in the new directory with the raw stats of every sample
+    :save info: json
+        'storage.json' in the new directory, whether clips are normalised on load
+    """
+    start_time = time.time()
+    stats_path = os.path.join(new_dir, 'stats.csv')
+    stats = load_stats(stats_path)
 
-            try:
-                os.mkdir(temp_new)
-            except Exception:
-                print(f'Already Created: {temp_new}')
+    jobs, skipped = collect_jobs(old_dir, new_dir, sr, force, normalise, length, storage, stats)
+    print(f'{len(jobs)} files to convert, {skipped} already up to date')
+    params = conversion_params(sr, normalise, length, storage)
 
-            contained_classes = os.listdir(temp)
+    converted, rejected, failed, num_bytes = 0, 0, 0, 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(file_conversion, jobs, chunksize=chunksize)
+        for job, (file_bytes, file_stats) in zip(jobs, tqdm(results, total=len(jobs))):
+            if file_stats is not None:
+                key = os.path.relpath(job[1], new_dir).replace(os.sep, '/')
+                for extension in clip_extensions():
+                    stats.pop(os.path.splitext(key)[0] + extension, None)
+                stats[key] = [key] + file_stats + [params]
 
-            for seen_class in contained_classes:
-                working_dir = os.path.join(temp, seen_class)
-                new_working_dir = os.path.join(temp_new, seen_class)
+            if file_stats is None:
+                failed += 1
+            elif file_stats[3] == 0:
+                rejected += 1
+            else:
+                converted += 1
+            num_bytes += file_bytes
 
-                try:
-                    os.mkdir(new_working_dir)
-                except Exception:
-                    print(f'Already Created: {new_working_dir}')
+    save_stats(stats_path, stats)
+    # PCM cant hold normalised values, so readers are told to normalise on load
+    save_storage_info(new_dir, storage, normalise and storage != 'float32')
 
-                for file in os.listdir(working_dir):
-                    if file.endswith('.wav'):
-                        file_path = os.path.join(working_dir, file)
+    run_time = max(time.time() - start_time, 1e-9)
+    print(f'Converted {converted} files, {rejected} rejected, {failed} failed, {skipped} skipped in {run_time:.1f}s '
+            f'({converted / run_time:.1f} files/s, {num_bytes / run_time / 1e6:.1f} MB/s of .wav read)')
 
-                        file_conversion(new_working_dir, file_path, 16000)
 
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Converts a split .wav dataset to .npy arrays')
+    parser.add_argument('old_dir', help='Base directory of the .wav dataset')
+    parser.add_argument('new_dir', help='Directory the mirrored .npy dataset is written to')
+    parser.add_argument('--sr', type=int, default=16000, help='Samplerate to convert at')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes')
+    parser.add_argument('--chunksize', type=int, default=16, help='Files handed to a worker at a time')
+    parser.add_argument('--force', action='store_true', help='Convert files even if already up to date')
+    parser.add_argument('--normalise', action='store_true', help='Validate and normalise samples in the same pass')
+    parser.add_argument('--length', type=int, default=160000, help='Samples every example should have when normalising')
+    parser.add_argument('--storage', default='float32', choices=list(storage_formats), help='Format the arrays are saved in')
+    args = parser.parse_args()
 
-main(old_dir, new_dir)
+    main(args.old_dir, args.new_dir, args.sr, args.workers, args.chunksize, args.force, args.normalise,
+            args.length, args.storage)
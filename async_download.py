@@ -0,0 +1,544 @@
+"""
+Asyncio version of the download loop, which overlaps the network and CPU stages
+    of different candidates rather than running them one after the other. Each
+    candidate passes through three stages:
+    - Fetch :   Up to 'workers' candidates are probed and downloaded at once,
+        each in a thread as the fetchers block
+    - Clean :   Raw downloads are handed through a bounded queue to 'cpu_workers'
+        cleaners, which trim and resample them with 'file_cleaning' in a
+        process pool
+    - Commit :  The event loop alone moves finished clips into their class
+        folder and writes the logs, the same as the main thread of
+        parallel_download.py
+
+The queue between fetching and cleaning gives backpressure. When the cleaners
+    fall behind the queue fills up and fetches that have finished hold on to
+    their slot until there is room, so no more fetches start and raw downloads
+    never pile up in the scratch folder. When fetching falls behind the cleaners
+    just wait on the queue. Either way whichever stage is slower is kept busy.
+
+Candidates are drawn in the same seeded order as the other loops and committed
+    strictly in that order, so the final set of YIDs for a class is the same as
+    from 'main_download' or 'main_download_parallel'. Transient failures are
+    retried after their backoff without holding a fetch slot.
+
+REQUIRES:
+    - Same as parallel_download.py
+
+OUTPUTS:
+    - Same folders and class logs as download_functions.py
+"""
+
+###############################################################################
+#IMPORTS
+###############################################################################
+import os
+import time
+import shutil
+import asyncio
+import pandas as pd
+from tqdm import tqdm, trange
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from download_functions import YoutubeFetcher
+from download_functions import create_directories, load_probe_cache, store_probe, class_candidates
+from download_log import ClassLog
+from download_planner import ClipManifest, plan_overlap
+from download_scheduler import FetchScheduler
+from download_metrics import PipelineMetrics
+from download_budget import is_disk_full
+from parallel_download import fetch_raw, clean_raw
+
+
+###############################################################################
+#FUNCTIONS
+###############################################################################
+def fetch_job(fetcher, scheduler, yid, start, end, scratch_dir, length=None):
+    """
+    Runs in a fetch thread, waits for the scheduler to allow the request then
+        fetches the candidate with 'fetch_raw'
+    """
+    scheduler.wait()
+    return fetch_raw(fetcher, yid, start, end, scratch_dir, length)
+
+
+###############################################################################
+#ORCHESTRATOR
+###############################################################################
+class AsyncDownloader(object):
+    """
+    Runs the fetch, clean and commit stages of a download run on one event loop,
+        see 'main_download_async' for the parameters
+    """
+    def __init__(self, defaultdir, samples_per_class, labels, textlabels, big_data, seed, fetcher, scheduler,
+                    metrics, workers, cpu_workers, queue_size, scratch_dir, probe_cache_path, manifest, ledger,
+                    sample_rate, ordering='permutation', prefer_known=False, budget=None):
+        self.defaultdir = defaultdir
+        self.data_dir = os.path.join(defaultdir, 'AudioSet_Data')
+        self.samples_per_class = samples_per_class
+        self.labels = labels
+        self.textlabels = textlabels
+        self.big_data = big_data
+        self.seed = seed
+        self.fetcher = fetcher
+        self.scheduler = scheduler
+        self.metrics = metrics
+        self.workers = workers
+        self.cpu_workers = cpu_workers
+        self.queue_size = queue_size
+        self.scratch_dir = scratch_dir
+        self.probe_cache_path = probe_cache_path
+        self.probe_cache = load_probe_cache(probe_cache_path)
+        self.manifest = manifest
+        self.ledger = ledger
+        self.sample_rate = sample_rate
+        self.ordering = ordering
+        self.budget = budget
+        # Set once the disk or budget has no room for another clip, the rest of the run is left
+        self.out_of_space = False
+        # Videos probed or downloaded in earlier runs are tried first, if asked for
+        self.history = {}
+        if prefer_known:
+            self.history = {'lengths': self.probe_cache,
+                            'prefer': [self.probe_cache, manifest.entries if manifest is not None else {}]}
+        self.fetch_counts = {'segment': 0, 'fallback': 0}
+
+        self.fetch_pool = ThreadPoolExecutor(max_workers=workers)
+        self.clean_pool = ProcessPoolExecutor(max_workers=cpu_workers)
+
+    async def candidate(self, yid, start, end):
+        """
+        Fetches and cleans a single candidate, retrying transient failures
+
+        :return result: dict
+            Same as 'fetch_candidate' in parallel_download.py
+        """
+        loop = asyncio.get_event_loop()
+        work_dir = os.path.join(self.scratch_dir, yid)
+        attempts = 0
+        while True:
+            cleaned = None
+            async with self.fetch_slots:
+                fetching = loop.run_in_executor(self.fetch_pool, fetch_job, self.fetcher, self.scheduler, yid, start,
+                                                end, self.scratch_dir, self.probe_cache.get(yid))
+                try:
+                    result = await asyncio.shield(fetching)
+                except asyncio.CancelledError:
+                    # The fetch thread cant be stopped, whatever it downloads is cleared away once it finishes
+                    fetching.add_done_callback(lambda _: shutil.rmtree(work_dir, ignore_errors=True))
+                    raise
+                except Exception:
+                    result = {'path': None, 'raw': None, 'method': None, 'length': None, 'bytes': 0,
+                                'failure': 'other', 'timings': {}}
+                store_probe(self.probe_cache_path, self.probe_cache, yid, result['length'])
+                self.metrics.add_timings(result['timings'])
+                self.metrics.count('bytes_fetched', result['bytes'])
+
+                if result['raw'] is not None:
+                    # The slot is held until a cleaner has room, this is what holds back the fetches
+                    cleaned = loop.create_future()
+                    try:
+                        await self.clean_queue.put((result, yid, cleaned))
+                    except asyncio.CancelledError:
+                        shutil.rmtree(work_dir, ignore_errors=True)
+                        raise
+
+            # If cancelled while waiting here the cleaner sees it and clears the download away
+            if cleaned is not None:
+                result = await cleaned
+
+            # Out of space is not the candidate's fault, it is neither retried nor counted as failed
+            if result['failure'] == 'disk_full':
+                return result
+
+            # Transient failures are tried again later without holding a fetch slot
+            retry_after = self.scheduler.record(yid, result['failure'])
+            if retry_after is None or attempts >= self.scheduler.max_retries:
+                return result
+            attempts += 1
+            # Throttling pauses the scheduler itself, so the retry only has to wait for that
+            if result['failure'] != 'throttled':
+                await asyncio.sleep(retry_after)
+
+    async def cleaner(self):
+        """
+        Takes raw downloads off the queue and cleans them in the process pool,
+            runs until cancelled
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            result, yid, cleaned = await self.clean_queue.get()
+            if not cleaned.cancelled():
+                try:
+                    result = await loop.run_in_executor(self.clean_pool, clean_raw, result, yid, self.defaultdir,
+                                                        self.sample_rate)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    shutil.rmtree(os.path.dirname(result['raw']), ignore_errors=True)
+                    result = dict(result, failure='disk_full' if is_disk_full(e) else 'other')
+            # The candidate is no longer wanted
+            if cleaned.cancelled():
+                shutil.rmtree(os.path.dirname(result['raw']), ignore_errors=True)
+                continue
+            # Probe and fetch were already added when the fetch finished
+            self.metrics.add_timings({stage: seconds for stage, seconds in result['timings'].items()
+                                        if stage in ['transcode', 'write']})
+            cleaned.set_result(result)
+
+    async def download_class(self, i):
+        """
+        Downloads one class, committing clips strictly in candidate order
+
+        :param i: int
+            Index of the class in 'labels'
+
+        :return downloaded: int
+            Clips added to the class by this run
+        :return failed: int
+            Candidates which failed
+        """
+        mid, name = self.labels[i], self.textlabels[i]
+        class_dir = os.path.join(self.data_dir, name)
+        manifest, ledger, metrics, budget = self.manifest, self.ledger, self.metrics, self.budget
+
+        # Opens the log of files that have been downloaded, created if new
+        class_log = ClassLog(os.path.join(class_dir, name + '.csv'))
+        files_downloaded, num_failed = len(class_log), 0
+
+        # Same seeded order of the candidates not yet downloaded as the other loops
+        available, candidates = class_candidates(self.big_data, mid, name, class_log.yids, self.seed, ledger,
+                                                    self.ordering, **self.history)
+
+        to_get = min(self.samples_per_class, available)
+        if files_downloaded >= to_get:
+            class_log.close()
+            return 0, 0
+        already_had = files_downloaded
+
+        # rank -> (yid, start, task) for running candidates, rank -> (result, yid, start) for finished ones
+        jobs, finished = {}, {}
+        # rank -> scratch space held by the job
+        held = {}
+        next_submit, next_commit = 0, 0
+        exhausted = False
+        # Enough candidates on the go to fill every fetch slot, the queue and every cleaner
+        window = self.workers + self.queue_size + self.cpu_workers
+
+        class_start = time.time()
+        class_bar = tqdm(total=to_get, initial=files_downloaded, desc=str(name), leave=False)
+
+        while files_downloaded < to_get:
+            # Keeps the pipeline full, but never asks for more than could still be needed
+            ok_waiting = sum(1 for r, _, _ in finished.values() if r['path'] or r.get('entry'))
+            if budget is not None:
+                # With no room for another clip, whatever is out is let finish then the run stops
+                if budget.update(ok_waiting + len(jobs), self.fetcher, tqdm.write) == 'full' and not jobs:
+                    self.out_of_space = True
+                    break
+            # Fewer jobs go out when the disk, budget or scratch space runs short
+            while (not exhausted and not self.out_of_space and len(jobs) < window and
+                    (budget is None or budget.can_fetch(len(jobs))) and
+                    files_downloaded + ok_waiting + len(jobs) < to_get):
+                try:
+                    yid, start, end = next(candidates)
+                except StopIteration:
+                    exhausted = True
+                    break
+
+                # Clips already downloaded for another class skip the pipeline entirely
+                entry = manifest.find(yid, start) if manifest is not None else None
+                if entry is not None:
+                    finished[next_submit] = ({'path': None, 'entry': entry, 'end': end}, yid, start)
+                # Known dead YIDs fail straight away without a request
+                elif self.scheduler.is_dead(yid):
+                    finished[next_submit] = ({'path': None, 'failure': 'dead'}, yid, start)
+                else:
+                    if ledger is not None:
+                        ledger.mark(mid, yid, 'in-flight')
+                    if budget is not None:
+                        held[next_submit] = budget.hold_scratch()
+                    jobs[next_submit] = (yid, start, asyncio.ensure_future(self.candidate(yid, start, end)))
+                next_submit += 1
+
+            if jobs:
+                done, _ = await asyncio.wait([task for _, _, task in jobs.values()],
+                                                return_when=asyncio.FIRST_COMPLETED)
+                for rank in [r for r, (_, _, task) in jobs.items() if task in done]:
+                    yid, start, task = jobs.pop(rank)
+                    result = task.result()
+                    if budget is not None:
+                        budget.release_scratch(held.pop(rank, 0))
+                        budget.add_raw(result.get('bytes', 0))
+                    # No room to clean it, the candidate is left for a run with more space
+                    if result['failure'] == 'disk_full':
+                        if ledger is not None:
+                            ledger.mark(mid, yid, 'pending')
+                        self.out_of_space = True
+                        continue
+                    finished[rank] = (result, yid, start)
+                    if result['method'] is not None:
+                        self.fetch_counts[result['method']] = self.fetch_counts.get(result['method'], 0) + 1
+            elif next_commit == next_submit:
+                break
+
+            # Commits finished results strictly in candidate order
+            while next_commit in finished:
+                result, yid, start = finished.pop(next_commit)
+                path, entry = result['path'], result.get('entry')
+                next_commit += 1
+
+                if path is None and entry is None:
+                    num_failed += 1
+                    metrics.fail(result['failure'])
+                    if ledger is not None:
+                        ledger.mark(mid, yid, 'failed', result['failure'])
+                    continue
+
+                if files_downloaded >= to_get:
+                    if path is not None:
+                        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+                    continue
+
+                write_start = time.monotonic()
+                if entry is not None:
+                    # Already downloaded for another class, linked in rather than fetched
+                    new_filename = '%s%s'%(files_downloaded + 1, os.path.splitext(entry['PATH'])[1])
+                    if not manifest.link(entry, os.path.join(class_dir, new_filename)):
+                        # Fetched instead like the single threaded loop, keeping its place in the order
+                        next_commit -= 1
+                        if ledger is not None:
+                            ledger.mark(mid, yid, 'in-flight')
+                        if budget is not None:
+                            held[next_commit] = budget.hold_scratch()
+                        jobs[next_commit] = (yid, start, asyncio.ensure_future(
+                                                self.candidate(yid, start, result['end'])))
+                        break
+                    og_file, sr = entry['OG FILE'], entry['SR']
+                else:
+                    new_filename = '%s%s'%(files_downloaded + 1, os.path.splitext(path)[1])
+                    clip_bytes = os.path.getsize(path)
+                    try:
+                        shutil.move(path, os.path.join(class_dir, new_filename))
+                    except Exception as e:
+                        if not is_disk_full(e):
+                            raise
+                        # Copying off a scratch disk can stop part way, nothing half written is kept
+                        if os.path.isfile(os.path.join(class_dir, new_filename)):
+                            os.remove(os.path.join(class_dir, new_filename))
+                        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+                        if ledger is not None:
+                            ledger.mark(mid, yid, 'pending')
+                        self.out_of_space = True
+                        break
+                    shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+                    metrics.count('bytes_written', clip_bytes)
+                    if budget is not None:
+                        budget.add_clip(clip_bytes)
+                    og_file, sr = result['og_file'], result['sr']
+                    if manifest is not None:
+                        manifest.add(yid, start, os.path.join(class_dir, new_filename), og_file, sr,
+                                        result['bytes'])
+                metrics.add('write', time.monotonic() - write_start)
+
+                files_downloaded += 1
+                with metrics.time('log'):
+                    class_log.append(yid, mid, name, new_filename, og_file, sr)
+                    if ledger is not None:
+                        ledger.mark(mid, yid, 'done', new_filename)
+                metrics.count('clips')
+
+                class_bar.update(1)
+                class_bar.set_postfix(failed=num_failed,
+                    rate=f'{(files_downloaded - already_had) / (time.time() - class_start):.2f} clips/s')
+
+            metrics.maybe_report(tqdm.write)
+
+            # Once out of space whatever is still going is let finish and committed before stopping
+            if self.out_of_space and not jobs:
+                break
+            if exhausted and not jobs and next_commit == next_submit:
+                break
+
+        # Anything still going is no longer needed, including any waiting to be retried
+        leftover = [task for _, _, task in jobs.values()]
+        for task in leftover:
+            task.cancel()
+        if leftover:
+            await asyncio.wait(leftover)
+        results = [task.result() for task in leftover if not task.cancelled()]
+        for result in results + [result for result, _, _ in finished.values()]:
+            if result['path'] is not None:
+                shutil.rmtree(os.path.dirname(result['path']), ignore_errors=True)
+        if budget is not None:
+            for rank in list(held):
+                budget.release_scratch(held.pop(rank))
+
+        class_log.close()
+        # Candidates fetched but not needed are left for a later run
+        if ledger is not None:
+            ledger.release(mid)
+        class_bar.close()
+        class_time = time.time() - class_start
+        tqdm.write(f'{files_downloaded} files downloaded for class {mid}, {num_failed} failed, '
+                    f'{class_time:.1f}s ({(files_downloaded - already_had) / max(class_time, 1e-9):.2f} clips/s)')
+        return files_downloaded - already_had, num_failed
+
+    async def run(self):
+        """
+        Downloads every class in turn, with the cleaners shared between them
+
+        :return downloaded: int
+            Clips added by this run
+        :return failed: int
+            Candidates which failed
+        """
+        # Made inside the loop as they belong to the loop running them
+        self.fetch_slots = asyncio.Semaphore(self.workers)
+        self.clean_queue = asyncio.Queue(maxsize=self.queue_size)
+        cleaners = [asyncio.ensure_future(self.cleaner()) for _ in range(self.cpu_workers)]
+
+        run_downloaded, run_failed = 0, 0
+        try:
+            for i in trange(len(self.labels)):
+                downloaded, failed = await self.download_class(i)
+                run_downloaded += downloaded
+                run_failed += failed
+                if self.out_of_space:
+                    tqdm.write(f'Stopped at class {self.labels[i]}, out of disk space or budget')
+                    break
+        finally:
+            for task in cleaners:
+                task.cancel()
+            await asyncio.wait(cleaners)
+        return run_downloaded, run_failed
+
+    def close(self):
+        self.fetch_pool.shutdown()
+        self.clean_pool.shutdown()
+
+
+###############################################################################
+#MAIN FUNCTION
+###############################################################################
+def main_download_async(defaultdir, samples_per_class, labels, textlabels, big_data, cookie_path, seed,
+                        workers, scratch_dir, cpu_workers=None, queue_size=None, segment_fetch=False,
+                        segment_margin=1, probe_cache_path=None, dedup=True, sample_rate=16000,
+                        scheduler=None, ledger=None, fetcher=None, metrics=None, ordering='permutation',
+                        prefer_known=False, budget=None):
+    """
+    Asyncio version of 'main_download'. Takes the same arguments plus the
+        pipeline setup.
+
+    :param samples_per_class: int
+        How many samples to attempt to download per class label given
+    :param labels: array
+         Class labels to be downloaded, this list is the MIDs
+    :param textlabels: array
+        Readable class labels to be downloaded, should line up with MIDs
+    :param big_data: MetaStore, FrameIndex or Dataframe
+        Includes all examples spanning all classes
+    :param cookie_path: str
+        Absolute path to the cookies file being used for downloading
+    :param seed: int
+        Random sampling seed for reproducibility
+    :param workers: int
+        Number of candidates fetched at once
+    :param scratch_dir: str
+        Directory used for in progress downloads
+    :param cpu_workers: int
+        Number of processes cleaning downloads, None for one per CPU
+    :param queue_size: int
+        Most raw downloads waiting to be cleaned, None for two per cleaner
+    :param segment_fetch: Boolean
+        Whether to only fetch the clip window with 'download_audio_segment'
+    :param segment_margin: float
+        Seconds of extra audio fetched either side of the clip window
+    :param probe_cache_path: str
+        Absolute path of the csv used to cache probed video durations, None
+            to always probe
+    :param dedup: Boolean
+        Whether clips already downloaded for another class are linked in from
+            the global manifest rather than downloaded again
+    :param sample_rate: int
+        Samplerate every clip is saved at, None keeps the original
+    :param scheduler: FetchScheduler
+        Rate limits requests, retries transient failures and skips known dead
+            YIDs, None to try every candidate once with no limit
+    :param ledger: JobLedger
+        Records the state of every candidate so a resumed run only looks at
+            pending ones, None to not keep one
+    :param fetcher: YoutubeFetcher or LocalFetcher
+        Backend the clips are fetched through, None for a 'YoutubeFetcher'
+            built from the arguments above
+    :param metrics: PipelineMetrics
+        Times each stage and counts bytes and failures, reporting as it goes,
+            None to only sum up the run at the end
+    :param ordering: str
+        Order candidates are tried in, 'permutation' or 'legacy' to reproduce
+            sets downloaded before, see 'sample_order'
+    :param prefer_known: Boolean
+        Whether videos already probed or downloaded are tried first, and clips
+            known not to fit in their video are left out
+    :param budget: DiskBudget
+        Holds back fetches when the scratch space is short and stops the run
+            cleanly before the dataset outgrows its budget or the disk, None to
+            carry on until a write fails
+
+    :save: Downloads, cleans and snips audio samples for each class given, up to
+        limit of num_samples or until examples of class run out
+    """
+    # Same directory layout as the single threaded version
+    expected_dir = defaultdir + '\\AudioSet_Data'
+    create_directories(textlabels, expected_dir)
+    data_dir = os.path.join(defaultdir, 'AudioSet_Data')
+
+    os.makedirs(scratch_dir, exist_ok=True)
+
+    if cpu_workers is None:
+        cpu_workers = os.cpu_count() or 1
+    if queue_size is None:
+        queue_size = 2 * cpu_workers
+    if fetcher is None:
+        fetcher = YoutubeFetcher(cookie_path, defaultdir, segment_fetch, segment_margin)
+    if scheduler is None:
+        scheduler = FetchScheduler(max_retries=0)
+    if metrics is None:
+        metrics = PipelineMetrics(interval=None)
+
+    # Global record of clips downloaded for any class, so each is fetched only once
+    manifest = None
+    if dedup:
+        manifest = ClipManifest(data_dir)
+        if not isinstance(big_data, pd.DataFrame):
+            plan_overlap(big_data, labels)
+
+    downloader = AsyncDownloader(defaultdir, samples_per_class, labels, textlabels, big_data, seed, fetcher,
+                                    scheduler, metrics, workers, cpu_workers, queue_size, scratch_dir,
+                                    probe_cache_path, manifest, ledger, sample_rate, ordering, prefer_known,
+                                    budget)
+
+    run_start = time.time()
+    # A loop of its own, which is closed again afterwards
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        run_downloaded, run_failed = loop.run_until_complete(downloader.run())
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+        downloader.close()
+
+    run_time = time.time() - run_start
+    print(f'Run complete: {run_downloaded} files across {len(labels)} classes, {run_failed} failed, '
+            f'{run_time:.1f}s ({run_downloaded / max(run_time, 1e-9):.2f} clips/s overall)')
+    if segment_fetch:
+        print(f"Segment fetches: {downloader.fetch_counts['segment']}, "
+                f"full download fallbacks: {downloader.fetch_counts['fallback']}")
+    if manifest is not None:
+        manifest.report()
+    print(f'Failures by kind: {scheduler.summary()}')
+    print(metrics.summary(whole_run=True))
+    metrics.export()
+    if budget is not None:
+        print(budget.summary())
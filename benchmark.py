@@ -0,0 +1,307 @@
+"""
+Offline benchmark of the download pipeline. Each configuration is a full run of
+    'main_download_parallel' against the 'local' fetcher backend, see
+    download_fetchers.py, so everything but YouTube itself is exercised:
+    scheduling, retries, cleaning with ffmpeg, dedup and the class logs.
+
+Synthetic meta-data is made up for the run, 'classes' classes each with enough
+    candidates to fill 'per_class' clips at the given failure rates. Every
+    configuration starts from an empty folder and the same seed, so runs only
+    differ by the configuration.
+
+For each configuration the following are measured and printed, as well as
+    appended to a csv:
+    - clips/s :     End to end clips saved per second
+    - CPU per clip : User and system time of the run, including ffmpeg and any
+        worker processes, per clip saved
+    - Disk I/O :    MB written to the dataset folder, plus the block reads and
+        writes counted by the OS where it counts them(not on Windows)
+    - Bound by :    Whether most of the stage time went on the network, CPU or
+        disk, see download_metrics.py
+
+A single worker in 'thread' mode is the same as the single threaded loop. In
+    'async' mode the workers are the concurrent fetches of async_download.py,
+    with one cleaning process per CPU.
+
+USAGE:
+    python benchmark.py fixture_dir [--classes 4] [--per-class 20]
+                                    [--workers 1 4] [--modes thread]
+                                    [--sample-rates 16000] [--latency 0.2]
+                                    [--failures unavailable=0.1 network=0.05]
+                                    [--out benchmark.csv]
+"""
+
+###############################################################################
+#IMPORTS
+###############################################################################
+import os
+import csv
+import time
+import shutil
+import argparse
+import tempfile
+import itertools
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, block I/O is then left out
+    resource = None
+
+from download_fetchers import LocalFetcher
+from download_scheduler import FetchScheduler
+from download_metrics import PipelineMetrics
+from parallel_download import main_download_parallel
+from async_download import main_download_async
+
+# Columns of the results csv
+result_columns = ['mode', 'workers', 'sample_rate', 'dedup', 'latency', 'clips', 'seconds', 'clips_per_s',
+                    'cpu_s', 'cpu_ms_per_clip', 'written_mb', 'block_read_mb', 'block_write_mb', 'bound_by']
+
+
+###############################################################################
+#FUNCTIONS
+###############################################################################
+def synthetic_meta(num_classes, per_class, seed=0):
+    """
+    Makes up meta-data in the layout of 'big_data.csv'
+
+    :param num_classes: int
+        Number of classes
+    :param per_class: int
+        Candidates per class
+    :param seed: int
+        Seed of the clip start times
+
+    :return labels: array
+        Made up class MIDs
+    :return textlabels: array
+        Made up readable class labels
+    :return big_data: dataframe
+        YID, start, end and MID of every candidate
+    """
+    rng = np.random.RandomState(seed)
+    labels = np.array([f'/m/bench{c}' for c in range(num_classes)])
+    textlabels = np.array([f'Bench_{c}' for c in range(num_classes)])
+
+    rows = []
+    for c, mid in enumerate(labels):
+        for n in range(per_class):
+            start = float(rng.randint(0, 30))
+            rows.append([f'bench{c:02d}{n:07d}', start, start + 10, mid])
+    big_data = pd.DataFrame(rows, columns=['YID', '1', '2', '3'])
+    return labels, textlabels, big_data
+
+
+def folder_size(path):
+    """
+    :return size: int
+        Total bytes of every file under path
+    """
+    total = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            total += os.path.getsize(os.path.join(root, f))
+    return total
+
+
+def cpu_time():
+    """
+    :return seconds: float
+        User and system time of this process and every child it has waited on
+    """
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def block_io():
+    """
+    :return read: float
+        MB read from disk by this process and its children, None if unknown
+    :return write: float
+        MB written to disk by this process and its children, None if unknown
+    """
+    if resource is None:
+        return None, None
+    usage = [resource.getrusage(who) for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]]
+    # Counted in 512 byte blocks
+    return (sum(u.ru_inblock for u in usage) * 512 / 1e6, sum(u.ru_oublock for u in usage) * 512 / 1e6)
+
+
+def run_config(work_dir, fetcher, meta, per_class, mode, workers, sample_rate, dedup, max_retries=3):
+    """
+    Runs the download pipeline once from an empty folder and measures it
+
+    :param work_dir: str
+        Folder the run is done in, emptied first
+    :param fetcher: LocalFetcher
+        Backend serving the fixture files
+    :param meta: tuple
+        (labels, textlabels, big_data) as given by 'synthetic_meta'
+    :param per_class: int
+        Clips to download per class
+    :param mode: str
+        Either 'thread' or 'process' based workers, or 'async' for the asyncio
+            pipeline
+    :param workers: int
+        Number of concurrent fetch workers
+    :param sample_rate: int
+        Samplerate clips are saved at, None keeps the original
+    :param dedup: Boolean
+        Whether the dedup manifest is used
+    :param max_retries: int
+        Times transient failures are retried
+
+    :return result: dict
+        The measurements, keyed by 'result_columns'
+    """
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+    labels, textlabels, big_data = meta
+    # Retries are not held back by real world backoffs
+    scheduler = FetchScheduler(max_retries=max_retries,
+                                backoff={'throttled': (0.1, 1), 'network': (0.1, 1), 'other': (0.1, 1)})
+    metrics = PipelineMetrics(interval=None)
+
+    # The dataset folders are made relative to the working directory, the same as in download_data.py
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    cpu_start, (read_start, write_start) = cpu_time(), block_io()
+    run_start = time.time()
+    try:
+        if mode == 'async':
+            main_download_async(work_dir, per_class, labels, textlabels, big_data, 'None', 0, workers,
+                                os.path.join(work_dir, 'Scratch'), dedup=dedup, sample_rate=sample_rate,
+                                scheduler=scheduler, fetcher=fetcher, metrics=metrics)
+        else:
+            main_download_parallel(work_dir, per_class, labels, textlabels, big_data, 'None', 0, workers, mode,
+                                    os.path.join(work_dir, 'Scratch'), dedup=dedup, sample_rate=sample_rate,
+                                    scheduler=scheduler, fetcher=fetcher, metrics=metrics)
+    finally:
+        os.chdir(cwd)
+    seconds = time.time() - run_start
+    cpu_s = cpu_time() - cpu_start
+    read_end, write_end = block_io()
+
+    data_dir = os.path.join(work_dir, 'AudioSet_Data')
+    clips = sum(len(pd.read_csv(os.path.join(data_dir, name, name + '.csv'), index_col=0)) for name in textlabels)
+    snapshot = metrics.snapshot()
+
+    return {'mode': mode, 'workers': workers, 'sample_rate': str(sample_rate), 'dedup': dedup,
+            'latency': fetcher.latency, 'clips': clips, 'seconds': round(seconds, 2),
+            'clips_per_s': round(clips / max(seconds, 1e-9), 2), 'cpu_s': round(cpu_s, 2),
+            'cpu_ms_per_clip': round(1000 * cpu_s / max(clips, 1), 1),
+            'written_mb': round(folder_size(data_dir) / 1e6, 2),
+            'block_read_mb': None if read_end is None else round(read_end - read_start, 2),
+            'block_write_mb': None if write_end is None else round(write_end - write_start, 2),
+            'bound_by': f"{snapshot['bound_by']} ({snapshot['bound_share']:.0%})"}
+
+
+def parse_rates(pairs):
+    """
+    :param pairs: list
+        'kind=rate' strings, i.e ['unavailable=0.1', 'network=0.05']
+
+    :return rates: dict
+        Failure kind -> rate
+    """
+    rates = {}
+    for pair in pairs:
+        kind, rate = pair.split('=')
+        rates[kind] = float(rate)
+    return rates
+
+
+###############################################################################
+#MAIN FUNCTION
+###############################################################################
+def main(fixture_dir, classes=4, per_class=20, workers=(1, 4), modes=('thread',), sample_rates=(16000,),
+            dedup=True, latency=0.2, failures=None, work_dir=None, out=None):
+    """
+    Benchmarks every combination of the given modes, worker counts and
+        samplerates
+
+    :param fixture_dir: str
+        Folder of media files served by the local fetcher
+    :param classes: int
+        Number of synthetic classes
+    :param per_class: int
+        Clips to download per class
+    :param workers: list
+        Worker counts to try
+    :param modes: list
+        Worker modes to try, any of 'thread', 'process' and 'async'
+    :param sample_rates: list
+        Samplerates to try, None keeps the original
+    :param dedup: Boolean
+        Whether the dedup manifest is used
+    :param latency: float
+        Seconds each request to the local fetcher takes
+    :param failures: dict
+        Failure kind -> rate for the local fetcher
+    :param work_dir: str
+        Folder the runs are done in, a temporary folder if None
+    :param out: str
+        Path of a csv the results are appended to, None to only print them
+
+    :return results: dataframe
+        One row of measurements per configuration
+    """
+    failures = failures or {}
+    fetcher = LocalFetcher(fixture_dir, latency=latency, failure_rates=failures)
+
+    # Enough candidates that failures never run a class dry
+    fail_rate = min(sum(failures.values()), 0.9)
+    meta = synthetic_meta(classes, int(per_class / (1 - fail_rate)) * 2 + 10)
+
+    temp_dir = None
+    if work_dir is None:
+        work_dir = temp_dir = tempfile.mkdtemp(prefix='audioset_bench_')
+
+    results = []
+    try:
+        for mode, num_workers, sample_rate in itertools.product(modes, workers, sample_rates):
+            result = run_config(os.path.join(work_dir, 'run'), fetcher, meta, per_class, mode, num_workers,
+                                sample_rate, dedup)
+            results.append(result)
+            print(', '.join(f'{key}: {result[key]}' for key in result_columns))
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    results = pd.DataFrame(results, columns=result_columns)
+    print(results.to_string(index=False))
+
+    if out is not None:
+        new_file = not os.path.isfile(out)
+        with open(out, 'a', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=result_columns)
+            if new_file:
+                writer.writeheader()
+            writer.writerows(results.to_dict('records'))
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the download pipeline offline against fixture files')
+    parser.add_argument('fixture_dir', help='Folder of media files served in place of YouTube')
+    parser.add_argument('--classes', type=int, default=4, help='Number of synthetic classes')
+    parser.add_argument('--per-class', type=int, default=20, help='Clips downloaded per class')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4], help='Worker counts to try')
+    parser.add_argument('--modes', nargs='+', default=['thread'], choices=['thread', 'process', 'async'],
+                        help='Worker modes to try')
+    parser.add_argument('--sample-rates', nargs='+', default=['16000'],
+                        help="Samplerates to try, 'None' keeps the original")
+    parser.add_argument('--no-dedup', action='store_true', help='Do not use the dedup manifest')
+    parser.add_argument('--latency', type=float, default=0.2, help='Seconds each fetcher request takes')
+    parser.add_argument('--failures', nargs='*', default=[], help="Failure rates as 'kind=rate'")
+    parser.add_argument('--work-dir', default=None, help='Folder the runs are done in, temporary if not given')
+    parser.add_argument('--out', default=None, help='csv the results are appended to')
+    args = parser.parse_args()
+
+    main(args.fixture_dir, args.classes, args.per_class, args.workers, args.modes,
+            [None if sr == 'None' else int(sr) for sr in args.sample_rates], not args.no_dedup,
+            args.latency, parse_rates(args.failures), args.work_dir, args.out)
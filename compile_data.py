@@ -32,45 +32,114 @@ OUTPUTS:
 #IMPORTS AND DIRECTORY POINTING
 ###############################################################################
 import os
+import time
 import warnings
 import numpy as np
 import pandas as pd
 
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
+# All segment meta-data files, in the order they are compiled together
+segment_files = ['balanced_train_segments.csv',
+                 'unbalanced_train_segments_0.csv',
+                 'unbalanced_train_segments_1.csv',
+                 'unbalanced_train_segments_2.csv',
+                 'eval_segments.csv']
+
 
 ###############################################################################
 # BIG DATAFRAME CREATION
 ###############################################################################
-def compile_dataframes(path_to_meta):
+def read_segment_chunks(path_to_meta, chunk_rows=100000):
+    """
+    Generator which streams every available segment meta-data file in chunks,
+        cleaning each chunk as it goes. Only one chunk is ever held in memory.
+
+    The files do not all have the same number of label columns, so the widest
+        one is found from the headers first and every chunk is padded out to it.
+        Chunks are re-indexed so that the index runs across all files, the
+        same as if they had been concatenated.
+
+    :param path_to_meta: str
+        The directory path to the meta data folder
+    :param chunk_rows: int
+        Number of rows read at a time
+
+    :yield file: str
+        Name of the segment file the chunk came from
+    :yield chunk: dataframe
+        Cleaned rows with columns 0 to n, YID, start, end then labels
+    """
+    files = []
+    for file in segment_files:
+        path = os.path.join(path_to_meta, file)
+        if os.path.isfile(path):
+            files.append(file)
+        else:
+            print(f'Segment file {file} not found, leaving it out')
+
+    # Header rows alone are enough to find the widest file
+    width = max(pd.read_csv(os.path.join(path_to_meta, file), header=[1], nrows=0).shape[1]
+                for file in files)
+
+    offset = 0
+    for file in files:
+        reader = pd.read_csv(os.path.join(path_to_meta, file), header=[1], chunksize=chunk_rows)
+        for chunk in reader:
+            chunk.columns = range(chunk.shape[1])
+            chunk = chunk.reindex(columns=range(width))
+            chunk.index = range(offset, offset + chunk.shape[0])
+            offset += chunk.shape[0]
+
+            # Times are always floats, even when a chunk only contains whole seconds
+            chunk[1] = chunk[1].astype(np.float64)
+            chunk[2] = chunk[2].astype(np.float64)
+
+            # The labels (all columns after the third) need to be cleaned of quotation
+            #   marks, done a whole column at a time. Empty columns have no strings
+            for col in range(3, width):
+                if chunk[col].dtype == object:
+                    chunk[col] = chunk[col].str.strip(' "')
+
+            yield file, chunk
+
+
+def compile_dataframes(path_to_meta, chunk_rows=100000):
     """
     Function creates a large compiled dataframe of all available meta-data in 
-        the meta-data folder passed
+        the meta-data folder passed. The segment files are streamed through in
+        chunks and appended to the output as they are cleaned, so peak memory
+        stays at around one chunk.
 
     :param path_to_meta: str
         The directory path to the meta data folder
+    :param chunk_rows: int
+        Number of rows read, cleaned and written at a time
 
     :saves: csv file
         A file with all available meta-data compiled into one
     """
-    # Meta data sheet imports
-    eval_segments = pd.read_csv(path_to_meta + '\\eval_segments.csv', header=[1], low_memory=False)
-    balanced_train = pd.read_csv(path_to_meta + '\\balanced_train_segments.csv', header=[1], low_memory=False)
-    unbalanced_train_0 = pd.read_csv(path_to_meta + '\\unbalanced_train_segments_0.csv', header=[1], low_memory=False)
-    unbalanced_train_1 = pd.read_csv(path_to_meta + '\\unbalanced_train_segments_1.csv', header=[1], low_memory=False)
-    unbalanced_train_2 = pd.read_csv(path_to_meta + '\\unbalanced_train_segments_2.csv', header=[1], low_memory=False)
-
-    # Concatenates all the imported dataframes into one much larger one, ~2M samples
-    big_data = pd.concat([balanced_train, unbalanced_train_0, unbalanced_train_1,
-                          unbalanced_train_2, eval_segments], axis=0, ignore_index=True)
-
-    # The labels (all columns after the third) need to be cleaned of quotation marks
-    big_data_first_three = big_data.iloc[:, 0:3] # Takes the columns to preserve
-    big_data_rest = big_data.iloc[:, 3:] # Takes columns of labels to clean
-
-    # Applies a string cleaning operation to all of the label columns
-    big_data_rest_cleaned = big_data_rest.apply(lambda x: x.str.strip(' "'), axis=1)
-
-    # Concats the two split dataframes back together before finally saving
-    big_data_full_cleaned = pd.concat([big_data_first_three, big_data_rest_cleaned], axis=1, ignore_index=True)
-    big_data_full_cleaned.to_csv(path_to_meta + '\\big_data.csv')
+    out_path = os.path.join(path_to_meta, 'big_data.csv')
+    # Written under a temporary name so a killed compile never leaves a partial big_data.csv
+    tmp_path = out_path + '.tmp'
+
+    start_time = time.time()
+    num_rows, file_rows, last_file = 0, 0, None
+
+    for file, chunk in read_segment_chunks(path_to_meta, chunk_rows):
+        if file != last_file:
+            if last_file is not None:
+                print(f'{last_file}: {file_rows} rows')
+            last_file, file_rows = file, 0
+
+        chunk.to_csv(tmp_path, mode='w' if num_rows == 0 else 'a', header=(num_rows == 0))
+        num_rows += chunk.shape[0]
+        file_rows += chunk.shape[0]
+
+    if last_file is not None:
+        print(f'{last_file}: {file_rows} rows')
+
+    os.replace(tmp_path, out_path)
+
+    total_time = time.time() - start_time
+    print(f'Compiled {num_rows} rows in {total_time:.1f}s ({num_rows / max(total_time, 1e-9):.0f} rows/s)')
@@ -0,0 +1,282 @@
+"""
+Disk budget for the download loops. A full run needs tens of GB and a disk that
+    fills up part way through leaves half written files behind, so rather than
+    running until a write fails the space left is checked before each fetch.
+
+Sizes are estimated from what the run has seen so far, starting from what a clip
+    at the chosen samplerate should take:
+    - Clips :   Each saved clip is added to the dataset total, which with the
+        average clip size gives the clips that still fit, both in the budget
+        and on the disk less the space held in reserve
+    - Raw :     Raw downloads only live in the scratch folder while they are
+        cleaned. Each fetch holds the average raw size of the scratch space
+        until it finishes, so the scratch folder can be kept small, i.e on a
+        tmpfs such as /dev/shm, without fetches writing over each other
+
+The budget moves between three states, each change being printed:
+    - 'ok' :    Fetches go out as normal
+    - 'low' :   Fewer than 'low_clips' clips still fit, or the scratch space has
+        no room for another average download. Fetchers able to only download
+        the clip segment are switched to it until the state is back to 'ok', so
+        each fetch needs less space and the run carries on at close to its
+        full rate
+    - 'full' :  Not even one more clip fits. No more fetches go out, anything
+        already fetched is committed and the run stops cleanly, leaving the
+        rest pending for a run with more space
+
+In every state only as many fetches go out at once as the scratch space has room
+    for, and never more than there are clips left in the budget. A fetch is
+    always allowed while nothing else is in flight, so however short the scratch
+    space is the run never stalls altogether.
+"""
+
+###############################################################################
+#IMPORTS
+###############################################################################
+import os
+import re
+import errno
+import shutil
+
+from download_planner import format_bytes
+
+# Size units accepted by 'parse_size'
+size_units = {'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3, 'TB': 1024 ** 4}
+
+
+###############################################################################
+#FUNCTIONS
+###############################################################################
+def parse_size(size):
+    """
+    :param size: int, float or str
+        Number of bytes or a size such as '40GB', 'None' for no size
+
+    :return num_bytes: float
+        The size in bytes, None if there is none
+    """
+    if size is None or size == 'None':
+        return None
+    if isinstance(size, (int, float)):
+        return float(size)
+    match = re.fullmatch(r'\s*([0-9.]+)\s*([KMGT]?B)?\s*', str(size).upper())
+    if match is None:
+        raise ValueError(f"Size must be a number of bytes or i.e '40GB', got: {size}")
+    return float(match.group(1)) * size_units[match.group(2) or 'B']
+
+
+def dataset_bytes(data_dir):
+    """
+    :param data_dir: str
+        Path of the 'AudioSet_Data' folder
+
+    :return size: int
+        Bytes taken up by every file in it, clips hardlinked into more than one
+            class only counting once
+    """
+    total, seen = 0, set()
+    for root, _, files in os.walk(data_dir):
+        for f in files:
+            stat = os.stat(os.path.join(root, f))
+            if (stat.st_dev, stat.st_ino) not in seen:
+                seen.add((stat.st_dev, stat.st_ino))
+                total += stat.st_size
+    return total
+
+
+def is_disk_full(error):
+    """
+    :param error: Exception
+        Error raised while writing, including an ffmpeg.Error
+
+    :return full: Boolean
+        Whether the error was down to the disk or quota being full
+    """
+    if getattr(error, 'errno', None) in [errno.ENOSPC, errno.EDQUOT]:
+        return True
+    # ffmpeg only says so in its output
+    text = str(error) + str(getattr(error, 'stderr', b'') or b'')
+    return 'No space left on device' in text or 'Disk quota exceeded' in text
+
+
+###############################################################################
+#DISK BUDGET
+###############################################################################
+class DiskBudget(object):
+    """
+    Keeps a download run inside its disk budget and scratch space
+
+    :param data_dir: str
+        Path of the 'AudioSet_Data' folder, what is already in it counts
+            towards the budget
+    :param scratch_dir: str
+        Folder raw downloads are written to, None if they are written in place
+    :param max_bytes: float
+        Most bytes the dataset folder may take up, None for no limit other than
+            the disk itself
+    :param reserve: float
+        Bytes always left free on the disks of the dataset and scratch folders
+    :param scratch_bytes: float
+        Most bytes of raw downloads kept in the scratch folder at once, None for
+            no limit other than its disk
+    :param sample_rate: int
+        Samplerate clips are saved at, for the first guess of the clip size
+    :param low_clips: int
+        Clips left in the budget at which fetching is cut back
+    :param raw_guess: float
+        First guess of the size of a raw download, until some are seen
+    """
+    def __init__(self, data_dir, scratch_dir=None, max_bytes=None, reserve=0, scratch_bytes=None,
+                    sample_rate=16000, low_clips=50, raw_guess=10 * 1024 ** 2):
+        self.data_dir = data_dir
+        self.scratch_dir = scratch_dir or data_dir
+        self.max_bytes = max_bytes
+        self.reserve = reserve
+        self.scratch_bytes = scratch_bytes
+        self.low_clips = low_clips
+
+        os.makedirs(self.data_dir, exist_ok=True)
+        os.makedirs(self.scratch_dir, exist_ok=True)
+        self.used = dataset_bytes(data_dir)
+        self.scratch_held = 0
+        self.state = 'ok'
+        # Clips still fitting in the budget as of the last 'update', less the fetches since
+        self.allowance = 0
+        # Fetcher switched to segment fetches while space is low, switched back once it is 'ok'
+        self.switched = None
+
+        # The first guesses count as one clip/ download each, so they are soon outweighed
+        channels = 2 if sample_rate is None else 1
+        self.clip_total, self.clip_count = 44 + 10 * 2 * channels * (sample_rate or 44100), 1
+        self.raw_total, self.raw_count = raw_guess, 1
+
+    def clip_estimate(self):
+        """
+        :return bytes: float
+            Average size of a saved clip
+        """
+        return self.clip_total / self.clip_count
+
+    def raw_estimate(self):
+        """
+        :return bytes: float
+            Average size of a raw download
+        """
+        return self.raw_total / self.raw_count
+
+    def add_raw(self, num_bytes):
+        """
+        :param num_bytes: int
+            Size of a raw download that was just fetched
+        """
+        if num_bytes:
+            self.raw_total += num_bytes
+            self.raw_count += 1
+
+    def add_clip(self, num_bytes):
+        """
+        :param num_bytes: int
+            Size of a clip that was just saved into the dataset
+        """
+        self.used += num_bytes
+        self.clip_total += num_bytes
+        self.clip_count += 1
+
+    def hold_scratch(self):
+        """
+        Holds scratch space, and one of the clips left in the budget, for a
+            fetch about to go out
+
+        :return held: float
+            Bytes held, to be handed back to 'release_scratch' once the fetch
+                and its cleaning are done
+        """
+        held = self.raw_estimate()
+        self.scratch_held += held
+        self.allowance -= 1
+        return held
+
+    def release_scratch(self, held):
+        self.scratch_held = max(self.scratch_held - held, 0)
+
+    def room(self):
+        """
+        :return bytes: float
+            Bytes the dataset can still grow by, within the budget and the disk
+        """
+        room = shutil.disk_usage(self.data_dir).free - self.reserve
+        if self.max_bytes is not None:
+            room = min(room, self.max_bytes - self.used)
+        return room
+
+    def scratch_room(self):
+        """
+        :return bytes: float
+            Scratch space not yet held by a fetch
+        """
+        room = shutil.disk_usage(self.scratch_dir).free - self.reserve
+        if self.scratch_bytes is not None:
+            room = min(room, self.scratch_bytes - self.scratch_held)
+        return room
+
+    def update(self, pending=0, fetcher=None, write=print):
+        """
+        Works out the state of the budget, called before fetches go out
+
+        :param pending: int
+            Clips fetched or being fetched which are not yet in the dataset
+        :param fetcher: YoutubeFetcher or LocalFetcher
+            Fetcher of the run, switched to segment fetches when space is low
+                if it has them
+        :param write: function
+            Prints a line, i.e tqdm.write so progress bars are not broken up
+
+        :return state: str
+            One of 'ok', 'low' or 'full'
+        """
+        clips_left = self.room() / self.clip_estimate() - pending
+        if clips_left < 1:
+            state = 'full'
+        elif clips_left < self.low_clips or self.scratch_room() < self.raw_estimate():
+            state = 'low'
+        else:
+            state = 'ok'
+
+        if state != self.state:
+            write(f'Disk budget {state}: room for about {max(int(clips_left), 0)} more clips of '
+                    f'{format_bytes(self.clip_estimate())}, {format_bytes(max(self.scratch_room(), 0))} of scratch '
+                    f'space free for downloads of {format_bytes(self.raw_estimate())}')
+            if state == 'low' and not getattr(fetcher, 'segment_fetch', True):
+                fetcher.segment_fetch = True
+                self.switched = fetcher
+                write('Switched to fetching only the clip segments to save space')
+            elif state == 'ok' and self.switched is not None:
+                self.switched.segment_fetch = False
+                self.switched = None
+                write('Switched back to full downloads')
+        self.state = state
+        self.allowance = int(clips_left)
+        return state
+
+    def can_fetch(self, in_flight):
+        """
+        :param in_flight: int
+            Fetches out at the moment
+
+        :return allowed: Boolean
+            Whether another fetch can go out, as of the last 'update'
+        """
+        if self.state == 'full':
+            return False
+        if in_flight == 0:
+            return True
+        # As many as the scratch space has room for, and no more than could still be saved
+        return self.allowance > 0 and self.scratch_room() >= self.raw_estimate()
+
+    def summary(self):
+        """
+        :return text: str
+            Space used and left
+        """
+        return (f'Dataset uses {format_bytes(self.used)}, room for about '
+                f'{max(int(self.room() / self.clip_estimate()), 0)} more clips of {format_bytes(self.clip_estimate())}')
@@ -1,6 +1,9 @@
 """
-This file deals with starting the single threaded download process, which as of 
-  right now is the recommended version to use(will update if this changes).
+This file deals with starting the download process. By default this is the
+  single threaded loop, setting 'parallel: workers' above 1 in 'control.yaml'
+  instead starts the concurrent version from parallel_download.py which draws
+  samples in the same seeded order. Setting 'parallel: mode' to 'async' starts
+  the asyncio pipeline from async_download.py, which also keeps the same order.
 """
 
 ##############################################################################
@@ -11,6 +14,13 @@ import yaml
 
 from download_functions import get_data, main_download
 from download_functions import download_audio, create_directories, file_cleaning
+from parallel_download import main_download_parallel
+from async_download import main_download_async
+from download_scheduler import FetchScheduler
+from download_ledger import JobLedger, shard_classes, ledger_path
+from download_fetchers import make_fetcher
+from download_metrics import PipelineMetrics
+from download_budget import DiskBudget, parse_size
 
 ##############################################################################
 # MAIN 
@@ -39,12 +49,121 @@ if __name__ == '__main__':
     #   we keep option for greater user control, missing classes etc
     start_index = params['data']['start_index']
 
+    # Only the classes of this run's shard are downloaded, the rest are left to the other runs
+    num_shards, shard = params['ledger']['num_shards'], params['ledger']['shard']
+    labels, textlabels = shard_classes(labels[start_index:end_index], textlabels[start_index:end_index],
+                                        shard, num_shards)
 
-    # Starts the main download function
-    main_download(defaultdir=defaultdir, 
+    # Records each candidate's state so a resumed run only looks at pending ones
+    ledger = None
+    if params['ledger']['enabled']:
+        ledger = JobLedger(ledger_path(os.path.join(path_to_meta, params['dir']['ledger_folder']),
+                                        shard, num_shards))
+
+    # Samplerate clips are saved at, 'None' keeps whatever was downloaded
+    sample_rate = params['download']['sample_rate']
+    if sample_rate == 'None':
+        sample_rate = None
+
+    # Paces requests, retries transient failures and remembers dead YIDs between runs
+    rate = params['scheduler']['rate']
+    scheduler = FetchScheduler(dead_cache_path=os.path.join(path_to_meta, params['dir']['dead_cache']),
+                                rate=None if rate == 'None' else rate,
+                                burst=params['scheduler']['burst'],
+                                max_retries=params['scheduler']['max_retries'])
+
+    # Backend clips are fetched through, YouTube unless testing offline
+    fetcher = make_fetcher(params['download']['fetcher'], params['dir']['cookie_path'], defaultdir,
+                            segment_fetch=params['download']['segment_fetch'],
+                            segment_margin=params['download']['segment_margin'],
+                            local_dir=os.path.join(defaultdir, params['dir']['fixture_folder']))
+
+    # Times each stage of the run, summed up on screen and in the snapshot files
+    metrics_files = [params['metrics'][key] for key in ['json_file', 'prometheus_file']]
+    metrics = PipelineMetrics(*[None if f == 'None' else os.path.join(path_to_meta, f) for f in metrics_files],
+                                interval=params['metrics']['interval'])
+
+    # Stops the run cleanly before the dataset outgrows its budget or the disk fills up
+    scratch_dir = os.path.join(defaultdir, params['dir']['scratch_folder'])
+    budget = DiskBudget(os.path.join(defaultdir, 'AudioSet_Data'), scratch_dir,
+                        max_bytes=parse_size(params['budget']['max_bytes']),
+                        reserve=parse_size(params['budget']['reserve']) or 0,
+                        scratch_bytes=parse_size(params['budget']['scratch_bytes']),
+                        sample_rate=sample_rate,
+                        low_clips=params['budget']['low_clips'])
+
+
+    # Starts the asyncio pipeline, which overlaps fetching with cleaning
+    if params['parallel']['mode'] == 'async':
+        cpu_workers, queue_size = params['parallel']['cpu_workers'], params['parallel']['queue_size']
+        main_download_async(defaultdir=defaultdir,
+                    samples_per_class=params['data']['max_per_class'],
+                    labels=labels,
+                    textlabels=textlabels,
+                    big_data=big_data,
+                    cookie_path=params['dir']['cookie_path'],
+                    seed=params['seed'],
+                    workers=params['parallel']['workers'],
+                    scratch_dir=scratch_dir,
+                    cpu_workers=None if cpu_workers == 'None' else cpu_workers,
+                    queue_size=None if queue_size == 'None' else queue_size,
+                    segment_fetch=params['download']['segment_fetch'],
+                    segment_margin=params['download']['segment_margin'],
+                    probe_cache_path=os.path.join(path_to_meta, params['dir']['probe_cache']),
+                    dedup=params['download']['dedup'],
+                    sample_rate=sample_rate,
+                    scheduler=scheduler,
+                    ledger=ledger,
+                    fetcher=fetcher,
+                    metrics=metrics,
+                    ordering=params['download']['ordering'],
+                    prefer_known=params['download']['prefer_known'],
+                    budget=budget)
+
+    # Starts the concurrent download function if more than one worker is asked for
+    elif params['parallel']['workers'] > 1:
+        main_download_parallel(defaultdir=defaultdir,
+                    samples_per_class=params['data']['max_per_class'],
+                    labels=labels,
+                    textlabels=textlabels,
+                    big_data=big_data,
+                    cookie_path=params['dir']['cookie_path'],
+                    seed=params['seed'],
+                    workers=params['parallel']['workers'],
+                    mode=params['parallel']['mode'],
+                    scratch_dir=scratch_dir,
+                    segment_fetch=params['download']['segment_fetch'],
+                    segment_margin=params['download']['segment_margin'],
+                    probe_cache_path=os.path.join(path_to_meta, params['dir']['probe_cache']),
+                    dedup=params['download']['dedup'],
+                    sample_rate=sample_rate,
+                    scheduler=scheduler,
+                    ledger=ledger,
+                    fetcher=fetcher,
+                    metrics=metrics,
+                    ordering=params['download']['ordering'],
+                    prefer_known=params['download']['prefer_known'],
+                    budget=budget)
+
+    # Otherwise starts the main download function
+    else:
+        main_download(defaultdir=defaultdir, 
                     samples_per_class=params['data']['max_per_class'],
-                    labels=labels[start_index:end_index],
-                    textlabels=textlabels[start_index:end_index],
+                    labels=labels,
+                    textlabels=textlabels,
                     big_data=big_data,
                     cookie_path=params['dir']['cookie_path'],
-                    seed=params['seed'])
\ No newline at end of file
+                    seed=params['seed'],
+                    segment_fetch=params['download']['segment_fetch'],
+                    segment_margin=params['download']['segment_margin'],
+                    probe_cache_path=os.path.join(path_to_meta, params['dir']['probe_cache']),
+                    scratch_dir=scratch_dir,
+                    dedup=params['download']['dedup'],
+                    sample_rate=sample_rate,
+                    scheduler=scheduler,
+                    ledger=ledger,
+                    fetcher=fetcher,
+                    metrics=metrics,
+                    ordering=params['download']['ordering'],
+                    prefer_known=params['download']['prefer_known'],
+                    budget=budget)
\ No newline at end of file
@@ -0,0 +1,200 @@
+"""
+Fetcher backends for the download loops. 'main_download' and
+    'main_download_parallel' only ever ask a fetcher to 'probe' a candidate and
+    then 'fetch' it, so where the media comes from can be swapped out:
+    - 'youtube_dl' / 'yt_dlp' : 'YoutubeFetcher' in download_functions.py,
+        gets the clips from YouTube with either library
+    - 'local' : 'LocalFetcher' below, serves pre-recorded media files from a
+        folder with a set latency and failure rates
+
+The local backend lets the rest of the pipeline(scheduling, cleaning, logging,
+    dedup) be run, load tested and benchmarked offline, see benchmark.py. Each
+    YID is served the file '<YID>.<ext>' if the folder has one, otherwise one
+    of the files picked by hashing the YID, so any meta-data can be used with a
+    handful of fixture files.
+
+Failure rates are given per failure kind, see download_scheduler.py. Permanent
+    kinds('unavailable', 'restricted') are decided by the YID alone, so a video
+    that is unavailable stays unavailable. Transient kinds('throttled',
+    'network', 'other') are drawn again on every request.
+"""
+
+###############################################################################
+#IMPORTS
+###############################################################################
+import os
+import time
+import zlib
+import random
+import shutil
+import ffmpeg
+import soundfile as sf
+
+from download_functions import YoutubeFetcher, preflight_clip
+from download_scheduler import is_permanent
+
+# File types served by the local backend
+media_extensions = ('.wav', '.flac', '.ogg', '.mp3', '.m4a', '.webm', '.opus')
+
+
+###############################################################################
+#FUNCTIONS
+###############################################################################
+def media_duration(path):
+    """
+    :param path: str
+        Path of a media file
+
+    :return duration: float
+        Length of the file in seconds
+    """
+    try:
+        return sf.info(path).duration
+    # Compressed formats soundfile cant open are asked of ffprobe instead
+    except Exception:
+        return float(ffmpeg.probe(path)['format']['duration'])
+
+
+def make_fetcher(backend, cookie_path, defaultdir, segment_fetch=False, segment_margin=1, local_dir=None,
+                    latency=0, failure_rates=None):
+    """
+    Builds the fetcher backend picked in 'control.yaml'
+
+    :param backend: str
+        One of 'youtube_dl', 'yt_dlp' or 'local'
+    :param cookie_path: str
+        Absolute path to the cookies file being used for downloading
+    :param defaultdir: str
+        The base directory of the full codeset, used to find ffmpeg
+    :param segment_fetch: Boolean
+        Whether to only fetch the clip window rather than the whole video
+    :param segment_margin: float
+        Seconds of extra audio fetched either side of the clip window
+    :param local_dir: str
+        Folder of media files served by the local backend
+    :param latency: float
+        Seconds each request to the local backend takes
+    :param failure_rates: dict
+        Failure kind -> chance of a local request failing that way
+
+    :return fetcher: YoutubeFetcher or LocalFetcher
+        The fetcher handed to the download loop
+    """
+    if backend in ['youtube_dl', 'yt_dlp']:
+        return YoutubeFetcher(cookie_path, defaultdir, segment_fetch, segment_margin, library=backend)
+    elif backend == 'local':
+        return LocalFetcher(local_dir, latency=latency, failure_rates=failure_rates)
+    else:
+        raise ValueError(f"Fetcher backend must be 'youtube_dl', 'yt_dlp' or 'local', got: {backend}")
+
+
+###############################################################################
+#LOCAL FETCHER
+###############################################################################
+class LocalFetcher(object):
+    """
+    Fetcher backend which serves pre-recorded media files from a folder
+
+    :param media_dir: str
+        Folder of media files to serve
+    :param latency: float
+        Seconds each probe and fetch request takes
+    :param jitter: float
+        Up to this many seconds are randomly added to each request
+    :param failure_rates: dict
+        Failure kind -> chance of a request failing that way
+    :param seed: int
+        Seed of the permanent failures, and of the transient failures and jitter
+            when used from threads
+    """
+    def __init__(self, media_dir, latency=0, jitter=0, failure_rates=None, seed=0):
+        self.media_dir = media_dir
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rates = dict(failure_rates or {})
+        self.seed = seed
+        self.rng = random.Random(seed)
+
+        names = sorted(f for f in os.listdir(media_dir) if f.lower().endswith(media_extensions))
+        if not names:
+            raise ValueError(f'No media files found in {media_dir}')
+        self.files = [os.path.join(media_dir, f) for f in names]
+        self.by_yid = {os.path.splitext(f)[0]: path for f, path in zip(names, self.files)}
+        self.durations = {path: media_duration(path) for path in self.files}
+
+    def __getstate__(self):
+        # Every job sent to a process pool gets its own copy, which would all make the same draws
+        state = dict(self.__dict__)
+        del state['rng']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.rng = random.Random()
+
+    def media(self, yid):
+        """
+        :param yid: str
+            YouTube ID of the candidate
+
+        :return path: str
+            Path of the file served for the YID
+        """
+        if yid in self.by_yid:
+            return self.by_yid[yid]
+        return self.files[zlib.crc32(yid.encode()) % len(self.files)]
+
+    def request(self, yid, kinds):
+        """
+        Waits out the latency of a request then decides if it failed
+
+        :param yid: str
+            YouTube ID of the candidate
+        :param kinds: list
+            Failure kinds the request can have
+
+        :return kind: str
+            The failure kind, None if the request worked
+        """
+        time.sleep(self.latency + self.jitter * self.rng.random())
+        for kind in kinds:
+            rate = self.failure_rates.get(kind, 0)
+            if is_permanent(kind):
+                # Same answer for the YID every time
+                draw = (zlib.crc32(f'{self.seed}{kind}{yid}'.encode()) % 10000) / 10000
+            else:
+                draw = self.rng.random()
+            if draw < rate:
+                return kind
+        return None
+
+    def probe(self, yid, start, end, length=None):
+        """
+        Same as 'YoutubeFetcher.probe'. The served file is treated as a video
+            long enough for the clip, so only bad times and failures fail
+        """
+        if length is None and end - start == 10:
+            failure = self.request(yid, ['unavailable', 'restricted', 'throttled', 'network', 'other'])
+            if failure is not None:
+                return False, None, None, failure
+            length = max(self.durations[self.media(yid)], end + 1)
+
+        valid, _, length, failure = preflight_clip(None, start, end, None, length)
+        return valid, None, length, failure
+
+    def fetch(self, yid, start, end, out_dir='', info=None):
+        """
+        Same as 'YoutubeFetcher.fetch'. The served file is copied into out_dir,
+            starting at whatever offset lines the clip up with its end
+
+        :return method: str
+            Always 'local'
+        """
+        if self.request(yid, ['network']) is not None:
+            return '0', 0, 'local'
+
+        path = self.media(yid)
+        filename = os.path.join(out_dir, yid + os.path.splitext(path)[1])
+        shutil.copyfile(path, filename)
+        offset = max(end - self.durations[path], 0)
+        return filename, offset, 'local'
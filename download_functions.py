@@ -32,21 +32,32 @@ OUTPUTS:
 #IMPORTS AND DIRECTORY POINTING
 ###############################################################################
 import os
-import io
-import ffmpy
+import time
+import shutil
 import ffmpeg
 import warnings
+import importlib
 import youtube_dl
 import numpy as np
 import pandas as pd
 import soundfile as sf
 
 from tqdm import tqdm, trange
-
-from contextlib import redirect_stdout, redirect_stderr
+from meta_store import FrameIndex, load_meta_store
+from download_log import ClassLog
+from download_planner import ClipManifest, plan_overlap
+from download_scheduler import FetchScheduler, classify_failure
+from download_metrics import PipelineMetrics
+from download_budget import is_disk_full
 
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
+# ffmpeg executable found for each base directory, filled in by 'find_ffmpeg'
+ffmpeg_paths = {}
+
+# Start of every link that will be needed
+slink = 'https://www.youtube.com/watch?v='
+
 
 ###############################################################################
 #DATA IMPORTS
@@ -57,18 +68,27 @@ def get_data(path_to_meta, df_file):
 
     :param path_to_meta: str
         Path to teh meta-data form the current working directory
+    :param df_file: str
+        Either the name of the compiled meta-data store folder or a csv file of
+            examples, i.e a previously downloaded set, to sample from
 
     :return labels: array
         An array of the suitable unique class Ids
     :return textabels: array
         Te human readbale equivalents to variable 'labels'
-    :return big_data: dataframe
-        All meta-data containing dataframe from which we sample relevant subsets
+    :return big_data: MetaStore or FrameIndex
+        All meta-data from which we sample relevant subsets, indexed by label
     """
-    # Deals with the import of big_data.csv, created in compile_data.py
-    big_data = pd.read_csv(path_to_meta + '\\' + 'big_data.csv', index_col=0)
-    # YouTube ID(col1) has to be changed so we can do a comparison on columns later on
-    big_data = big_data.rename(columns={"0": "YID"})
+    # The compiled store is the default, it is (re)built here if out of date
+    if not df_file.endswith('.csv'):
+        big_data = load_meta_store(path_to_meta, df_file)
+    else:
+        # Deals with the import of csv files such as big_data.csv, created in compile_data.py
+        big_data = pd.read_csv(os.path.join(path_to_meta, df_file), index_col=0)
+        # YouTube ID(col1) has to be changed so we can do a comparison on columns later on
+        big_data = big_data.rename(columns={"0": "YID"})
+        # Labels are indexed once here rather than searched for every class
+        big_data = FrameIndex(big_data)
 
     # Imports the perviosuly used suitable_classes.npy file array
     suitable_classes = np.load('suitable_classes.npy')
@@ -80,25 +100,35 @@ def get_data(path_to_meta, df_file):
 ###############################################################################
 #FUNCTIONS
 ###############################################################################
-def download_audio(link, start, end, cookie_path):
+class QuietLogger(object):
     """
-    Function responsible for actually downloading the file from youtube. This
-        is mainly done through the youtube_dl library where options are used
-        to only grab the audio.
+    Logger handed to youtube_dl which swallows all of its output. Unlike
+        redirecting stdout/stderr this does not touch any global state, so is
+        safe to use when many downloads are running in threads at once
+    """
+    def debug(self, msg):
+        pass
 
-    :param link: str
-        The youtube compatible link for the file attempting to
-            be downloaded
+    def warning(self, msg):
+        pass
 
-    :return filename: str
-        The name of the file, a return of '0' indicates a
-            download failure, anything else should be a success.
+    def error(self, msg):
+        pass
+
+
+def get_options(cookie_path, out_dir=''):
     """
-    # Names the file straight away, if not changed by return, failure has occured
-    filename='0'
-    # Obtains a list of files in directory, important for later identifying download
-    listdir=os.listdir()
+    Builds the youtube_dl options shared by the probing and downloading functions
+
+    :param cookie_path: str
+        Absolute path to the cookies file being used for downloading, 'None'
+            if not being used
+    :param out_dir: str
+        Directory that any downloaded file is written into
 
+    :return options: dict
+        Options to be passed to youtube_dl.YoutubeDL
+    """
     # Options for the downloading of file, in this case we want bets quality audio
     options = {
     'quiet': True, # Mutes normal output
@@ -107,43 +137,181 @@ def download_audio(link, start, end, cookie_path):
     'format': 'bestaudio/best', # Downloads the best quality audio
     'extractaudio' : True,  # only keep the audio
     'noplaylist' : True,    # only download single song, not playlist
+    'logger': QuietLogger(), # Catches anything that still gets through quiet
+    'outtmpl': os.path.join(out_dir, '%(id)s.%(ext)s'), # Named by YID so the path is known up front
     }
 
     # if we have a cookie path we can use it
     if cookie_path != 'None':
         options['cookiefile'] = cookie_path # Path to the cookies file
 
+    return options
 
-    # The code here uses try to avoid a crash when rare downloads inevitably fail
-    try:
-        f = io.StringIO()
-        with redirect_stdout(f), redirect_stderr(f):
-            youtube_dl.YoutubeDL(options).download([link])
-
-        # Comapres new to old directory file lists to find the new file
-        listdir2=os.listdir()
-        for i, val in enumerate(listdir2):
-            if listdir2[i] not in listdir:
-                filename=listdir2[i]
+
+def find_ffmpeg(defaultdir):
+    """
+    Finds the ffmpeg executable to use, looking in the base directory first, as
+        the original Windows setup ships 'ffmpeg.exe' there, and then on PATH.
+        Results are kept so the lookup is only done once per process.
+
+    :param defaultdir: str
+        The base directory of the full codeset
+
+    :return executable: str
+        Path of ffmpeg, or just 'ffmpeg' if none was found so the error comes
+            from the call that needs it
+    """
+    if defaultdir not in ffmpeg_paths:
+        executable = shutil.which('ffmpeg') or 'ffmpeg'
+        for name in ['ffmpeg.exe', 'ffmpeg']:
+            path = os.path.join(defaultdir, name)
+            if os.path.isfile(path):
+                executable = path
                 break
+        ffmpeg_paths[defaultdir] = executable
+    return ffmpeg_paths[defaultdir]
 
-        # want to check teh length of the file so that we dont have smaples< 10s
-        length = youtube_dl.YoutubeDL(options).extract_info(link)['duration']
 
-        # Files that are excatly 10s typically get shortened by a second, so 11s needed
-        if  length < 11:
-            os.remove(filename)
-            filename='0'
-        # Wierd start/ends have been selected for some files so have to sort this
-        if end >= length:
-            os.remove(filename)
-            filename='0'
+def load_probe_cache(cache_path):
+    """
+    Loads the cache of previously probed video durations so that resumed runs
+        can validate clips without going back to YouTube
 
-        if end-start != 10:
-            os.remove(filename)
-            filename ='0'
+    :param cache_path: str
+        Path to the probe cache csv, None disables caching
+
+    :return probe_cache: dict
+        YID -> video duration in seconds
+    """
+    probe_cache = {}
+    if cache_path is None or not os.path.isfile(cache_path):
+        return probe_cache
+
+    with open(cache_path) as f:
+        for line in f:
+            # A killed run can leave a half written last line, which is skipped
+            try:
+                yid, duration = line.rstrip('\n').split(',')
+                probe_cache[yid] = float(duration)
+            except ValueError:
+                continue
+
+    return probe_cache
+
+
+def store_probe(cache_path, probe_cache, yid, duration):
+    """
+    Adds a newly probed duration to the cache, both in memory and on disk. The
+        disk cache is append only so each probe costs a single short write
+
+    :param cache_path: str
+        Path to the probe cache csv, None disables caching
+    :param probe_cache: dict
+        The in memory cache loaded by 'load_probe_cache'
+    :param yid: str
+        YouTube ID of the probed video
+    :param duration: float
+        Duration of the video in seconds
+    """
+    if duration is None or yid in probe_cache:
+        return
+    probe_cache[yid] = duration
+    if cache_path is not None:
+        with open(cache_path, 'a') as f:
+            f.write(f'{yid},{duration}\n')
 
 
+def preflight_clip(link, start, end, cookie_path, length=None, library=youtube_dl):
+    """
+    Pre-flight validation of a clip before any media is downloaded. The video
+        info is resolved once with download=False, which is both enough to check
+        the clip and can be handed straight to 'download_audio' so nothing is
+        resolved twice. If the duration is already known, i.e from the probe
+        cache, no request is made at all.
+
+    :param link: str
+        The youtube compatible link for the file
+    :param start: float
+        Start time in seconds of the class clip
+    :param end: float
+        End time in seconds of the class clip
+    :param cookie_path: str
+        Absolute path to the cookies file being used for downloading
+    :param length: float
+        Known duration of the video, None if it still needs probing
+    :param library: module
+        youtube_dl or a module with the same api, i.e yt_dlp
+
+    :return valid: Boolean
+        Whether the clip should be downloaded
+    :return info: dict
+        Resolved youtube_dl info, None if it was not needed or failed
+    :return length: float
+        Duration of the video, None if it could not be found
+    :return failure: str
+        Kind of failure as given by 'classify_failure' if the clip is not
+            valid, None if it is
+    """
+    # Wierd start/ends have been selected for some files so have to sort this
+    if end-start != 10:
+        return False, None, length, 'invalid'
+
+    info = None
+    if length is None:
+        try:
+            info = library.YoutubeDL(get_options(cookie_path)).extract_info(link, download=False)
+            length = info['duration']
+        # Video is unavailable, the reason decides whether it is ever tried again
+        except Exception as e:
+            return False, None, None, classify_failure(e)
+
+    # Live streams etc have no duration
+    if length is None:
+        return False, None, None, 'invalid'
+
+    # Files that are excatly 10s typically get shortened by a second, so 11s needed
+    valid = length >= 11 and end < length
+    return valid, info, length, None if valid else 'invalid'
+
+
+def download_audio(link, start, end, cookie_path, out_dir='', info=None, library=youtube_dl):
+    """
+    Function responsible for actually downloading the file from youtube. This
+        is mainly done through the youtube_dl library where options are used
+        to only grab the audio. Clips should already have been checked with
+        'preflight_clip'.
+
+    :param link: str
+        The youtube compatible link for the file attempting to
+            be downloaded
+    :param out_dir: str
+        Directory the file is downloaded into, defaults to the current working
+            directory. Files are always named '<YID>.<ext>' inside of it
+    :param info: dict
+        Info already resolved by 'preflight_clip', saves resolving it again
+    :param library: module
+        youtube_dl or a module with the same api, i.e yt_dlp
+
+    :return filename: str
+        The path of the file, a return of '0' indicates a
+            download failure, anything else should be a success.
+    """
+    # Names the file straight away, if not changed by return, failure has occured
+    filename='0'
+
+    # The code here uses try to avoid a crash when rare downloads inevitably fail
+    try:
+        ydl = library.YoutubeDL(get_options(cookie_path, out_dir))
+        if info is None:
+            info = ydl.extract_info(link, download=True)
+        else:
+            info = ydl.process_ie_result(info, download=True)
+
+        # The output template means the path follows straight from the info
+        path = ydl.prepare_filename(info)
+        if os.path.isfile(path):
+            filename = path
+
     # Skips forward if try function fails, indicating the fle cannot be retrieved
     except Exception:
         filename ='0'
@@ -151,6 +319,341 @@ def download_audio(link, start, end, cookie_path):
     return filename
 
 
+def download_audio_segment(link, start, end, cookie_path, defaultdir, out_dir='', margin=1, info=None,
+                            library=youtube_dl):
+    """
+    Alternative to 'download_audio' which only pulls the [start, end] window
+        (plus a small margin either side) out of the YouTube stream instead of
+        the whole video. The stream url is resolved by youtube_dl without
+        downloading and ffmpeg then seeks straight to the segment, so only the
+        bytes around the clip are fetched and decoded. Clips should already
+        have been checked with 'preflight_clip'.
+
+    If anything goes wrong with the ranged fetch the full video is downloaded
+        instead using 'download_audio', the returned method says which was used.
+
+    :param link: str
+        The youtube compatible link for the file attempting to
+            be downloaded
+    :param defaultdir: str
+        The base directory of the full codeset, used to find ffmpeg
+    :param out_dir: str
+        Directory the file is downloaded into, defaults to the current working
+            directory
+    :param margin: float
+        Seconds of extra audio kept either side of the segment
+    :param info: dict
+        Info already resolved by 'preflight_clip', otherwise resolved here
+    :param library: module
+        youtube_dl or a module with the same api, i.e yt_dlp
+
+    :return filename: str
+        The name of the file, a return of '0' indicates a
+            download failure, anything else should be a success.
+    :return offset: float
+        Time in seconds of the original video that the file starts at, start
+            and end need this taken off before being passed to 'file_cleaning'
+    :return method: str
+        'segment' if only the window was fetched, 'fallback' if the full video
+            download had to be used instead, None if the video was unavailable
+    """
+    # Stream urls expire so a cached duration still means resolving here
+    if info is None:
+        try:
+            info = library.YoutubeDL(get_options(cookie_path)).extract_info(link, download=False)
+        except Exception:
+            return '0', 0, None
+
+    offset = max(start - margin, 0)
+    filename = os.path.join(out_dir, info['id'] + '_segment.wav')
+
+    try:
+        # Any headers youtube_dl would use have to be passed on for the stream url to work
+        headers = ''.join(f'{key}: {val}\r\n' for key, val in info.get('http_headers', {}).items())
+        stream = ffmpeg.input(info['url'], ss=offset, t=(end - offset) + margin, headers=headers)
+        stream = ffmpeg.output(stream, filename, vn=None)
+        ffmpeg.run(stream, cmd=find_ffmpeg(defaultdir), quiet=True, overwrite_output=True)
+        return filename, offset, 'segment'
+
+    # Ranged fetch didnt work, so go back to grabbing the whole thing
+    except Exception:
+        if os.path.exists(filename):
+            os.remove(filename)
+        return download_audio(link, start, end, cookie_path, out_dir=out_dir, info=info,
+                                library=library), 0, 'fallback'
+
+
+class YoutubeFetcher(object):
+    """
+    Fetcher backend which gets clips from YouTube, the one used for real runs.
+        Both download loops only talk to a fetcher through 'probe' and 'fetch',
+        so it can be swapped out, i.e for the 'LocalFetcher' in
+        download_fetchers.py when benchmarking offline
+
+    :param cookie_path: str
+        Absolute path to the cookies file being used for downloading
+    :param defaultdir: str
+        The base directory of the full codeset, used to find ffmpeg
+    :param segment_fetch: Boolean
+        Whether to only fetch the clip window with 'download_audio_segment'
+            rather than the whole video
+    :param segment_margin: float
+        Seconds of extra audio fetched either side of the clip window
+    :param library: str
+        Name of the module doing the fetching, 'youtube_dl' or 'yt_dlp'
+    """
+    def __init__(self, cookie_path, defaultdir, segment_fetch=False, segment_margin=1, library='youtube_dl'):
+        self.cookie_path = cookie_path
+        self.defaultdir = defaultdir
+        self.segment_fetch = segment_fetch
+        self.segment_margin = segment_margin
+        # Only the name is kept so the fetcher can be pickled for a process pool
+        self.library = library
+
+    def module(self):
+        return importlib.import_module(self.library)
+
+    def probe(self, yid, start, end, length=None):
+        """
+        Checks a clip before anything is downloaded, see 'preflight_clip'
+
+        :param yid: str
+            YouTube ID of the candidate
+        :param start: float
+            Start time in seconds of the class clip
+        :param end: float
+            End time in seconds of the class clip
+        :param length: float
+            Known duration of the video, None if it still needs probing
+
+        :return valid: Boolean
+            Whether the clip should be downloaded
+        :return info: dict
+            Anything resolved by the probe which 'fetch' can reuse
+        :return length: float
+            Duration of the video, None if it could not be found
+        :return failure: str
+            Kind of failure if the clip is not valid, None if it is
+        """
+        return preflight_clip(slink + yid, start, end, self.cookie_path, length, library=self.module())
+
+    def fetch(self, yid, start, end, out_dir='', info=None):
+        """
+        Downloads a clip that passed 'probe'
+
+        :param yid: str
+            YouTube ID of the candidate
+        :param start: float
+            Start time in seconds of the class clip
+        :param end: float
+            End time in seconds of the class clip
+        :param out_dir: str
+            Directory the file is downloaded into
+        :param info: dict
+            Info returned by 'probe'
+
+        :return filename: str
+            Path of the downloaded file, '0' if the download failed
+        :return offset: float
+            Time in seconds of the original video that the file starts at
+        :return method: str
+            How the file was fetched, 'full', 'segment' or 'fallback'
+        """
+        if self.segment_fetch:
+            return download_audio_segment(slink + yid, start, end, self.cookie_path, self.defaultdir,
+                                            out_dir=out_dir, margin=self.segment_margin, info=info,
+                                            library=self.module())
+        filename = download_audio(slink + yid, start, end, self.cookie_path, out_dir=out_dir, info=info,
+                                    library=self.module())
+        return filename, 0, 'full'
+
+
+def class_examples(big_data, mid):
+    """
+    Gets every example of a class from the meta-data, using the label index
+        built by 'get_data'. A plain dataframe is still accepted but has to be
+        searched in full
+
+    :param big_data: MetaStore, FrameIndex or dataframe
+        All meta-data as loaded by 'get_data'
+    :param mid: str
+        The class MID
+
+    :return all_examples: dataframe
+        The examples of the class with YID, start and end as the first columns
+    """
+    if isinstance(big_data, pd.DataFrame):
+        return big_data[big_data.eq(mid).any(1)]
+    return big_data.examples(mid)
+
+
+def valid_clips(all_examples):
+    """
+    :param all_examples: dataframe
+        Examples with YID, start and end as the first columns
+
+    :return valid: array
+        Whether each example is a 10s clip, the rest can never be used, and
+            the first row of it as the same clip can be listed more than once
+    """
+    first = ~all_examples.iloc[:, :2].duplicated().values
+    return first & ((all_examples.iloc[:, 2].values - all_examples.iloc[:, 1].values) == 10)
+
+
+def sample_order(all_examples, seed, skip=None, ordering='permutation', lengths=None, prefer=None):
+    """
+    Generator which yields candidates in the seeded order they are tried in.
+
+    'permutation' shuffles every example of the class once, up front, then
+        walks through it, leaving out the rows in 'skip' along with clips that
+        could never be used or are repeats of an earlier row. As the shuffle
+        is of the whole class, leaving rows out never changes the order of the
+        rest, so a resumed class carries on in exactly the order it would have
+        had.
+
+    'legacy' is the original order, where each candidate is a fresh seeded
+        draw from the examples left, with the drawn row dropped each time. Each
+        draw costs as much as the whole class and unusable clips are still
+        tried, but sets downloaded with it can be reproduced exactly.
+
+    :param all_examples: dataframe
+        Every example of the class
+    :param seed: int
+        Random sampling seed for reproducibility
+    :param skip: array
+        Boolean mask of rows which are not candidates, i.e already downloaded
+    :param ordering: str
+        Either 'permutation' or 'legacy'
+    :param lengths: dict
+        YID -> known video duration, clips that dont fit in their video are
+            left out, 'permutation' only
+    :param prefer: list
+        Collections of YIDs with a good history, i.e already probed or
+            downloaded. These are tried first, in their seeded order, ahead of
+            the rest, 'permutation' only
+
+    :yield candidate: tuple
+        (yid, start, end, row) of the next candidate, row being its index label
+    """
+    if ordering == 'legacy':
+        if skip is not None:
+            all_examples = all_examples[~np.asarray(skip)]
+        while not all_examples.empty:
+            # Randomly samples the all_examples df without replacement
+            instance = all_examples.sample(1, random_state=seed)
+            all_examples = all_examples.drop(instance.index)
+            yield instance.iloc[0, 0], instance.iloc[0, 1], instance.iloc[0, 2], instance.index[0]
+        return
+    elif ordering != 'permutation':
+        raise ValueError(f"Ordering must be 'permutation' or 'legacy', got: {ordering}")
+
+    yids, starts, ends = [all_examples.iloc[:, c].values for c in range(3)]
+    rows = all_examples.index.values
+    order = np.random.RandomState(seed).permutation(len(all_examples))
+
+    # Only the rows which are left are kept, in the order they were shuffled into
+    keep = valid_clips(all_examples)
+    if skip is not None:
+        keep &= ~np.asarray(skip)
+    if lengths:
+        # Same check 'preflight_clip' makes once the duration is known, unknown ones always pass
+        length = pd.Series(yids).map(lengths).fillna(np.inf).values
+        keep &= (length >= 11) & (ends < length)
+    order = order[keep[order]]
+
+    if prefer:
+        ordered_yids = pd.Series(yids[order])
+        known = np.logical_or.reduce([ordered_yids.isin(list(p)).values for p in prefer])
+        order = np.concatenate([order[known], order[~known]])
+
+    for p in order:
+        yield yids[p], starts[p], ends[p], rows[p]
+
+
+def class_candidates(big_data, mid, name, logged_yids, seed, ledger=None, ordering='permutation', lengths=None,
+                        prefer=None):
+    """
+    Works out how many examples a class has and the order its candidates are
+        tried in, see 'sample_order'. With a ledger a resumed class is served
+        from its pending rows, only going back to the meta-data if they run out
+
+    :param big_data: MetaStore, FrameIndex or dataframe
+        All meta-data as loaded by 'get_data'
+    :param mid: str
+        The class MID
+    :param name: str
+        Readable class label
+    :param logged_yids: set
+        YIDs already in the class log
+    :param seed: int
+        Random sampling seed for reproducibility
+    :param ledger: JobLedger
+        Job ledger of the run, None to draw from the meta-data every time
+    :param ordering: str
+        Either 'permutation' or 'legacy'
+    :param lengths: dict
+        YID -> known video duration, used to leave out clips that cant fit
+    :param prefer: list
+        Collections of YIDs with a good history, tried first
+
+    :return available: int
+        Number of examples of the class, only counting usable clips with the
+            'permutation' ordering
+    :return candidates: generator
+        (yid, start, end) of each candidate not yet downloaded
+    """
+    order_args = {'ordering': ordering, 'lengths': lengths, 'prefer': prefer}
+    if ledger is not None and ledger.has_class(mid):
+        ledger.reconcile(mid, logged_yids)
+        return ledger.available(mid), ledger_candidates(big_data, mid, seed, ledger, logged_yids,
+                                                            order_args=order_args)
+
+    all_examples = class_examples(big_data, mid)
+    available = all_examples.shape[0] if ordering == 'legacy' else int(valid_clips(all_examples).sum())
+    # Already downloaded YIDs are left out of the candidates
+    logged = all_examples['YID'].isin(logged_yids).values
+
+    if ledger is None:
+        return available, ((yid, start, end) for yid, start, end, _ in
+                            sample_order(all_examples, seed, logged, **order_args))
+
+    ledger.add_class(mid, name, available)
+    ledger.reconcile(mid, logged_yids)
+    return available, ledger_candidates(big_data, mid, seed, ledger, logged_yids, all_examples, logged, order_args)
+
+
+def ledger_candidates(big_data, mid, seed, ledger, logged_yids, all_examples=None, skip=None, order_args=None):
+    """
+    Generator which yields the pending candidates of a class from the ledger,
+        then draws new ones from the meta-data, adding each to the ledger
+
+    :param logged_yids: set
+        YIDs already in the class log
+    :param all_examples: dataframe
+        Every example of the class, None to load them only if needed
+    :param skip: array
+        Boolean mask of examples which are not candidates
+    :param order_args: dict
+        Keyword arguments of 'sample_order'
+
+    :yield candidate: tuple
+        (yid, start, end) of the next candidate
+    """
+    if all_examples is None:
+        for candidate in ledger.pending(mid):
+            yield candidate
+        if ledger.is_exhausted(mid):
+            return
+        # Carries on the seeded order exactly where it was left, every row drawn so far is in the ledger
+        all_examples = class_examples(big_data, mid)
+        skip = all_examples.index.isin(ledger.known_rows(mid)) | all_examples['YID'].isin(logged_yids).values
+
+    for yid, start, end, row in sample_order(all_examples, seed, skip, **(order_args or {})):
+        ledger.add(mid, row, yid, start, end)
+        yield yid, start, end
+    ledger.set_exhausted(mid)
+
+
 def create_directories(textlabels, expected_dir):
     """
     Function responsible for creating the dataset directory along with each
@@ -186,12 +689,17 @@ def create_directories(textlabels, expected_dir):
             continue
 
 
-def file_cleaning(filename, num_sample, start, end, defaultdir):
+def file_cleaning(filename, num_sample, start, end, defaultdir, out_dir='', sample_rate=16000, timings=None):
     """
     This function cleans/clips teh downloaded audio clip to the specific 10s range
         that describes the clas in question. Also converts the file to .wav and
         renames it so the class datasets are more cohesive in naming convention.
 
+    All of this is done by a single ffmpeg call which only decodes the [start, end]
+        window of the download, downmixes it to mono and resamples it while
+        writing the final .wav, so the full length audio is never written out
+        or read back in.
+
     :param filename: str
         The current name of the file as given by download function
     :param num_sample: int 
@@ -202,63 +710,71 @@ def file_cleaning(filename, num_sample, start, end, defaultdir):
     :param end: int 
         End time in seconds of the class clip form raw file
     :param defaultdir: str 
-        The base directory of the full codeset, i.e '...\AudioSet',
-            this is needed to point to the ffmpeg.exe file used for conversion
+        The base directory of the full codeset, i.e '...\AudioSet', this is
+            the first place 'find_ffmpeg' looks for ffmpeg
+    :param out_dir: str
+        Directory the cleaned file is written into, defaults to the current
+            working directory
+    :param sample_rate: int
+        Samplerate the clip is resampled to, None keeps the original samplerate
+            and channels
+    :param timings: dict
+        If given the seconds spent in the ffmpeg pass and putting the clip in
+            place are added as 'transcode' and 'write'
 
 
     :return filename: str 
         The new name of the file with the numbering convention
     :return samplerate: int
-        The samplerate determined by soundfile library, is returned
-            so that it can be noted in saved example data
+        The samplerate of the saved clip, is returned so that it can be noted
+            in saved example data
 
     :save: .wav file
         Saves the recently downloaded file under a new name after clipping to
             the 10s example
     """
-    # Grabs the extension from the file name
-    extension = os.path.splitext(filename)[1]
-
-    # Renames the file with num of sample/ start and end times
-    os.rename(filename,'%s%s'%(num_sample,extension))
-
-    # Redefines new filenames
-    filename='%s%s'%(num_sample,extension)
-
-    # If the file type isnt already .wav, we want to change it to be
-    if extension not in ['.wav']:
-        xindex = filename.find(extension)
-        filename = filename[0 : xindex]
-
-        # Uses the executable ffmpeg file to run audio conversion, needs default directory
-        ff = ffmpy.FFmpeg(executable = defaultdir + '\\ffmpeg.exe',
-            global_options = ('-hide_banner -loglevel panic -nostats'),
-            inputs = {filename + extension:None},
-            outputs = {filename +'.wav':None},
-            )
-        ff.run()
-        os.remove(filename+extension)
-
-    # Uses information of the audio sample to cut it down to the 10s interval specified in metadata
-    file = filename+'.wav'
-    data, samplerate = sf.read(file)
-    totalframes = len(data)
-    totalseconds = totalframes / samplerate
-    startsec = start
-    startframe = samplerate * startsec
-    endsec = end
-    endframe = samplerate * endsec
-
-    # Writes the newly cut down file
-    os.remove(file)
-    sf.write(file, data[int(startframe):int(endframe)], samplerate)
-
-    return file, samplerate
+    file = os.path.join(out_dir, '%s.wav'%(num_sample))
+    # Converted under a temporary name, a half written clip is never left as the final file
+    temp_file = os.path.join(out_dir, '%s.part.wav'%(num_sample))
+
+    stage_start = time.monotonic()
+    # Seeking on the input means only the wanted window is ever decoded
+    stream = ffmpeg.input(filename, ss=start, t=end - start)
+    if sample_rate is None:
+        stream = ffmpeg.output(stream, temp_file, vn=None, acodec='pcm_s16le')
+    else:
+        stream = ffmpeg.output(stream, temp_file, vn=None, acodec='pcm_s16le', ac=1, ar=sample_rate)
+    try:
+        ffmpeg.run(stream, cmd=find_ffmpeg(defaultdir), quiet=True, overwrite_output=True)
+    except Exception:
+        # i.e the disk filled up, the half written clip is not left behind
+        if os.path.isfile(temp_file):
+            os.remove(temp_file)
+        raise
+    transcoded = time.monotonic()
+    os.replace(temp_file, file)
+
+    # Raw download is no longer needed, unless it has just been written over
+    if os.path.abspath(filename) != os.path.abspath(file):
+        os.remove(filename)
+
+    # Only the header is read to find the samplerate that was kept
+    if sample_rate is None:
+        sample_rate = sf.info(file).samplerate
+
+    if timings is not None:
+        timings['transcode'] = timings.get('transcode', 0) + transcoded - stage_start
+        timings['write'] = timings.get('write', 0) + time.monotonic() - transcoded
+
+    return os.path.basename(file), sample_rate
 
 ###############################################################################
 #MAIN FUNCTION
 ###############################################################################
-def main_download(defaultdir, samples_per_class, labels, textlabels, big_data, cookie_path, seed):
+def main_download(defaultdir, samples_per_class, labels, textlabels, big_data, cookie_path, seed,
+                    segment_fetch=False, segment_margin=1, probe_cache_path=None, scratch_dir=None,
+                    dedup=True, sample_rate=16000, scheduler=None, ledger=None, fetcher=None, metrics=None,
+                    ordering='permutation', prefer_known=False, budget=None):
     """
     Function that brings all things together to download all class datasets.
 
@@ -270,12 +786,49 @@ def main_download(defaultdir, samples_per_class, labels, textlabels, big_data, c
     :param textlabels: array
         Readable class labels to be downloaded, should
             line up with MIDs from labels list
-    :param big_data: Dataframe 
+    :param big_data: MetaStore, FrameIndex or Dataframe 
         Includes all examples spanning all classes
     : param cookie_path: str
         Absolute path to the cookies file being used for downloading
     :param seed: int
         Random sampling seed for reproducibility
+    :param segment_fetch: Boolean
+        Whether to only fetch the clip window with 'download_audio_segment'
+            rather than the whole video
+    :param segment_margin: float
+        Seconds of extra audio fetched either side of the clip window
+    :param probe_cache_path: str
+        Absolute path of the csv used to cache probed video durations, None
+            to always probe
+    :param scratch_dir: str
+        Absolute path of the folder raw downloads are written to before being
+            cleaned into the class folder, None to download in place
+    :param dedup: Boolean
+        Whether clips already downloaded for another class are linked in from
+            the global manifest rather than downloaded again
+    :param sample_rate: int
+        Samplerate every clip is saved at, None keeps the original
+    :param scheduler: FetchScheduler
+        Rate limits requests, retries transient failures and skips known dead
+            YIDs, None to try every candidate once with no limit
+    :param ledger: JobLedger
+        Records the state of every candidate so a resumed run only looks at
+            pending ones, None to not keep one
+    :param fetcher: YoutubeFetcher or LocalFetcher
+        Backend the clips are fetched through, None for a 'YoutubeFetcher'
+            built from the arguments above
+    :param metrics: PipelineMetrics
+        Times each stage and counts bytes and failures, reporting as it goes,
+            None to only sum up the run at the end
+    :param ordering: str
+        Order candidates are tried in, 'permutation' or 'legacy' to reproduce
+            sets downloaded before, see 'sample_order'
+    :param prefer_known: Boolean
+        Whether videos already probed or downloaded are tried first, and clips
+            known not to fit in their video are left out
+    :param budget: DiskBudget
+        Stops the run cleanly before the dataset outgrows its budget or the
+            disk, None to carry on until a write fails
 
     :save: Downloads, cleans and snips audio samples for each class given, up to
         limit of num_samples or until examples of class run out
@@ -286,87 +839,188 @@ def main_download(defaultdir, samples_per_class, labels, textlabels, big_data, c
     # Creates all needed directories if they dont already exist
     create_directories(textlabels, expected_dir)
 
-    # Start of every link that will be needed
-    slink='https://www.youtube.com/watch?v='
+    # Clips come from YouTube unless some other backend is given
+    if fetcher is None:
+        fetcher = YoutubeFetcher(cookie_path, defaultdir, segment_fetch, segment_margin)
+
+    # Keeps track of how each clip was fetched, i.e how often the segment fetch falls back
+    fetch_counts = {'segment': 0, 'fallback': 0}
+
+    # Durations of videos probed in earlier runs, these dont need probing again
+    probe_cache = load_probe_cache(probe_cache_path)
+
+    # Without a scheduler every candidate is tried exactly once, as it always was
+    if scheduler is None:
+        scheduler = FetchScheduler(max_retries=0)
+
+    # Stage times are always kept, only reported during the run if asked for
+    if metrics is None:
+        metrics = PipelineMetrics(interval=None)
+
+    # Raw downloads are kept out of the class folders until cleaned
+    if scratch_dir is not None:
+        os.makedirs(scratch_dir, exist_ok=True)
+    else:
+        scratch_dir = ''
+
+    # Global record of clips downloaded for any class, so each is fetched only once
+    manifest = None
+    if dedup:
+        manifest = ClipManifest(expected_dir)
+        if not isinstance(big_data, pd.DataFrame):
+            plan_overlap(big_data, labels)
+
+    # Videos probed or downloaded in earlier runs are tried first, if asked for
+    history = {}
+    if prefer_known:
+        history = {'lengths': probe_cache, 'prefer': [probe_cache, manifest.entries if manifest is not None else {}]}
+
+    # Set once the disk or budget has no room for another clip, the rest of the run is left
+    out_of_space = False
 
     for i in trange(len(labels)):
         # Access sub dataset folder
         os.chdir(os.getcwd() + '\\' + textlabels[i])
 
-        all_examples = big_data[big_data.eq(labels[i]).any(1)]
-        available = all_examples.shape[0]
-
         files_downloaded, num_failed = 0, 0
 
-        try: # Tries to find log of files that have been downloaded
-            class_df = pd.read_csv(textlabels[i] + '.csv')
-            # Finds how mnay files done so far for class and accounts for them in running total
-            num_files = class_df.shape[0]
-            files_downloaded += num_files
-            # Combining the dataframes and then removing duplicated based on first column
-            all_examples = pd.concat([all_examples, class_df]).drop_duplicates(subset='YID', keep=False,
-                                                                               inplace=False, ignore_index=False)
-        except Exception:
-            class_df = pd.DataFrame(columns=['YID','MID','CLASS NAME','FILE NAME',
-                        'OG FILE', 'SR'])
+        # Opens the log of files that have been downloaded, created if new
+        class_log = ClassLog(textlabels[i] + '.csv')
+        # Finds how mnay files done so far for class and accounts for them in running total
+        files_downloaded += len(class_log)
+
+        # Seeded order of the candidates not yet downloaded
+        available, candidates = class_candidates(big_data, labels[i], textlabels[i], class_log.yids, seed, ledger,
+                                                    ordering, **history)
 
         # Sets how many files we actually want to/ can extract before accounting for
         to_get = min(samples_per_class, available)
 
         if files_downloaded >= to_get:
+            class_log.close()
             os.chdir(expected_dir)
             #print('Skipping: {}'.format(labels[i]))
             continue
 
-        while True:
-            # Randomly samples the all_examples df without replacement
-            instance = all_examples.sample(1, random_state=seed)
-            all_examples = all_examples.drop(instance.index)
-
-            # If no more yids to sample
-            if all_examples.empty:
-                print(f'{files_downloaded} files downloaded for class {labels[i]}')
-                # Need to return to parent directory
-                os.chdir(expected_dir)
-                break
-
-            # Creates the youtube link used for actually downloading
-            yid = instance.iloc[0, 0]
-            link = slink + yid
-
-            # Additional meta data retrival
-            start = instance.iloc[0, 1]
-            end = instance.iloc[0, 2]
-
-            # Attempts the file download, fails return '0'
-            filename = download_audio(link, start, end, cookie_path)
-
-            # If file fails we move onto next sample
-            if filename == '0':
-                num_failed += 1
-                print('failed')
-                continue
-
-            # Track the successful download
-            files_downloaded += 1
-
-            # Cleans the file, incuding snipping, and returns the new file name, {num}.wav
-            new_filename, sr = file_cleaning(filename, files_downloaded, start, end, defaultdir)
-
-            # Save new collected files to relevent dataframe and save the dataframe
-            class_df = class_df.append({'YID': yid, 'MID': labels[i], 'CLASS NAME': textlabels[i],
-                                        'FILE NAME': new_filename, 'OG FILE':filename, 'SR':sr}, ignore_index = True)
-            class_df.to_csv(textlabels[i] + '.csv')
-
-            # Finishing conditions for downloads
-            # If no more yids to sample
-            if all_examples.empty:
-                print(f'{files_downloaded} files downloaded for class {labels[i]}')
-                # Need to return to parent directory
-                os.chdir(expected_dir)
-                break
+        for yid, start, end in candidates:
+            # Clips already downloaded for another class are linked rather than fetched again
+            entry = manifest.find(yid, start) if manifest is not None else None
+            linked = False
+            link_start = time.monotonic()
+            if entry is not None:
+                new_filename = '%s%s'%(files_downloaded + 1, os.path.splitext(entry['PATH'])[1])
+                linked = manifest.link(entry, os.path.join(os.getcwd(), new_filename))
+
+            if linked:
+                files_downloaded += 1
+                og_filename, sr = entry['OG FILE'], entry['SR']
+                metrics.add('write', time.monotonic() - link_start)
+
+            else:
+                def fetch():
+                    # Checks the clip is usable before any of the media is downloaded
+                    with metrics.time('probe'):
+                        valid, info, length, failure = fetcher.probe(yid, start, end, probe_cache.get(yid))
+                        store_probe(probe_cache_path, probe_cache, yid, length)
+                    if not valid:
+                        return None, failure
+
+                    # Attempts the file download, fails return '0'
+                    with metrics.time('fetch'):
+                        filename, offset, method = fetcher.fetch(yid, start, end, out_dir=scratch_dir, info=info)
+                    if method is not None:
+                        fetch_counts[method] = fetch_counts.get(method, 0) + 1
+                    # Start and end now have to be relative to the fetched file
+                    clip_start, clip_end = start - offset, end - offset
+
+                    # Video was there a moment ago, so the download itself went wrong
+                    if filename == '0':
+                        return None, 'network'
+                    return (filename, clip_start, clip_end), None
+
+                # Stops before a clip is fetched that there wouldnt be room for
+                if budget is not None and budget.update(fetcher=fetcher, write=tqdm.write) == 'full':
+                    out_of_space = True
+                    break
+
+                if ledger is not None:
+                    ledger.mark(labels[i], yid, 'in-flight')
+
+                # Known dead YIDs are skipped, transient failures are retried after a backoff
+                fetched, failure = scheduler.attempt(yid, fetch)
+
+                # If file fails we move onto next sample
+                if fetched is None:
+                    num_failed += 1
+                    print(f'failed ({failure})')
+                    metrics.fail(failure)
+                    metrics.maybe_report(tqdm.write)
+                    if ledger is not None:
+                        ledger.mark(labels[i], yid, 'failed', failure)
+                    continue
+                filename, clip_start, clip_end = fetched
+
+                # Track the successful download
+                files_downloaded += 1
+                num_bytes = os.path.getsize(filename)
+                og_filename = os.path.basename(filename)
+                metrics.count('bytes_fetched', num_bytes)
+                if budget is not None:
+                    budget.add_raw(num_bytes)
+
+                # Cleans the file, incuding snipping, and returns the new file name, {num}.wav
+                timings = {}
+                try:
+                    new_filename, sr = file_cleaning(filename, files_downloaded, clip_start, clip_end, defaultdir,
+                                                        sample_rate=sample_rate, timings=timings)
+                except Exception as e:
+                    if not is_disk_full(e):
+                        raise
+                    # Nothing half written is kept, the candidate is left for a run with more room
+                    files_downloaded -= 1
+                    os.remove(filename)
+                    if ledger is not None:
+                        ledger.mark(labels[i], yid, 'pending')
+                    out_of_space = True
+                    break
+                metrics.add_timings(timings)
+                clip_bytes = os.path.getsize(new_filename)
+                metrics.count('bytes_written', clip_bytes)
+                if budget is not None:
+                    budget.add_clip(clip_bytes)
+
+                if manifest is not None:
+                    manifest.add(yid, start, os.path.join(os.getcwd(), new_filename), og_filename, sr, num_bytes)
+
+            # Save new collected files to the class log, written out in batches
+            with metrics.time('log'):
+                class_log.append(yid, labels[i], textlabels[i], new_filename, og_filename, sr)
+                if ledger is not None:
+                    ledger.mark(labels[i], yid, 'done', new_filename)
+            metrics.count('clips')
+            metrics.maybe_report(tqdm.write)
 
             #If we have the correct number of samples that we need
-            elif files_downloaded >= to_get:
-                os.chdir(expected_dir)
+            if files_downloaded >= to_get:
                 break
+
+        # Either the class is full or there are no more yids to sample
+        if files_downloaded < to_get:
+            print(f'{files_downloaded} files downloaded for class {labels[i]}')
+        class_log.close()
+        # Need to return to parent directory
+        os.chdir(expected_dir)
+
+        if out_of_space:
+            print(f'Stopped at class {labels[i]}, out of disk space or budget')
+            break
+
+    if segment_fetch:
+        print(f"Segment fetches: {fetch_counts['segment']}, full download fallbacks: {fetch_counts['fallback']}")
+    if manifest is not None:
+        manifest.report()
+    print(f'Failures by kind: {scheduler.summary()}')
+    print(metrics.summary(whole_run=True))
+    metrics.export()
+    if budget is not None:
+        print(budget.summary())
@@ -0,0 +1,265 @@
+"""
+Persistent job ledger for the download loops, kept in SQLite. Every (class, YID)
+    candidate is recorded along with its place in the seeded candidate order and
+    its state:
+    - 'pending' :   Not tried yet
+    - 'in-flight' : Being fetched right now
+    - 'done' :      Downloaded and in the class log
+    - 'failed' :    Tried and failed, along with the kind of failure
+
+Candidates are added to the ledger as they are drawn from the seeded order, so
+    the order is only ever drawn once. Resuming a class is then a single indexed
+    query for its pending rows, rather than loading every example of the class,
+    removing the ones already in the class log and redrawing the order. The
+    meta-data is only gone back to if the pending rows run out before the class
+    is full.
+
+The class logs stay the source of truth for what has been downloaded. When a
+    class is resumed anything left 'in-flight' by a killed run goes back to
+    'pending', as do 'done' rows whose log line was never flushed and
+    candidates which failed for a transient reason. Permanent failures stay
+    'failed'.
+
+Runs can be split over several hosts or processes sharing a filesystem with
+    'shard_classes'. Classes are hashed into 'num_shards' shards and each run
+    only takes the classes of its own shard, so no two runs ever write to the
+    same class folder. Each shard has its own ledger file, as SQLite locking
+    cannot be trusted over network filesystems.
+"""
+
+###############################################################################
+#IMPORTS
+###############################################################################
+import os
+import zlib
+import time
+import socket
+import sqlite3
+
+from download_scheduler import permanent_failures
+
+# Failed candidates with these details are never put back to pending
+dead_states = tuple(permanent_failures) + ('dead',)
+
+
+###############################################################################
+#SHARDING
+###############################################################################
+def shard_of(mid, num_shards):
+    """
+    :param mid: str
+        The class MID
+    :param num_shards: int
+        Number of shards the classes are split into
+
+    :return shard: int
+        Shard the class belongs to, the same on every host
+    """
+    return zlib.crc32(str(mid).encode()) % num_shards
+
+
+def shard_classes(labels, textlabels, shard=0, num_shards=1):
+    """
+    Keeps only the classes belonging to one shard
+
+    :param labels: array
+        Class MIDs
+    :param textlabels: array
+        Readable class labels, lined up with the MIDs
+    :param shard: int
+        The shard of this run, from 0 to num_shards - 1
+    :param num_shards: int
+        Number of shards the classes are split into
+
+    :return labels: array
+        MIDs of the shard's classes
+    :return textlabels: array
+        Readable labels of the shard's classes
+    """
+    if not 0 <= shard < num_shards:
+        raise ValueError(f'Shard must be between 0 and {num_shards - 1}, got: {shard}')
+    keep = [shard_of(mid, num_shards) == shard for mid in labels]
+    return labels[keep], textlabels[keep]
+
+
+def ledger_path(ledger_dir, shard=0, num_shards=1):
+    """
+    :return path: str
+        Path of the ledger file of a shard
+    """
+    return os.path.join(ledger_dir, f'ledger_{shard}_of_{num_shards}.sqlite')
+
+
+###############################################################################
+#LEDGER
+###############################################################################
+class JobLedger(object):
+    """
+    SQLite backed record of every candidate of every class downloaded
+
+    :param path: str
+        Path of the ledger database, created if it does not exist
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+
+        self.conn = sqlite3.connect(path, timeout=60)
+        # Every change is its own small transaction, a full sync on each is not needed
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS classes '
+                                '(mid TEXT PRIMARY KEY, name TEXT, available INTEGER, exhausted INTEGER)')
+            # 'row' is the meta-data row of the candidate, a video can have more than one clip in a class
+            self.conn.execute('CREATE TABLE IF NOT EXISTS jobs '
+                                '(mid TEXT, rank INTEGER, row INTEGER, yid TEXT, start REAL, end REAL, state TEXT, '
+                                'detail TEXT, owner TEXT, updated REAL, PRIMARY KEY (mid, rank))')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (mid, state, rank)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS jobs_yid ON jobs (mid, yid)')
+
+    def close(self):
+        self.conn.close()
+
+    def has_class(self, mid):
+        """
+        :param mid: str
+            The class MID
+
+        :return known: Boolean
+            Whether the class has been started before
+        """
+        return self.conn.execute('SELECT 1 FROM classes WHERE mid = ?', (mid,)).fetchone() is not None
+
+    def add_class(self, mid, name, available):
+        """
+        :param mid: str
+            The class MID
+        :param name: str
+            Readable class label
+        :param available: int
+            Number of examples of the class in the meta-data
+        """
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO classes VALUES (?, ?, ?, 0)', (mid, name, available))
+
+    def available(self, mid):
+        """
+        :return available: int
+            Number of examples the class had when it was started
+        """
+        return self.conn.execute('SELECT available FROM classes WHERE mid = ?', (mid,)).fetchone()[0]
+
+    def is_exhausted(self, mid):
+        """
+        :return exhausted: Boolean
+            Whether every example of the class has been added as a candidate
+        """
+        return bool(self.conn.execute('SELECT exhausted FROM classes WHERE mid = ?', (mid,)).fetchone()[0])
+
+    def set_exhausted(self, mid):
+        with self.conn:
+            self.conn.execute('UPDATE classes SET exhausted = 1 WHERE mid = ?', (mid,))
+
+    def known_rows(self, mid):
+        """
+        :return rows: list
+            Meta-data rows of every candidate of the class already added, whatever
+                its state
+        """
+        return [r[0] for r in self.conn.execute('SELECT row FROM jobs WHERE mid = ?', (mid,))]
+
+    def add(self, mid, row, yid, start, end):
+        """
+        Adds the next candidate of a class as pending, after every earlier one
+
+        :param mid: str
+            The class MID
+        :param row: int
+            Meta-data row of the candidate
+        :param yid: str
+            YouTube ID of the candidate
+        :param start: float
+            Start of the clip in seconds
+        :param end: float
+            End of the clip in seconds
+        """
+        with self.conn:
+            rank = self.conn.execute('SELECT COALESCE(MAX(rank) + 1, 0) FROM jobs WHERE mid = ?', (mid,)).fetchone()[0]
+            self.conn.execute("INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, 'pending', NULL, NULL, ?)",
+                                (mid, rank, int(row), str(yid), float(start), float(end), time.time()))
+
+    def release(self, mid):
+        """
+        Puts every in-flight candidate of a class back to pending, i.e ones that
+            were still being fetched when the class finished or the run was killed
+        """
+        with self.conn:
+            self.conn.execute("UPDATE jobs SET state = 'pending', owner = NULL, updated = ? "
+                                "WHERE mid = ? AND state = 'in-flight'", (time.time(), mid))
+
+    def reconcile(self, mid, logged_yids):
+        """
+        Brings the ledger of a class back in line with its class log before the
+            class is resumed
+
+        :param mid: str
+            The class MID
+        :param logged_yids: set
+            YIDs in the class log
+        """
+        self.release(mid)
+        logged_yids = set(logged_yids)
+        now = time.time()
+        with self.conn:
+            # Transient failures get another go, the same as they always have on a resume
+            self.conn.execute("UPDATE jobs SET state = 'pending', detail = NULL, updated = ? "
+                                "WHERE mid = ? AND state = 'failed' AND detail NOT IN (%s)"
+                                % ', '.join('?' * len(dead_states)), (now, mid) + dead_states)
+            done = set(r[0] for r in self.conn.execute("SELECT yid FROM jobs WHERE mid = ? AND state = 'done'", (mid,)))
+            # Marked done but the log line never made it to disk
+            self.conn.executemany("UPDATE jobs SET state = 'pending', updated = ? WHERE mid = ? AND yid = ?",
+                                    [(now, mid, yid) for yid in done - logged_yids])
+            # Logged but not marked done, i.e downloaded before the ledger was used
+            self.conn.executemany("UPDATE jobs SET state = 'done', updated = ? WHERE mid = ? AND yid = ?",
+                                    [(now, mid, yid) for yid in logged_yids - done])
+
+    def pending(self, mid):
+        """
+        :param mid: str
+            The class MID
+
+        :return candidates: list
+            (yid, start, end) of every pending candidate, in order
+        """
+        return self.conn.execute("SELECT yid, start, end FROM jobs WHERE mid = ? AND state = 'pending' "
+                                    "ORDER BY rank", (mid,)).fetchall()
+
+    def mark(self, mid, yid, state, detail=None):
+        """
+        Moves a candidate to a new state, along with any other clips of the same
+            video in the class as the class log works by YID
+
+        :param mid: str
+            The class MID
+        :param yid: str
+            YouTube ID of the candidate
+        :param state: str
+            One of 'pending', 'in-flight', 'done' or 'failed'
+        :param detail: str
+            File name for done candidates, failure kind for failed ones
+        """
+        owner = self.owner if state == 'in-flight' else None
+        with self.conn:
+            self.conn.execute('UPDATE jobs SET state = ?, detail = ?, owner = ?, updated = ? '
+                                'WHERE mid = ? AND yid = ?', (state, detail, owner, time.time(), mid, str(yid)))
+
+    def counts(self, mid):
+        """
+        :param mid: str
+            The class MID
+
+        :return counts: dict
+            State -> number of candidates of the class in it
+        """
+        return dict(self.conn.execute('SELECT state, COUNT(*) FROM jobs WHERE mid = ? GROUP BY state', (mid,)))
@@ -0,0 +1,154 @@
+"""
+Append only writer for the per-class download logs, '<class>.csv'. Previously
+    every successful download appended a row to a dataframe and rewrote the
+    whole csv, making logging quadratic in the number of clips per class. Here
+    rows are buffered and appended to the end of the file in batches, so each
+    row is written exactly once.
+
+The log keeps the same layout as before, a leading index column followed by
+    YID, MID, CLASS NAME, FILE NAME, OG FILE and SR, so it can still be read
+    with pd.read_csv(path, index_col=0). Logs written by older versions, which
+    may have picked up extra 'Unnamed' columns, are appended to in their own
+    column layout.
+
+Resuming is crash safe in that the log is always the source of truth:
+    - Every flush is a single write followed by an fsync
+    - A half written last line, i.e from a crash mid flush, is cut off on load
+    - Clips that were saved but whose rows were never flushed are simply not in
+        the log, their file names get reused and so are overwritten on resume
+"""
+
+###############################################################################
+#IMPORTS
+###############################################################################
+import os
+import io
+import csv
+import pandas as pd
+
+
+###############################################################################
+#CLASS LOG
+###############################################################################
+class ClassLog(object):
+    """
+    Append only per-class download log with batched flushes
+
+    :param path: str
+        Path of the class log csv, created if it does not exist
+    :param flush_every: int
+        Number of rows buffered before they are written to disk
+    """
+    columns = ['YID', 'MID', 'CLASS NAME', 'FILE NAME', 'OG FILE', 'SR']
+
+    def __init__(self, path, flush_every=10):
+        self.path = path
+        self.flush_every = flush_every
+        self.rows = []
+        self.buffer = []
+
+        if os.path.isfile(path):
+            self.header = self.load()
+        else:
+            # Leading blank column is the index, as written by DataFrame.to_csv
+            self.header = [''] + self.columns
+            with open(path, 'w', newline='') as f:
+                csv.writer(f).writerow(self.header)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def load(self):
+        """
+        Reads the rows already in the log, cutting off any partial last line
+
+        :return header: list
+            Column names of the existing log
+        """
+        with open(self.path, 'rb') as f:
+            data = f.read()
+
+        # Anything after the last newline was never completely written
+        complete = data.rfind(b'\n') + 1
+        if complete != len(data):
+            with open(self.path, 'r+b') as f:
+                f.truncate(complete)
+            data = data[:complete]
+
+        reader = csv.reader(io.StringIO(data.decode('utf-8'), newline=''))
+        header = next(reader)
+        for line in reader:
+            if len(line) == len(header):
+                self.rows.append(dict(zip(header, line)))
+
+        return header
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def yids(self):
+        """
+        :return yids: set
+            Every YID in the log, including rows not yet flushed
+        """
+        return set(row['YID'] for row in self.rows)
+
+    def append(self, yid, mid, class_name, file_name, og_file, sr):
+        """
+        Adds a row to the log, it is written once the buffer is full
+
+        :param yid: str
+            YouTube ID of the downloaded clip
+        :param mid: str
+            Class MID
+        :param class_name: str
+            Readable class name
+        :param file_name: str
+            Name of the saved clip in the class folder
+        :param og_file: str
+            Name of the file as it was downloaded
+        :param sr: int
+            Samplerate of the saved clip
+        """
+        row = dict(zip(self.columns, [yid, mid, class_name, file_name, og_file, sr]))
+        # Index column carries on from the rows already logged
+        row[''] = len(self.rows)
+        self.rows.append(row)
+        self.buffer.append([row.get(col, '') for col in self.header])
+
+        if len(self.buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """
+        Appends all buffered rows to the log in a single write
+        """
+        if not self.buffer:
+            return
+
+        lines = io.StringIO(newline='')
+        csv.writer(lines).writerows(self.buffer)
+        with open(self.path, 'a', newline='') as f:
+            f.write(lines.getvalue())
+            f.flush()
+            os.fsync(f.fileno())
+        self.buffer = []
+
+    def close(self):
+        """
+        Flushes anything left in the buffer
+        """
+        self.flush()
+
+    def frame(self):
+        """
+        :return class_df: dataframe
+            All logged rows with the standard log columns
+        """
+        return pd.DataFrame(self.rows, columns=self.columns)
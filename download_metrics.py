@@ -0,0 +1,278 @@
+"""
+Lightweight instrumentation of the download pipeline, showing where the time of
+    a run goes. Every clip passes through these stages, each of which is timed:
+    - 'probe' :     Resolving the video and checking the clip is usable
+    - 'fetch' :     Downloading the media
+    - 'transcode' : The ffmpeg pass which trims, downmixes and resamples the clip,
+        trimming is part of the same pass so is not timed on its own
+    - 'write' :     Renaming, moving or linking the clip into its class folder
+    - 'log' :       Writing the class log and ledger
+
+Bytes downloaded, bytes of finished clips, clips saved and failed candidates by
+    cause are counted alongside.
+
+'probe' and 'fetch' are waiting on the network, 'transcode' on the CPU and
+    'write' and 'log' on the disk. Whichever takes the largest share of the
+    stage time is what the run is bound by, given in both the on-screen summary
+    and the exported snapshot.
+
+The summary covers a rolling window of the last few minutes, so it shows how the
+    run is going now rather than on average. Snapshots of the totals are
+    written as JSON and in the Prometheus textfile format(as read by the
+    node_exporter textfile collector), both renamed into place so a reader never
+    sees half a file.
+
+Stage times can be recorded from any thread. Work done in other processes is
+    timed there and handed back as a dict of stage -> seconds, see 'add_timings'.
+"""
+
+###############################################################################
+#IMPORTS
+###############################################################################
+import os
+import json
+import time
+import threading
+
+from collections import deque
+from contextlib import contextmanager
+
+# Stages in pipeline order
+stages = ['probe', 'fetch', 'transcode', 'write', 'log']
+
+# What each stage is waiting on
+stage_resources = {'probe': 'network', 'fetch': 'network', 'transcode': 'cpu', 'write': 'disk', 'log': 'disk'}
+
+
+###############################################################################
+#METRICS
+###############################################################################
+class PipelineMetrics(object):
+    """
+    Thread safe stage timers and counters for a download run
+
+    :param json_path: str
+        Path the JSON snapshot is written to, None to not write one
+    :param prometheus_path: str
+        Path the Prometheus textfile snapshot is written to, None to not write one
+    :param interval: float
+        Seconds between rolling summaries and snapshots, see 'maybe_report',
+            None to never report during the run
+    :param window: float
+        Seconds of recent history the rolling summary covers
+    :param clock: function
+        Returns the current time in seconds
+    """
+    def __init__(self, json_path=None, prometheus_path=None, interval=30, window=300, clock=time.monotonic):
+        self.json_path = json_path
+        self.prometheus_path = prometheus_path
+        self.interval = interval
+        self.window = window
+        self.clock = clock
+        self.lock = threading.Lock()
+
+        self.started = clock()
+        self.last_report = self.started
+        self.stage_seconds = {stage: 0.0 for stage in stages}
+        self.stage_counts = {stage: 0 for stage in stages}
+        self.counters = {'clips': 0, 'bytes_fetched': 0, 'bytes_written': 0}
+        self.failures = {}
+        # (time, stage or counter, amount) of everything inside the rolling window
+        self.recent = deque()
+
+    def add(self, stage, seconds):
+        """
+        :param stage: str
+            One of 'stages'
+        :param seconds: float
+            Time the stage took
+        """
+        with self.lock:
+            self.stage_seconds[stage] += seconds
+            self.stage_counts[stage] += 1
+            self.remember(stage, seconds)
+
+    def add_timings(self, timings):
+        """
+        :param timings: dict
+            Stage -> seconds, as timed in a worker
+        """
+        for stage, seconds in timings.items():
+            self.add(stage, seconds)
+
+    @contextmanager
+    def time(self, stage):
+        """
+        Times the body of a with statement as a stage
+
+        :param stage: str
+            One of 'stages'
+        """
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.add(stage, self.clock() - start)
+
+    def count(self, counter, amount=1):
+        """
+        :param counter: str
+            One of 'clips', 'bytes_fetched' or 'bytes_written'
+        :param amount: int
+            Amount to add
+        """
+        with self.lock:
+            self.counters[counter] += amount
+            self.remember(counter, amount)
+
+    def fail(self, kind):
+        """
+        :param kind: str
+            Failure kind of a candidate that was given up on
+        """
+        with self.lock:
+            self.failures[kind] = self.failures.get(kind, 0) + 1
+            self.remember('failed', 1)
+
+    def remember(self, name, amount):
+        # Caller holds the lock
+        now = self.clock()
+        self.recent.append((now, name, amount))
+        while self.recent and self.recent[0][0] < now - self.window:
+            self.recent.popleft()
+
+    def bound_by(self, stage_seconds):
+        """
+        :param stage_seconds: dict
+            Stage -> seconds
+
+        :return resource: str
+            'network', 'cpu' or 'disk', whichever took the most time, None if
+                nothing has been timed
+        :return share: float
+            Fraction of the stage time it took
+        """
+        totals = {}
+        for stage, seconds in stage_seconds.items():
+            totals[stage_resources[stage]] = totals.get(stage_resources[stage], 0) + seconds
+        total = sum(totals.values())
+        if total <= 0:
+            return None, 0.0
+        resource = max(totals, key=totals.get)
+        return resource, totals[resource] / total
+
+    def snapshot(self):
+        """
+        :return snapshot: dict
+            Totals of every stage, counter and failure kind since the start
+        """
+        with self.lock:
+            elapsed = max(self.clock() - self.started, 1e-9)
+            stage_seconds = dict(self.stage_seconds)
+            snapshot = {
+                'timestamp': time.time(),
+                'elapsed_seconds': elapsed,
+                'stages': {stage: {'count': self.stage_counts[stage], 'seconds': stage_seconds[stage],
+                                    'mean_seconds': stage_seconds[stage] / max(self.stage_counts[stage], 1)}
+                            for stage in stages},
+                'counters': dict(self.counters),
+                'failures': dict(self.failures),
+                'clips_per_second': self.counters['clips'] / elapsed,
+            }
+        snapshot['bound_by'], snapshot['bound_share'] = self.bound_by(stage_seconds)
+        return snapshot
+
+    def summary(self, whole_run=False):
+        """
+        :param whole_run: Boolean
+            Whether to sum up the whole run rather than the rolling window
+
+        :return text: str
+            One line summary
+        """
+        with self.lock:
+            elapsed = self.clock() - self.started
+            if whole_run:
+                span = max(elapsed, 1e-9)
+                totals = dict(self.stage_seconds, **self.counters)
+                counts = dict(self.stage_counts)
+                totals['failed'] = sum(self.failures.values())
+            else:
+                span = max(min(elapsed, self.window), 1e-9)
+                totals, counts = {}, {}
+                for _, name, amount in self.recent:
+                    totals[name] = totals.get(name, 0) + amount
+                    counts[name] = counts.get(name, 0) + 1
+
+        stage_seconds = {stage: totals.get(stage, 0.0) for stage in stages}
+        parts = [f'{stage} {stage_seconds[stage] / max(counts.get(stage, 0), 1):.2f}s' for stage in stages]
+        parts.append(f"{totals.get('clips', 0) / span:.2f} clips/s")
+        parts.append(f"{totals.get('bytes_fetched', 0) / span / 1e6:.2f} MB/s fetched")
+        parts.append(f"{totals.get('failed', 0)} failed")
+        resource, share = self.bound_by(stage_seconds)
+        if resource is not None:
+            parts.append(f'{resource}-bound ({share:.0%} of stage time)')
+        return ('Whole run: ' if whole_run else f'Last {span:.0f}s: ') + ' | '.join(parts)
+
+    def write_json(self, path, snapshot):
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(snapshot, f, indent=2)
+        os.replace(temp_path, path)
+
+    def write_prometheus(self, path, snapshot):
+        lines = ['# HELP audioset_stage_seconds_total Time spent in each pipeline stage',
+                    '# TYPE audioset_stage_seconds_total counter']
+        lines += [f'audioset_stage_seconds_total{{stage="{stage}"}} {s["seconds"]:.6f}'
+                    for stage, s in snapshot['stages'].items()]
+        lines += ['# HELP audioset_stage_runs_total Times each pipeline stage has run',
+                    '# TYPE audioset_stage_runs_total counter']
+        lines += [f'audioset_stage_runs_total{{stage="{stage}"}} {s["count"]}'
+                    for stage, s in snapshot['stages'].items()]
+        for counter, value in snapshot['counters'].items():
+            lines += [f'# TYPE audioset_{counter}_total counter', f'audioset_{counter}_total {value}']
+        lines += ['# HELP audioset_failures_total Candidates given up on by failure kind',
+                    '# TYPE audioset_failures_total counter']
+        lines += [f'audioset_failures_total{{kind="{kind}"}} {count}'
+                    for kind, count in sorted(snapshot['failures'].items())]
+        lines += ['# TYPE audioset_elapsed_seconds gauge', f'audioset_elapsed_seconds {snapshot["elapsed_seconds"]:.3f}']
+
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, path)
+
+    def export(self):
+        """
+        Writes the snapshot files that are set
+
+        :return snapshot: dict
+            The snapshot written
+        """
+        snapshot = self.snapshot()
+        if self.json_path is not None:
+            self.write_json(self.json_path, snapshot)
+        if self.prometheus_path is not None:
+            self.write_prometheus(self.prometheus_path, snapshot)
+        return snapshot
+
+    def maybe_report(self, write=print):
+        """
+        Prints the rolling summary and exports a snapshot, at most once every
+            'interval' seconds, so can be called as often as convenient. Stage
+            times are noted as each stage ends, so the mean per clip of a slow
+            stage only shows once it has finished
+
+        :param write: function
+            Prints a line, i.e tqdm.write so progress bars are not broken up
+
+        :return reported: Boolean
+            Whether anything was done
+        """
+        now = self.clock()
+        if self.interval is None or now - self.last_report < self.interval:
+            return False
+        self.last_report = now
+        write(self.summary())
+        self.export()
+        return True
@@ -0,0 +1,248 @@
+"""
+Cross-class planning of downloads. AudioSet clips are multi-label, so the same
+    YouTube ID is often a candidate for several of the suitable classes and would
+    otherwise be downloaded, converted and stored once per class.
+
+Here every clip that is fetched is recorded once in a global manifest,
+    'AudioSet_Data/manifest.csv', keyed on (YID, start). When a later class draws
+    a clip that is already in the manifest, the existing file is hardlinked into
+    the new class folder(copied if the filesystem cannot link) instead of being
+    downloaded again. The candidate order of each class is unchanged, so the
+    resulting dataset is the same as without de-duplication.
+
+Before a run 'plan_overlap' reports how many candidates are shared between the
+    classes being downloaded, and at the end the manifest reports the number of
+    clips linked along with the bandwidth and disk space saved.
+
+If no manifest exists yet, i.e for datasets downloaded before this was added, it
+    is bootstrapped from the class logs already in 'AudioSet_Data'. AudioSet only
+    has one segment per YID so these entries are matched on YID alone.
+
+Manifest rows are written as soon as a clip is saved but class logs are flushed
+    in batches, so after a crash the manifest can list clips whose log rows were
+    lost. Their file names are reused by the resumed run, so on loading only the
+    entries whose file is still logged against the same YID are kept.
+"""
+
+###############################################################################
+#IMPORTS
+###############################################################################
+import os
+import csv
+import shutil
+import numpy as np
+
+from download_log import ClassLog
+
+
+###############################################################################
+#FUNCTIONS
+###############################################################################
+def plan_overlap(big_data, labels):
+    """
+    Counts how many candidate examples are shared between the classes being
+        downloaded, an upper bound on what de-duplication can save
+
+    :param big_data: MetaStore or FrameIndex
+        All meta-data as loaded by 'get_data'
+    :param labels: array
+        Class MIDs being downloaded
+
+    :return num_candidates: int
+        Total candidates summed over every class
+    :return num_shared: int
+        Candidates which also appear in at least one other of the classes
+    """
+    rows = [big_data.rows_for(mid) for mid in labels]
+    if len(rows) == 0:
+        return 0, 0
+
+    all_rows = np.concatenate(rows)
+    _, counts = np.unique(all_rows, return_counts=True)
+    num_shared = int(counts[counts > 1].sum())
+
+    print(f'{len(all_rows)} candidates over {len(labels)} classes, {num_shared} of which are '
+            f'shared between classes and only need downloading once')
+    return len(all_rows), num_shared
+
+
+def format_bytes(num_bytes):
+    """
+    :param num_bytes: float
+        Number of bytes
+
+    :return text: str
+        Human readable size
+    """
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(num_bytes) < 1024:
+            return f'{num_bytes:.1f}{unit}'
+        num_bytes /= 1024
+    return f'{num_bytes:.1f}TB'
+
+
+###############################################################################
+#CLIP MANIFEST
+###############################################################################
+class ClipManifest(object):
+    """
+    Global append only record of every clip downloaded, across all classes
+
+    :param data_dir: str
+        Path of the 'AudioSet_Data' folder
+    """
+    columns = ['YID', 'START', 'PATH', 'OG FILE', 'SR', 'BYTES']
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.path = os.path.join(data_dir, 'manifest.csv')
+        self.entries = {}
+
+        # Savings made over this run
+        self.num_linked = 0
+        self.bandwidth_saved = 0
+        self.disk_saved = 0
+
+        if os.path.isfile(self.path):
+            self.load()
+        else:
+            self.bootstrap()
+
+    def load(self):
+        """
+        Reads the existing manifest, cutting off any partially written last line
+        """
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        complete = data.rfind(b'\n') + 1
+        if complete != len(data):
+            with open(self.path, 'r+b') as f:
+                f.truncate(complete)
+
+        with open(self.path, newline='') as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            for line in reader:
+                if len(line) == len(header):
+                    self.entries[line[0]] = dict(zip(header, line))
+
+        # Entries not backed by their class log point at files which may since hold another clip
+        logged = {}
+        for yid, entry in list(self.entries.items()):
+            folder, file_name = os.path.split(entry['PATH'])
+            if folder not in logged:
+                log_path = os.path.join(self.data_dir, folder, folder + '.csv')
+                logged[folder] = {}
+                if os.path.isfile(log_path):
+                    logged[folder] = {row['FILE NAME']: row['YID'] for row in ClassLog(log_path).rows}
+            if logged[folder].get(file_name) != yid:
+                del self.entries[yid]
+
+    def bootstrap(self):
+        """
+        Creates the manifest from the class logs of an existing dataset
+        """
+        rows = []
+        for folder in sorted(os.listdir(self.data_dir)):
+            log_path = os.path.join(self.data_dir, folder, folder + '.csv')
+            if not os.path.isfile(log_path):
+                continue
+            for row in ClassLog(log_path).rows:
+                if row['YID'] in self.entries:
+                    continue
+                entry = {'YID': row['YID'], 'START': '', 'PATH': os.path.join(folder, row['FILE NAME']),
+                            'OG FILE': row['OG FILE'], 'SR': row['SR'], 'BYTES': ''}
+                self.entries[row['YID']] = entry
+                rows.append([entry[col] for col in self.columns])
+
+        with open(self.path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(self.columns)
+            writer.writerows(rows)
+
+    def find(self, yid, start):
+        """
+        Looks for an already downloaded copy of a clip
+
+        :param yid: str
+            YouTube ID of the clip
+        :param start: float
+            Start time of the clip in seconds
+
+        :return entry: dict
+            The manifest entry, None if the clip has not been downloaded or its
+                file has since gone missing
+        """
+        entry = self.entries.get(yid)
+        if entry is None:
+            return None
+        # Entries bootstrapped from class logs have no start and match on YID
+        if entry['START'] != '' and float(entry['START']) != float(start):
+            return None
+        if not os.path.isfile(os.path.join(self.data_dir, entry['PATH'])):
+            return None
+        return entry
+
+    def add(self, yid, start, path, og_file, sr, num_bytes):
+        """
+        Records a newly downloaded clip
+
+        :param yid: str
+            YouTube ID of the clip
+        :param start: float
+            Start time of the clip in seconds
+        :param path: str
+            Path of the saved clip
+        :param og_file: str
+            Name of the file as it was downloaded
+        :param sr: int
+            Samplerate of the saved clip
+        :param num_bytes: int
+            Size of the raw download, used to report bandwidth saved
+        """
+        entry = {'YID': yid, 'START': start, 'PATH': os.path.relpath(path, self.data_dir),
+                    'OG FILE': og_file, 'SR': sr, 'BYTES': num_bytes}
+        self.entries[yid] = entry
+        with open(self.path, 'a', newline='') as f:
+            csv.writer(f).writerow([entry[col] for col in self.columns])
+
+    def link(self, entry, dst):
+        """
+        Hardlinks an already downloaded clip to a new location, copying it if
+            the filesystem does not support links
+
+        :param entry: dict
+            Manifest entry as returned by 'find'
+        :param dst: str
+            Path the clip should appear at
+
+        :return linked: Boolean
+            Whether the clip is now at the destination
+        """
+        src = os.path.join(self.data_dir, entry['PATH'])
+        if os.path.exists(dst):
+            # Already there, i.e the entry is the clip being linked on a resumed run
+            if os.path.isfile(src) and os.path.samefile(src, dst):
+                return True
+            os.remove(dst)
+
+        try:
+            os.link(src, dst)
+            self.disk_saved += os.path.getsize(src)
+        except OSError:
+            try:
+                shutil.copy2(src, dst)
+            except OSError:
+                return False
+
+        self.num_linked += 1
+        if entry['BYTES'] != '':
+            self.bandwidth_saved += int(entry['BYTES'])
+        return True
+
+    def report(self):
+        """
+        Prints what de-duplication has saved over this run
+        """
+        print(f'{self.num_linked} clips reused from other classes instead of downloading, saving '
+                f'{format_bytes(self.bandwidth_saved)} of bandwidth and {format_bytes(self.disk_saved)} of disk')
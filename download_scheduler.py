@@ -0,0 +1,317 @@
+"""
+Failure handling for the download loops. Previously every failed candidate was
+    treated the same, just counted and skipped, so a run being throttled by
+    YouTube would burn through its candidates and a resumed run would try all
+    of the same dead videos again.
+
+Failures are now sorted into kinds by 'classify_failure':
+    - 'throttled' :   Too many requests, everything should slow down
+    - 'network' :     Timeouts, dropped connections and server errors
+    - 'unavailable' : Private, removed, blocked or terminated videos
+    - 'restricted' :  Videos needing a sign in, i.e age restricted
+    - 'invalid' :     Clips that can never be used, bad times or too short
+    - 'other' :       Anything not recognised
+
+'unavailable', 'restricted' and 'invalid' are permanent and never retried. The
+    YIDs that are 'unavailable' or 'restricted' are kept in a persistent dead
+    cache(a csv in the meta-data folder) and are never requested again,
+    including by later runs. 'invalid' is down to the times of one clip, so other
+    clips of the same video are still tried, their lengths coming from the probe
+    cache without another request.
+
+The rest are transient. 'FetchScheduler' retries these for the same candidate
+    after a backoff which grows with each consecutive failure of that kind,
+    throttling pausing all requests rather than just the one. All requests also
+    pass through a token bucket so YouTube is never asked for more than a set
+    rate.
+
+The scheduler only ever sees a fetch function returning (result, failure), so it
+    can be tested against a fake fetcher, with the clock and sleep swapped out.
+"""
+
+###############################################################################
+#IMPORTS
+###############################################################################
+import os
+import time
+import threading
+
+
+###############################################################################
+#FAILURE TAXONOMY
+###############################################################################
+# Failure kinds which mean a clip can never be downloaded
+permanent_failures = ['unavailable', 'restricted', 'invalid']
+
+# Permanent failure kinds which hold for every clip of the video, kept in the dead cache
+dead_failures = ['unavailable', 'restricted']
+
+# Default (first wait, longest wait) in seconds of the backoff for each transient kind
+default_backoff = {'throttled': (30, 600), 'network': (2, 60), 'other': (1, 30)}
+
+# Lower case pieces of youtube_dl error messages for each kind, checked in order
+failure_messages = [
+    ('throttled', ['429', 'too many requests', 'rate limit']),
+    ('restricted', ['sign in to confirm', 'age-restricted', 'age restricted', 'inappropriate for some users',
+                        'members-only', 'join this channel']),
+    ('unavailable', ['video unavailable', 'private video', 'this video is private', 'has been removed',
+                        'no longer available', 'account associated', 'copyright', 'not available in your country',
+                        'blocked it', 'does not exist', 'http error 404', 'http error 410']),
+    ('network', ['timed out', 'timeout', 'connection', 'network is unreachable', 'temporary failure',
+                    'name resolution', 'http error 5', 'remote end closed', 'ssl', 'eof occurred', 'reset by peer']),
+]
+
+
+def classify_failure(error):
+    """
+    Sorts a failure into one of the kinds listed in the module docstring
+
+    :param error: Exception or str
+        The exception raised by youtube_dl, or its message
+
+    :return kind: str
+        The failure kind
+    """
+    message = str(error).lower()
+    for kind, pieces in failure_messages:
+        if any(piece in message for piece in pieces):
+            return kind
+
+    # Socket level errors dont always have a helpful message
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return 'network'
+    return 'other'
+
+
+def is_permanent(kind):
+    """
+    :param kind: str
+        The failure kind
+
+    :return permanent: Boolean
+        Whether the clip should never be tried again
+    """
+    return kind in permanent_failures
+
+
+###############################################################################
+#RATE LIMITING
+###############################################################################
+class TokenBucket(object):
+    """
+    Thread safe token bucket, tokens refill at a steady rate up to a burst size
+
+    :param rate: float
+        Tokens added per second, None or 0 for no limit
+    :param burst: int
+        Most tokens that can be saved up
+    :param clock: function
+        Returns the current time in seconds
+    :param sleep: function
+        Sleeps for a number of seconds
+    """
+    def __init__(self, rate, burst=1, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.burst
+        self.last = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Takes a token, waiting for one to be added if there are none. The token
+            is reserved straight away, so waiting threads are served in turn
+        """
+        if not self.rate:
+            return
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            self.sleep(wait)
+
+
+###############################################################################
+#DEAD YID CACHE
+###############################################################################
+def load_dead_cache(cache_path):
+    """
+    Loads the YIDs already known to be permanently unavailable
+
+    :param cache_path: str
+        Path to the dead cache csv, None disables the cache
+
+    :return dead: dict
+        YID -> failure kind
+    """
+    dead = {}
+    if cache_path is None or not os.path.isfile(cache_path):
+        return dead
+
+    with open(cache_path) as f:
+        for line in f:
+            # A killed run can leave a half written last line, which is skipped
+            parts = line.rstrip('\n').split(',')
+            # Caches written before 'invalid' was left out of them can still list it
+            if len(parts) == 2 and parts[1] in dead_failures:
+                dead[parts[0]] = parts[1]
+
+    return dead
+
+
+###############################################################################
+#SCHEDULER
+###############################################################################
+class FetchScheduler(object):
+    """
+    Decides when requests are made and whether failed candidates are retried
+
+    :param dead_cache_path: str
+        Path to the dead YID cache csv, None to not keep one
+    :param rate: float
+        Most requests per second, None or 0 for no limit
+    :param burst: int
+        Requests that can be made at once after a quiet spell
+    :param max_retries: int
+        Times a candidate is retried after transient failures
+    :param backoff: dict
+        Failure kind -> (first wait, longest wait) in seconds, missing kinds
+            use 'default_backoff'
+    :param clock: function
+        Returns the current time in seconds
+    :param sleep: function
+        Sleeps for a number of seconds
+    """
+    def __init__(self, dead_cache_path=None, rate=None, burst=1, max_retries=3, backoff=None,
+                    clock=time.monotonic, sleep=time.sleep):
+        self.dead_cache_path = dead_cache_path
+        self.dead = load_dead_cache(dead_cache_path)
+        self.max_retries = max_retries
+        self.backoff = dict(default_backoff)
+        self.backoff.update(backoff or {})
+        self.clock = clock
+        self.sleep = sleep
+        self.bucket = TokenBucket(rate, burst, clock, sleep)
+
+        # Consecutive failures of each kind, reset by any success
+        self.streaks = {}
+        # No request is made before this time, set by throttling
+        self.paused_until = 0
+        self.failures = {}
+        self.lock = threading.Lock()
+
+    def is_dead(self, yid):
+        """
+        :param yid: str
+            YouTube ID of the candidate
+
+        :return dead: Boolean
+            Whether the video is known to be permanently unavailable
+        """
+        return yid in self.dead
+
+    def wait(self):
+        """
+        Blocks until the next request is allowed to be made
+        """
+        while True:
+            with self.lock:
+                pause = self.paused_until - self.clock()
+            if pause <= 0:
+                break
+            self.sleep(pause)
+        self.bucket.acquire()
+
+    def backoff_time(self, kind):
+        """
+        :param kind: str
+            A transient failure kind
+
+        :return wait: float
+            Seconds to wait given the current streak of that kind
+        """
+        first, longest = self.backoff.get(kind, self.backoff['other'])
+        return min(first * 2 ** (self.streaks.get(kind, 1) - 1), longest)
+
+    def record(self, yid, kind):
+        """
+        Records the outcome of a request
+
+        :param yid: str
+            YouTube ID of the candidate
+        :param kind: str
+            The failure kind, None for a success
+
+        :return retry_after: float
+            Seconds to wait before retrying the candidate, None if it should not
+                be retried
+        """
+        with self.lock:
+            if kind is None:
+                self.streaks = {}
+                return None
+
+            self.failures[kind] = self.failures.get(kind, 0) + 1
+
+            if is_permanent(kind):
+                if kind in dead_failures and yid not in self.dead:
+                    self.dead[yid] = kind
+                    if self.dead_cache_path is not None:
+                        with open(self.dead_cache_path, 'a') as f:
+                            f.write(f'{yid},{kind}\n')
+                return None
+
+            self.streaks[kind] = self.streaks.get(kind, 0) + 1
+            wait = self.backoff_time(kind)
+            # Throttling is about us not the video, so everything holds off
+            if kind == 'throttled':
+                self.paused_until = max(self.paused_until, self.clock() + wait)
+            return wait
+
+    def attempt(self, yid, fetch):
+        """
+        Runs a fetch for a candidate under the rate limit, retrying it after
+            transient failures
+
+        :param yid: str
+            YouTube ID of the candidate
+        :param fetch: function
+            Takes no arguments and returns (result, failure kind), the kind being
+                None on success
+
+        :return result: object
+            What the fetch returned, None if it failed
+        :return kind: str
+            Failure kind of the last attempt, 'dead' if the YID was already known
+                to be unavailable, None on success
+        """
+        if self.is_dead(yid):
+            return None, 'dead'
+
+        for attempt in range(self.max_retries + 1):
+            self.wait()
+            result, kind = fetch()
+            retry_after = self.record(yid, kind)
+            if kind is None:
+                return result, None
+            if retry_after is None or attempt == self.max_retries:
+                return None, kind
+            # Throttling waits are already covered by the pause in 'wait'
+            if kind != 'throttled':
+                self.sleep(retry_after)
+
+        return None, kind
+
+    def summary(self):
+        """
+        :return text: str
+            Counts of each failure kind seen so far
+        """
+        if not self.failures:
+            return 'No failures'
+        return ', '.join(f'{kind}: {count}' for kind, count in sorted(self.failures.items()))
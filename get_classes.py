@@ -11,6 +11,8 @@ REQUIRES:
             - qa_true_counts.csv : Estimated quality of classes from Google's testing
 
 OUTPUTS:
+    - 'class_table.csv' in the 'MetaData' folder, a cached join of the above files
+        which is rebuilt if any of them change
     - A numpy loadable file which contains a 2D array with the classes from
         AudioSet that meet requirements, the first dimension is the mID and
         second dimension is the readable name of class
@@ -33,59 +35,116 @@ import matplotlib.pyplot as plt
 ###############################################################################
 #FUNCTIONS
 ###############################################################################
-def suitable_class_extractor(quality, path_to_meta, leaf=True):
+def class_table_is_current(path_to_meta, table_path):
     """
-    Function to extract suitable classes from the AudioSet ontology based on 
-        some requirements
+    Checks whether the cached class table is newer than all of the files it
+        was built from
 
-    :param qual: float 
-        Minimum quality threshold for considered classes, between 0 and 1
-    :param leafs: Boolean 
-        Whether or not to only consider leaf nodes of AudioSet hierarchy
+    :param path_to_meta: str
+        The directory path to the meta data folder
+    :param table_path: str
+        Path of the cached class table
 
-    :return len(suitabe): int
-        Number of suitable classes found from ontology
-    :return suitable: array
-        2D array with mIDs along with legible class names (suitable_classes.npy)
+    :return current: Boolean
+        True if the cached table can be used as is
     """
+    if not os.path.isfile(table_path):
+        return False
+    table_time = os.path.getmtime(table_path)
+    sources = ['labels.xlsx', 'ontology.json', 'qa_true_counts.csv']
+    return all(os.path.getmtime(os.path.join(path_to_meta, file)) <= table_time for file in sources)
+
 
+def build_class_table(path_to_meta):
+    """
+    Joins the ontology, mid to name conversions and quality estimates into a
+        single table with one row per ontology class, in ontology order
+
+    :param path_to_meta: str
+        The directory path to the meta data folder
+
+    :return class_table: dataframe
+        Columns mid, name, is_leaf, blacklist and rate(NaN if the class has no
+            quality estimate)
+    """
     # Read in mid to label conversion table
-    label_convert = pd.read_excel(path_to_meta + '\labels.xlsx', index_col=0)
+    label_convert = pd.read_excel(os.path.join(path_to_meta, 'labels.xlsx'), index_col=0)
 
     # Read in ontology stored in json file
-    with open(path_to_meta + '/ontology.json') as f:
+    with open(os.path.join(path_to_meta, 'ontology.json')) as f:
         ontology = json.load(f)
 
     # Read in quality estimates for classes
-    quality_estimates = pd.read_csv(path_to_meta + '/qa_true_counts.csv')
+    quality_estimates = pd.read_csv(os.path.join(path_to_meta, 'qa_true_counts.csv'))
     quality_estimates['rate'] = quality_estimates['num_true'] / quality_estimates['num_rated']
 
-    # Stores the suitable classes to extract in 2D, [mid, label_name]
-    suitable = []
-    for i, val in enumerate(ontology):
-        example = ontology[i]
+    class_table = pd.DataFrame({
+        'mid': [example['id'] for example in ontology],
+        'is_leaf': [len(example['child_ids']) == 0 for example in ontology],
+        'blacklist': [example['restrictions'] == ['blacklist'] for example in ontology]})
 
-        # Checks if leaf node or not
-        if leaf:
-            if len(example['child_ids']) > 0:
-                continue
+    # Joins are done on mid as lookups, keeping ontology order
+    names = label_convert.drop_duplicates('mid').set_index('mid')['display_name']
+    rates = quality_estimates.drop_duplicates('label_id').set_index('label_id')['rate']
+    class_table.insert(1, 'name', class_table['mid'].map(names))
+    class_table['rate'] = class_table['mid'].map(rates)
 
-        if example['restrictions'] == ['blacklist']:
-            continue
+    return class_table
 
-        mid = example['id']
-        sub_df = quality_estimates.loc[quality_estimates['label_id'] == mid]
 
-        # Some classes do not seem to exist outside of the ontology and so skip
-        if sub_df.empty:
-            continue
+def load_class_table(path_to_meta, table_name='class_table.csv'):
+    """
+    Loads the joined class table, building and caching it to the meta-data
+        folder first if it is missing or older than its sources
+
+    :param path_to_meta: str
+        The directory path to the meta data folder
+    :param table_name: str
+        Name of the cached table within the meta data folder
+
+    :return class_table: dataframe
+        See 'build_class_table'
+    """
+    table_path = os.path.join(path_to_meta, table_name)
+
+    if class_table_is_current(path_to_meta, table_path):
+        return pd.read_csv(table_path)
 
-        # Make sure that quality threshold is reached
-        if (sub_df['rate'].item() >= quality):
-            sub_label = label_convert.loc[label_convert['mid'] == mid]
-            mid_name = sub_label['display_name'].item()
-            # If both requirements satisfied we save class by name and MID
-            suitable.append([mid, mid_name])
+    class_table = build_class_table(path_to_meta)
+    class_table.to_csv(table_path, index=False)
+    return class_table
+
+
+def suitable_class_extractor(quality, path_to_meta, leaf=True, class_table=None):
+    """
+    Function to extract suitable classes from the AudioSet ontology based on 
+        some requirements
+
+    :param qual: float 
+        Minimum quality threshold for considered classes, between 0 and 1
+    :param leafs: Boolean 
+        Whether or not to only consider leaf nodes of AudioSet hierarchy
+    :param class_table: dataframe
+        Already loaded class table, loaded from the meta data folder if None
+
+    :return len(suitabe): int
+        Number of suitable classes found from ontology
+    :return suitable: array
+        2D array with mIDs along with legible class names (suitable_classes.npy)
+    """
+    if class_table is None:
+        class_table = load_class_table(path_to_meta)
+
+    # Blacklisted classes are never used, classes without a quality estimate
+    #   do not seem to exist outside of the ontology and drop out as NaN
+    mask = (~class_table['blacklist']) & (class_table['rate'] >= quality)
+
+    # Checks if leaf node or not
+    if leaf:
+        mask &= class_table['is_leaf']
+
+    # Stores the suitable classes to extract in 2D, [mid, label_name]
+    suitable = class_table.loc[mask, ['mid', 'name']].values.tolist()
 
     return len(suitable), suitable
 
@@ -99,11 +158,12 @@ def graphing(path_to_meta):
         Graph of how number of suitbale classes scale with estimated
             quality threshold
     """
-    # Deals with data collection
+    # Deals with data collection, the class table is only loaded once for the sweep
+    class_table = load_class_table(path_to_meta)
     numbers_of_classes = []
     thresholds = np.arange(0, 1.05, 0.05)
     for i in thresholds:
-        nums, classes = suitable_class_extractor(i, path_to_meta, True)
+        nums, classes = suitable_class_extractor(i, path_to_meta, True, class_table)
         numbers_of_classes.append(nums)
 
     # Takes data and plots/saves
@@ -4,7 +4,8 @@ Main file for obtaining the meta data needed for downloading classes of interest
     in the expected order of execution.
 
 The outputs of this file are the following:
-    -> 'big_data.csv': a dataframe which contains meta data for all classes
+    -> 'big_data_store': a compiled, memory-mappable store which contains meta
+        data for all classes, see meta_store.py
     -> 'suitable_classes.npy': a numpy save file containing the selected class 
         IDs along with their human named counterparts
 """
@@ -16,7 +17,7 @@ import os
 import yaml
 
 from pathlib import Path
-from compile_data import compile_dataframes
+from meta_store import load_meta_store
 from get_classes import main_get_classes, suitable_class_extractor, graphing
 
 ##############################################################################
@@ -35,16 +36,9 @@ if __name__== '__main__':
     path_to_meta = os.path.join(defaultdir, params['dir']['meta_folder'])
 
 
-    # Looks for the 'big_data.csv' file - if not already made, will be created
-    main_df = os.path.join(path_to_meta,'big_data.csv')
-    main_df = Path(main_df)
-
-    if main_df.is_file():
-        pass
-    else:
-        print('Compiling meta-data files ..... This takes a fair few minutes, time for a coffee?')
-        compile_dataframes(path_to_meta)
-        print("The large joint dataframe 'big_data.csv' has been created")
+    # Looks for the meta-data store - if not already made or out of date, will be created
+    store = load_meta_store(path_to_meta)
+    print(f'Meta-data store loaded with {len(store)} examples')
 
 
     # This fucntion is contained within 'get_classes.py'
@@ -0,0 +1,388 @@
+"""
+Compiled, column based store of all of the segment meta-data. This replaces
+    re-parsing the ~2M row 'big_data.csv' on every download run with a folder
+    of .npy arrays which are memory-mapped on load, meaning opening the store
+    takes a fraction of a second no matter its size.
+
+Along with the columns themselves(YID, start, end and the labels of every
+    example) the store holds an inverted index from each MID to the rows it
+    appears in, so finding all examples of a class never has to scan the table.
+
+Frames of examples loaded from csv, such as a previously downloaded set, can
+    be given the same index with 'FrameIndex'. Both support multi-label queries
+    through 'query', e.g all examples with MID A but not B:
+        store.query(include=['/m/A'], exclude=['/m/B'])
+
+The store records the size and modification time of the segment csv files it
+    was built from and is rebuilt automatically by 'load_meta_store' if any of
+    them change.
+
+Store layout (within MetaData/big_data_store):
+    - yid.npy :          YouTube IDs, fixed width bytes
+    - start.npy :        Start time of each clip in seconds
+    - end.npy :          End time of each clip in seconds
+    - mids.npy :         Every unique MID, position in array is its id
+    - label_indptr.npy : CSR row pointers into label_ids
+    - label_ids.npy :    MID ids of every row, concatenated
+    - mid_indptr.npy :   CSR pointers into mid_rows for each MID id
+    - mid_rows.npy :     Row ids of every MID, concatenated and sorted
+    - manifest.json :    Source file stats the store was built from
+"""
+
+###############################################################################
+#IMPORTS
+###############################################################################
+import os
+import abc
+import json
+import time
+import warnings
+import numpy as np
+import pandas as pd
+
+from compile_data import segment_files, read_segment_chunks
+
+warnings.simplefilter(action='ignore', category=FutureWarning)
+
+# Bumped whenever the layout of the store changes so old stores get rebuilt
+store_version = 1
+
+
+###############################################################################
+#FUNCTIONS
+###############################################################################
+def source_stats(path_to_meta):
+    """
+    Collects the size and modification time of every segment csv available,
+        used to tell whether a built store is out of date
+
+    :param path_to_meta: str
+        The directory path to the meta data folder
+
+    :return stats: dict
+        File name -> [size in bytes, modification time]
+    """
+    stats = {}
+    for file in segment_files:
+        path = os.path.join(path_to_meta, file)
+        if os.path.isfile(path):
+            stats[file] = [os.path.getsize(path), os.path.getmtime(path)]
+    return stats
+
+
+def store_is_current(path_to_meta, store_dir):
+    """
+    Checks whether the store exists and was built from the current csv files
+
+    :param path_to_meta: str
+        The directory path to the meta data folder
+    :param store_dir: str
+        The directory path of the store
+
+    :return current: Boolean
+        True if the store can be loaded as is
+    """
+    try:
+        with open(os.path.join(store_dir, 'manifest.json')) as f:
+            manifest = json.load(f)
+    except Exception:
+        return False
+
+    return (manifest.get('version') == store_version and
+            manifest.get('sources') == source_stats(path_to_meta))
+
+
+def build_meta_store(path_to_meta, store_dir, chunk_rows=100000):
+    """
+    Streams all available segment csv files and writes the column arrays and
+        MID inverted index that make up the store
+
+    :param path_to_meta: str
+        The directory path to the meta data folder
+    :param store_dir: str
+        The directory path of the store, created if needed
+    :param chunk_rows: int
+        Number of csv rows parsed at a time
+
+    :save: store
+        All of the arrays listed in the module docstring
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    sources = source_stats(path_to_meta)
+
+    yids, starts, ends, label_rows, label_mids = [], [], [], [], []
+    for file, chunk in read_segment_chunks(path_to_meta, chunk_rows):
+        yids.append(chunk[0].values.astype('S11'))
+        starts.append(chunk[1].values)
+        ends.append(chunk[2].values)
+
+        # Stacking gives the labels in row order with the empty cells dropped,
+        #   the chunk index already runs across all files
+        stacked = chunk.iloc[:, 3:].stack()
+        stacked = stacked[stacked != '']
+        label_rows.append(stacked.index.get_level_values(0).values)
+        label_mids.append(stacked.values.astype(str))
+
+    yid = np.concatenate(yids)
+    start = np.concatenate(starts)
+    end = np.concatenate(ends)
+
+    label_rows = np.concatenate(label_rows).astype(np.int64)
+    label_codes, mids = pd.factorize(np.concatenate(label_mids), sort=True)
+    label_codes = label_codes.astype(np.int32)
+
+    # Row major CSR, labels of each row
+    label_indptr = np.zeros(len(yid) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(label_rows, minlength=len(yid)), out=label_indptr[1:])
+
+    # MID major CSR, rows of each label. A stable sort keeps rows ascending per MID
+    order = np.argsort(label_codes, kind='stable')
+    mid_rows = label_rows[order]
+    mid_indptr = np.zeros(len(mids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(label_codes, minlength=len(mids)), out=mid_indptr[1:])
+
+    np.save(os.path.join(store_dir, 'yid.npy'), yid)
+    np.save(os.path.join(store_dir, 'start.npy'), start)
+    np.save(os.path.join(store_dir, 'end.npy'), end)
+    np.save(os.path.join(store_dir, 'mids.npy'), np.asarray(mids, dtype=str))
+    np.save(os.path.join(store_dir, 'label_indptr.npy'), label_indptr)
+    np.save(os.path.join(store_dir, 'label_ids.npy'), label_codes)
+    np.save(os.path.join(store_dir, 'mid_indptr.npy'), mid_indptr)
+    np.save(os.path.join(store_dir, 'mid_rows.npy'), mid_rows)
+
+    # Manifest is written last, a half built store is never seen as current
+    with open(os.path.join(store_dir, 'manifest.json'), 'w') as f:
+        json.dump({'version': store_version, 'sources': sources, 'num_rows': len(yid)}, f)
+
+
+class LabelQuery(abc.ABC):
+    """
+    Shared multi-label query logic. Subclasses provide 'rows_for', returning
+        the ascending unique row ids of a MID, and 'frame', turning row ids into
+        a dataframe of examples. Every query then only ever touches the row
+        lists of the MIDs involved, never the full table.
+    """
+    @abc.abstractmethod
+    def rows_for(self, mid):
+        """
+        :param mid: str
+            The class MID
+
+        :return rows: array
+            Ascending unique row ids of the examples labelled with it
+        """
+
+    @abc.abstractmethod
+    def frame(self, rows):
+        """
+        :param rows: array
+            Row ids of the examples wanted
+
+        :return examples: dataframe
+            YID, start, end and labels of each of the rows
+        """
+
+    def query(self, include, exclude=(), match='any'):
+        """
+        Finds the rows labelled with some combination of MIDs
+
+        :param include: list
+            MIDs that examples should be labelled with
+        :param exclude: list
+            MIDs that examples must not be labelled with
+        :param match: str
+            'any' for examples with at least one of the include MIDs, 'all' for
+                examples with every one of them
+
+        :return rows: array
+            Ascending row ids of the matching examples
+        """
+        if match not in ['any', 'all']:
+            raise ValueError(f"Query match must be 'any' or 'all', got: {match}")
+
+        rows = None
+        for mid in include:
+            mid_rows = self.rows_for(mid)
+            if rows is None:
+                rows = mid_rows
+            elif match == 'any':
+                rows = np.union1d(rows, mid_rows)
+            else:
+                rows = np.intersect1d(rows, mid_rows, assume_unique=True)
+
+        if rows is None:
+            return np.zeros(0, dtype=np.int64)
+
+        for mid in exclude:
+            rows = np.setdiff1d(rows, self.rows_for(mid), assume_unique=True)
+
+        return rows
+
+    def examples(self, mid, exclude=()):
+        """
+        Gets all examples of a class
+
+        :param mid: str
+            The class MID
+        :param exclude: list
+            MIDs that examples must not also be labelled with
+
+        :return examples: dataframe
+            All examples labelled with the MID, indexed by row id
+        """
+        if len(exclude) == 0:
+            return self.frame(self.rows_for(mid))
+        return self.frame(self.query([mid], exclude))
+
+
+class MetaStore(LabelQuery):
+    """
+    Read only view over a built store, every array is memory-mapped so only
+        the rows actually asked for are ever read from disk
+
+    :param store_dir: str
+        The directory path of the store
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        load = lambda name: np.load(os.path.join(store_dir, name + '.npy'), mmap_mode='r')
+
+        self.yid = load('yid')
+        self.start = load('start')
+        self.end = load('end')
+        self.label_indptr = load('label_indptr')
+        self.label_ids = load('label_ids')
+        self.mid_indptr = load('mid_indptr')
+        self.mid_rows = load('mid_rows')
+
+        # Vocabulary is tiny so is kept in memory as a lookup
+        self.mids = np.load(os.path.join(store_dir, 'mids.npy'))
+        self.mid_lookup = {mid: i for i, mid in enumerate(self.mids)}
+
+    def __len__(self):
+        return self.yid.shape[0]
+
+    def rows_for(self, mid):
+        """
+        Gets the row ids of every example labelled with the MID
+
+        :param mid: str
+            The class MID
+
+        :return rows: array
+            Ascending row ids, empty if the MID is not in the store
+        """
+        if mid not in self.mid_lookup:
+            return np.zeros(0, dtype=np.int64)
+        code = self.mid_lookup[mid]
+        return np.asarray(self.mid_rows[self.mid_indptr[code]:self.mid_indptr[code + 1]])
+
+    def labels_for(self, row):
+        """
+        Gets the MIDs of a single row
+
+        :param row: int
+            Row id of the example
+
+        :return labels: list
+            All MIDs the example is labelled with
+        """
+        codes = self.label_ids[self.label_indptr[row]:self.label_indptr[row + 1]]
+        return [self.mids[c] for c in codes]
+
+    def frame(self, rows):
+        """
+        Builds a dataframe of the given rows in the same column layout that
+            'big_data.csv' is loaded with, i.e YID, start and end first
+
+        :param rows: array
+            Row ids to include
+
+        :return examples: dataframe
+            One row per example, indexed by row id
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        return pd.DataFrame({'YID': np.char.decode(np.asarray(self.yid[rows]), 'ascii'),
+                                '1': np.asarray(self.start[rows]),
+                                '2': np.asarray(self.end[rows])}, index=rows)
+
+
+class FrameIndex(LabelQuery):
+    """
+    Label index over an in memory dataframe of examples, i.e a csv of a
+        previously downloaded set. The label columns are scanned once up front
+        instead of the whole frame being compared for every class.
+
+    :param big_data: dataframe
+        Examples with YID, start and end as the first three columns and the
+            labels in any columns after
+    """
+    def __init__(self, big_data):
+        self.big_data = big_data
+
+        # Every non empty label cell along with the position of its row
+        labels = big_data.iloc[:, 3:]
+        labels.columns = range(labels.shape[1])
+        labels.index = range(labels.shape[0])
+        stacked = labels.stack().astype(str).str.strip(' "')
+        stacked = stacked[stacked != '']
+
+        positions = stacked.index.get_level_values(0).values.astype(np.int64)
+        codes, mids = pd.factorize(stacked.values, sort=True)
+
+        # Rows are grouped by MID, kept ascending and with any repeats removed
+        order = np.lexsort((positions, codes))
+        positions, codes = positions[order], codes[order]
+        bounds = np.searchsorted(codes, np.arange(len(mids) + 1))
+        self.mid_rows = {mid: np.unique(positions[bounds[i]:bounds[i + 1]]) for i, mid in enumerate(mids)}
+
+    def __len__(self):
+        return self.big_data.shape[0]
+
+    def rows_for(self, mid):
+        """
+        Gets the row positions of every example labelled with the MID
+
+        :param mid: str
+            The class MID
+
+        :return rows: array
+            Ascending row positions, empty if the MID is not in the frame
+        """
+        return self.mid_rows.get(mid, np.zeros(0, dtype=np.int64))
+
+    def frame(self, rows):
+        """
+        Gets the given rows of the original dataframe
+
+        :param rows: array
+            Row positions to include
+
+        :return examples: dataframe
+            The rows, keeping the original index
+        """
+        return self.big_data.iloc[np.asarray(rows, dtype=np.int64)]
+
+
+def load_meta_store(path_to_meta, store_name='big_data_store'):
+    """
+    Loads the meta-data store, building or rebuilding it first if it is
+        missing or the segment csv files have changed since it was built
+
+    :param path_to_meta: str
+        The directory path to the meta data folder
+    :param store_name: str
+        Name of the store folder within the meta data folder
+
+    :return store: MetaStore
+        The loaded store
+    """
+    store_dir = os.path.join(path_to_meta, store_name)
+
+    if not store_is_current(path_to_meta, store_dir):
+        print('Building meta-data store from segment csv files .....')
+        start_time = time.time()
+        build_meta_store(path_to_meta, store_dir)
+        print(f'Meta-data store built in {time.time() - start_time:.1f}s')
+
+    return MetaStore(store_dir)
@@ -0,0 +1,568 @@
+"""
+This script is the concurrent counterpart to 'main_download' in
+    download_functions.py. Rather than blocking on one YouTube ID at a time, a
+    bounded pool of workers(threads or processes) fetch and clean candidates
+    from a shared queue while the main thread alone renames the finished clips
+    and writes the per-class csv logs.
+
+Reproducibility is kept by drawing candidates in exactly the same seeded order
+    as the single threaded loop and committing finished downloads strictly in
+    that order. Downloads that complete out of order are held back until every
+    earlier candidate has resolved, so the final set of YIDs for a class is the
+    first n successes of the seeded order, the same as the sequential version
+    (minus the usual network exceptions).
+
+Each candidate is downloaded into its own folder inside a scratch directory so
+    that concurrent downloads never see each others files.
+
+REQUIRES:
+    - Same as download_functions.py
+    - A writable scratch folder, set in 'control.yaml'
+
+OUTPUTS:
+    - Same folders and class logs as download_functions.py
+"""
+
+###############################################################################
+#IMPORTS
+###############################################################################
+import os
+import time
+import shutil
+import pandas as pd
+from tqdm import tqdm, trange
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures import wait, FIRST_COMPLETED
+
+from download_functions import YoutubeFetcher
+from download_functions import create_directories, file_cleaning, load_probe_cache, store_probe
+from download_functions import class_candidates
+from download_log import ClassLog
+from download_planner import ClipManifest, plan_overlap
+from download_scheduler import FetchScheduler
+from download_metrics import PipelineMetrics
+from download_budget import is_disk_full
+
+
+###############################################################################
+#FUNCTIONS
+###############################################################################
+def fetch_raw(fetcher, yid, start, end, scratch_dir, length=None):
+    """
+    Network half of a candidate, checks and downloads it into its own scratch
+        folder without cleaning it
+
+    :param fetcher: YoutubeFetcher or LocalFetcher
+        Backend the clip is fetched through
+    :param yid: str
+        YouTube ID of the candidate
+    :param start: float
+        Start time in seconds of the class clip
+    :param end: float
+        End time in seconds of the class clip
+    :param scratch_dir: str
+        Parent scratch directory, each candidate gets a sub-folder here
+    :param length: float
+        Cached duration of the video, None if it has to be probed
+
+    :return result: dict
+        Same as 'fetch_candidate', with 'path' always None. If the fetch worked
+            the 'raw' download is given along with the 'clip' (start, end)
+            relative to it
+    """
+    result = {'path': None, 'og_file': None, 'sr': None, 'method': None, 'length': length, 'bytes': 0,
+                'failure': None, 'timings': {}, 'raw': None, 'clip': None}
+    # Timed here rather than in the main thread's metrics, which a worker process cant reach
+    timings = result['timings']
+    stage_start = time.monotonic()
+    # Checks the clip is usable before any of the media is downloaded
+    valid, info, result['length'], result['failure'] = fetcher.probe(yid, start, end, length)
+    timings['probe'] = time.monotonic() - stage_start
+    if not valid:
+        return result
+
+    work_dir = os.path.join(scratch_dir, yid)
+    # Partial files left over from a killed run are cleared out first
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+
+    stage_start = time.monotonic()
+    filename, offset, result['method'] = fetcher.fetch(yid, start, end, out_dir=work_dir, info=info)
+    timings['fetch'] = time.monotonic() - stage_start
+
+    if filename == '0':
+        shutil.rmtree(work_dir, ignore_errors=True)
+        result['failure'] = 'network'
+        return result
+
+    result['raw'] = filename
+    result['clip'] = (start - offset, end - offset)
+    result['bytes'] = os.path.getsize(filename)
+    return result
+
+
+def clean_raw(result, yid, defaultdir, sample_rate=16000):
+    """
+    CPU half of a candidate, cleans the raw download given by 'fetch_raw' in
+        its scratch folder. Kept at module level so it can be pickled by a
+        process pool.
+
+    :param result: dict
+        As given by 'fetch_raw' for a fetch that worked
+    :param yid: str
+        YouTube ID of the candidate
+    :param defaultdir: str
+        The base directory of the full codeset, used to find ffmpeg
+    :param sample_rate: int
+        Samplerate the clip is saved at, None keeps the original
+
+    :return result: dict
+        The same result with the 'path' to the cleaned .wav filled in, or the
+            'failure' if it could not be cleaned, 'disk_full' if there was no
+            room to write it
+    """
+    filename = result['raw']
+    work_dir = os.path.dirname(filename)
+    start, end = result['clip']
+    try:
+        new_filename, result['sr'] = file_cleaning(filename, yid, start, end, defaultdir, out_dir=work_dir,
+                                                    sample_rate=sample_rate, timings=result['timings'])
+    except Exception as e:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        result['failure'] = 'disk_full' if is_disk_full(e) else 'other'
+        return result
+
+    result['path'] = os.path.join(work_dir, new_filename)
+    result['og_file'] = os.path.basename(filename)
+    return result
+
+
+def fetch_candidate(fetcher, yid, start, end, defaultdir, scratch_dir, length=None, sample_rate=16000):
+    """
+    Worker function which checks, downloads and cleans a single candidate
+        inside its own scratch folder. Kept at module level so it can be
+        pickled by a process pool.
+
+    :param fetcher: YoutubeFetcher or LocalFetcher
+        Backend the clip is fetched through
+    :param yid: str
+        YouTube ID of the candidate
+    :param start: float
+        Start time in seconds of the class clip
+    :param end: float
+        End time in seconds of the class clip
+    :param defaultdir: str
+        The base directory of the full codeset, used to find ffmpeg
+    :param scratch_dir: str
+        Parent scratch directory, each candidate gets a sub-folder here
+    :param length: float
+        Cached duration of the video, None if it has to be probed
+    :param sample_rate: int
+        Samplerate the clip is saved at, None keeps the original
+
+    :return result: dict
+        'path' to the cleaned .wav(None if anything failed), 'og_file' name as
+            downloaded, 'sr' samplerate, fetch 'method', probed 'length' and
+            'bytes' size of the raw download, along with the kind of 'failure'
+            if the clip could not be fetched and the seconds each stage took as
+            'timings'
+    """
+    result = fetch_raw(fetcher, yid, start, end, scratch_dir, length)
+    if result['raw'] is None:
+        return result
+    return clean_raw(result, yid, defaultdir, sample_rate)
+
+
+def discard_result(future):
+    """
+    Done callback for jobs which are no longer needed, removes their scratch
+        folder once the worker has finished with it
+
+    :param future: Future
+        The finished fetch job
+    """
+    try:
+        path = future.result()['path']
+    except Exception:
+        return
+    if path is not None:
+        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+
+def get_executor(mode, workers):
+    """
+    Creates the worker pool used for the whole run
+
+    :param mode: str
+        Either 'thread' or 'process'
+    :param workers: int
+        Number of concurrent fetch workers
+
+    :return executor: Executor
+        The concurrent.futures pool
+    """
+    if mode == 'thread':
+        return ThreadPoolExecutor(max_workers=workers)
+    elif mode == 'process':
+        return ProcessPoolExecutor(max_workers=workers)
+    else:
+        raise ValueError(f"Parallel mode must be 'thread' or 'process', got: {mode}")
+
+
+###############################################################################
+#MAIN FUNCTION
+###############################################################################
+def main_download_parallel(defaultdir, samples_per_class, labels, textlabels, big_data,
+                            cookie_path, seed, workers, mode, scratch_dir,
+                            segment_fetch=False, segment_margin=1, probe_cache_path=None, dedup=True,
+                            sample_rate=16000, scheduler=None, ledger=None, fetcher=None, metrics=None,
+                            ordering='permutation', prefer_known=False, budget=None):
+    """
+    Concurrent version of 'main_download'. Takes the same arguments plus the
+        worker pool setup.
+
+    :param samples_per_class: int
+        How many samples to attempt to download per class label given
+    :param labels: array
+         Class labels to be downloaded, this list is the MIDs
+    :param textlabels: array
+        Readable class labels to be downloaded, should line up with MIDs
+    :param big_data: MetaStore, FrameIndex or Dataframe
+        Includes all examples spanning all classes
+    :param cookie_path: str
+        Absolute path to the cookies file being used for downloading
+    :param seed: int
+        Random sampling seed for reproducibility
+    :param workers: int
+        Number of concurrent fetch workers
+    :param mode: str
+        Either 'thread' or 'process' based workers
+    :param scratch_dir: str
+        Directory used for in progress downloads
+    :param segment_fetch: Boolean
+        Whether to only fetch the clip window with 'download_audio_segment'
+    :param segment_margin: float
+        Seconds of extra audio fetched either side of the clip window
+    :param probe_cache_path: str
+        Absolute path of the csv used to cache probed video durations, None
+            to always probe
+    :param dedup: Boolean
+        Whether clips already downloaded for another class are linked in from
+            the global manifest rather than downloaded again
+    :param sample_rate: int
+        Samplerate every clip is saved at, None keeps the original
+    :param scheduler: FetchScheduler
+        Rate limits requests, retries transient failures and skips known dead
+            YIDs, None to try every candidate once with no limit
+    :param ledger: JobLedger
+        Records the state of every candidate so a resumed run only looks at
+            pending ones, None to not keep one
+    :param fetcher: YoutubeFetcher or LocalFetcher
+        Backend the clips are fetched through, None for a 'YoutubeFetcher'
+            built from the arguments above
+    :param metrics: PipelineMetrics
+        Times each stage and counts bytes and failures, reporting as it goes,
+            None to only sum up the run at the end
+    :param ordering: str
+        Order candidates are tried in, 'permutation' or 'legacy' to reproduce
+            sets downloaded before, see 'sample_order'
+    :param prefer_known: Boolean
+        Whether videos already probed or downloaded are tried first, and clips
+            known not to fit in their video are left out
+    :param budget: DiskBudget
+        Holds back fetches when the scratch space is short and stops the run
+            cleanly before the dataset outgrows its budget or the disk, None to
+            carry on until a write fails
+
+    :save: Downloads, cleans and snips audio samples for each class given, up to
+        limit of num_samples or until examples of class run out
+    """
+    # Same directory layout as the single threaded version
+    expected_dir = defaultdir + '\\AudioSet_Data'
+    create_directories(textlabels, expected_dir)
+    data_dir = os.path.join(defaultdir, 'AudioSet_Data')
+
+    os.makedirs(scratch_dir, exist_ok=True)
+
+    run_start = time.time()
+    run_downloaded, run_failed = 0, 0
+    fetch_counts = {'segment': 0, 'fallback': 0}
+    if fetcher is None:
+        fetcher = YoutubeFetcher(cookie_path, defaultdir, segment_fetch, segment_margin)
+    # Only the main thread touches the cache, workers are just handed the duration
+    probe_cache = load_probe_cache(probe_cache_path)
+
+    # Only the main thread talks to the scheduler, requests are paced as they are submitted
+    if scheduler is None:
+        scheduler = FetchScheduler(max_retries=0)
+
+    # Workers time their own stages, the main thread adds them in along with its own
+    if metrics is None:
+        metrics = PipelineMetrics(interval=None)
+
+    # Global record of clips downloaded for any class, so each is fetched only once
+    manifest = None
+    if dedup:
+        manifest = ClipManifest(data_dir)
+        if not isinstance(big_data, pd.DataFrame):
+            plan_overlap(big_data, labels)
+
+    # Videos probed or downloaded in earlier runs are tried first, if asked for
+    history = {}
+    if prefer_known:
+        history = {'lengths': probe_cache, 'prefer': [probe_cache, manifest.entries if manifest is not None else {}]}
+
+    # Set once the disk or budget has no room for another clip, the rest of the run is left
+    out_of_space = False
+
+    with get_executor(mode, workers) as executor:
+        for i in trange(len(labels)):
+            class_dir = os.path.join(data_dir, textlabels[i])
+            log_path = os.path.join(class_dir, textlabels[i] + '.csv')
+
+            files_downloaded, num_failed = 0, 0
+
+            # Opens the log of files that have been downloaded, created if new
+            class_log = ClassLog(log_path)
+            files_downloaded += len(class_log)
+
+            # Same seeded order of the candidates not yet downloaded as the single threaded loop
+            available, candidates = class_candidates(big_data, labels[i], textlabels[i], class_log.yids, seed,
+                                                        ledger, ordering, **history)
+
+            to_get = min(samples_per_class, available)
+            if files_downloaded >= to_get:
+                class_log.close()
+                continue
+            already_had = files_downloaded
+
+            # rank -> future for submitted jobs, rank -> result for finished ones
+            in_flight, finished = {}, {}
+            # rank -> (time it can be retried, candidate) for transient failures
+            retries, attempts = {}, {}
+            # rank -> scratch space held by the fetch
+            held = {}
+            next_submit, next_commit = 0, 0
+            exhausted = False
+
+            def room_to_fetch():
+                # Never more than the workers, fewer when the disk, budget or scratch space runs short
+                if out_of_space:
+                    return False
+                return len(in_flight) < workers and (budget is None or budget.can_fetch(len(in_flight)))
+
+            class_start = time.time()
+            class_bar = tqdm(total=to_get, initial=files_downloaded, desc=str(textlabels[i]), leave=False)
+
+            while files_downloaded < to_get:
+                # Keeps the pool full, but never asks for more than could still be needed
+                ok_waiting = sum(1 for r, _, _ in finished.values() if r['path'] or r.get('entry'))
+
+                if budget is not None:
+                    # With no room for another clip, whatever is out is let finish then the run stops
+                    if budget.update(ok_waiting + len(in_flight) + len(retries), fetcher,
+                                        tqdm.write) == 'full' and not in_flight:
+                        out_of_space = True
+                        break
+
+                # Retries whose backoff is over go back out first, they keep their place in the order
+                now = time.time()
+                for rank in sorted(r for r in retries if retries[r][0] <= now):
+                    if not room_to_fetch():
+                        break
+                    _, yid, start, end = retries.pop(rank)
+                    if budget is not None:
+                        held[rank] = budget.hold_scratch()
+                    scheduler.wait()
+                    future = executor.submit(fetch_candidate, fetcher, yid, start, end, defaultdir,
+                                                scratch_dir, probe_cache.get(yid), sample_rate)
+                    in_flight[rank] = (yid, start, end, future)
+
+                while (not exhausted and room_to_fetch() and
+                        files_downloaded + ok_waiting + len(in_flight) + len(retries) < to_get):
+                    try:
+                        yid, start, end = next(candidates)
+                    except StopIteration:
+                        exhausted = True
+                        break
+
+                    # Clips already downloaded for another class skip the workers entirely
+                    entry = manifest.find(yid, start) if manifest is not None else None
+                    if entry is not None:
+                        finished[next_submit] = ({'path': None, 'entry': entry, 'end': end}, yid, start)
+                    # Known dead YIDs fail straight away without a request
+                    elif scheduler.is_dead(yid):
+                        finished[next_submit] = ({'path': None, 'failure': 'dead'}, yid, start)
+                    else:
+                        if ledger is not None:
+                            ledger.mark(labels[i], yid, 'in-flight')
+                        if budget is not None:
+                            held[next_submit] = budget.hold_scratch()
+                        scheduler.wait()
+                        future = executor.submit(fetch_candidate, fetcher, yid, start, end, defaultdir,
+                                                    scratch_dir, probe_cache.get(yid), sample_rate)
+                        in_flight[next_submit] = (yid, start, end, future)
+                    next_submit += 1
+
+                if not in_flight and (out_of_space or (not retries and next_commit == next_submit)):
+                    break
+
+                done = []
+                if in_flight:
+                    # Wakes up in time for the next retry even if nothing finishes
+                    timeout = None
+                    if retries:
+                        timeout = max(min(r[0] for r in retries.values()) - time.time(), 0)
+                    done, _ = wait([f for _, _, _, f in in_flight.values()], timeout=timeout,
+                                    return_when=FIRST_COMPLETED)
+                elif retries:
+                    time.sleep(max(min(r[0] for r in retries.values()) - time.time(), 0))
+
+                for rank in [r for r, (_, _, _, f) in in_flight.items() if f in done]:
+                    yid, start, end, future = in_flight.pop(rank)
+                    try:
+                        result = future.result()
+                    except Exception:
+                        result = {'path': None, 'method': None, 'length': None, 'failure': 'other'}
+
+                    store_probe(probe_cache_path, probe_cache, yid, result['length'])
+                    # Every attempt counts towards the stage times, retried or not
+                    metrics.add_timings(result.get('timings', {}))
+                    metrics.count('bytes_fetched', result.get('bytes', 0))
+                    if budget is not None:
+                        budget.release_scratch(held.pop(rank, 0))
+                        budget.add_raw(result.get('bytes', 0))
+
+                    # No room to clean it, the candidate is left for a run with more space
+                    if result['failure'] == 'disk_full':
+                        if ledger is not None:
+                            ledger.mark(labels[i], yid, 'pending')
+                        out_of_space = True
+                        continue
+
+                    # Transient failures are tried again later instead of moving on
+                    retry_after = scheduler.record(yid, result['failure'])
+                    if retry_after is not None and attempts.get(rank, 0) < scheduler.max_retries:
+                        attempts[rank] = attempts.get(rank, 0) + 1
+                        if result['failure'] == 'throttled':
+                            retry_after = 0
+                        retries[rank] = (time.time() + retry_after, yid, start, end)
+                        continue
+
+                    finished[rank] = (result, yid, start)
+                    if result['method'] is not None:
+                        fetch_counts[result['method']] = fetch_counts.get(result['method'], 0) + 1
+
+                # Commits finished results strictly in candidate order
+                while next_commit in finished:
+                    result, yid, start = finished.pop(next_commit)
+                    path, entry = result['path'], result.get('entry')
+                    next_commit += 1
+
+                    if path is None and entry is None:
+                        num_failed += 1
+                        metrics.fail(result['failure'])
+                        if ledger is not None:
+                            ledger.mark(labels[i], yid, 'failed', result['failure'])
+                        continue
+
+                    if files_downloaded >= to_get:
+                        if path is not None:
+                            shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+                        continue
+
+                    write_start = time.monotonic()
+                    if entry is not None:
+                        # Already downloaded for another class, linked in rather than fetched
+                        new_filename = '%s%s'%(files_downloaded + 1, os.path.splitext(entry['PATH'])[1])
+                        if not manifest.link(entry, os.path.join(class_dir, new_filename)):
+                            # Fetched instead like the single threaded loop, keeping its place in the order
+                            next_commit -= 1
+                            retries[next_commit] = (time.time(), yid, start, result['end'])
+                            if ledger is not None:
+                                ledger.mark(labels[i], yid, 'in-flight')
+                            break
+                        og_file, sr = entry['OG FILE'], entry['SR']
+                    else:
+                        new_filename = '%s%s'%(files_downloaded + 1, os.path.splitext(path)[1])
+                        clip_bytes = os.path.getsize(path)
+                        try:
+                            shutil.move(path, os.path.join(class_dir, new_filename))
+                        except Exception as e:
+                            if not is_disk_full(e):
+                                raise
+                            # Copying off a scratch disk can stop part way, nothing half written is kept
+                            if os.path.isfile(os.path.join(class_dir, new_filename)):
+                                os.remove(os.path.join(class_dir, new_filename))
+                            shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+                            if ledger is not None:
+                                ledger.mark(labels[i], yid, 'pending')
+                            out_of_space = True
+                            break
+                        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+                        metrics.count('bytes_written', clip_bytes)
+                        if budget is not None:
+                            budget.add_clip(clip_bytes)
+                        og_file, sr = result['og_file'], result['sr']
+                        if manifest is not None:
+                            manifest.add(yid, start, os.path.join(class_dir, new_filename), og_file, sr,
+                                            result['bytes'])
+
+                    metrics.add('write', time.monotonic() - write_start)
+
+                    files_downloaded += 1
+                    with metrics.time('log'):
+                        class_log.append(yid, labels[i], textlabels[i], new_filename, og_file, sr)
+                        if ledger is not None:
+                            ledger.mark(labels[i], yid, 'done', new_filename)
+                    metrics.count('clips')
+
+                    class_bar.update(1)
+                    class_bar.set_postfix(failed=num_failed,
+                        rate=f'{(files_downloaded - already_had) / (time.time() - class_start):.2f} clips/s')
+
+                metrics.maybe_report(tqdm.write)
+
+                # Once out of space whatever is still out is let finish and committed before stopping
+                if out_of_space and not in_flight:
+                    break
+                if exhausted and not in_flight and not retries and next_commit == next_submit:
+                    break
+
+            # Anything still out is no longer needed, clean up once it lands
+            for yid, start, end, future in in_flight.values():
+                if not future.cancel():
+                    future.add_done_callback(discard_result)
+            for result, _, _ in finished.values():
+                if result['path'] is not None:
+                    shutil.rmtree(os.path.dirname(result['path']), ignore_errors=True)
+            if budget is not None:
+                for rank in list(held):
+                    budget.release_scratch(held.pop(rank))
+
+            class_log.close()
+            # Candidates fetched but not needed are left for a later run
+            if ledger is not None:
+                ledger.release(labels[i])
+            class_bar.close()
+            class_time = time.time() - class_start
+            run_downloaded += files_downloaded - already_had
+            run_failed += num_failed
+            tqdm.write(f'{files_downloaded} files downloaded for class {labels[i]}, {num_failed} failed, '
+                        f'{class_time:.1f}s ({(files_downloaded - already_had) / max(class_time, 1e-9):.2f} clips/s)')
+            if out_of_space:
+                tqdm.write(f'Stopped at class {labels[i]}, out of disk space or budget')
+                break
+
+    run_time = time.time() - run_start
+    print(f'Run complete: {run_downloaded} files across {len(labels)} classes, {run_failed} failed, '
+            f'{run_time:.1f}s ({run_downloaded / max(run_time, 1e-9):.2f} clips/s overall)')
+    if segment_fetch:
+        print(f"Segment fetches: {fetch_counts['segment']}, full download fallbacks: {fetch_counts['fallback']}")
+    if manifest is not None:
+        manifest.report()
+    print(f'Failures by kind: {scheduler.summary()}')
+    print(metrics.summary(whole_run=True))
+    metrics.export()
+    if budget is not None:
+        print(budget.summary())